@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Portable theme artifacts, a built theme that installs without rebuilding it.
+
+An artifact is a gzipped tarball with the built theme directory and an
+artifact.json describing it: the build options, the hash of every file and
+the grub entry to icon map. Archives are reproducible, the same build
+always gives byte identical artifacts, so they can be compared and cached.
+"""
+
+import os
+import io
+import json
+import gzip
+import tarfile
+
+import manifest
+from cache import hash_file
+
+ARTIFACT_VERSION = 1
+METADATA_NAME = "artifact.json"
+THEME_DIR_NAME = "theme"
+
+
+class ArtifactError(Exception):
+    "The artifact is invalid or does not match its metadata"
+
+
+def add_bytes(archive, name, data, mode=0o644):
+    "Adds data to archive as a regular file with normalized metadata"
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    member.mode = mode
+    member.mtime = 0
+    archive.addfile(member, io.BytesIO(data))
+
+
+def create(theme_dir, artifact_path, metadata):
+    """Writes the artifact of theme_dir to artifact_path, returns its metadata.
+
+    metadata is stored along with the theme files hashes. Members are sorted
+    and their owners, modes and times normalized, and the gzip header has no
+    name or time, so equal inputs give equal artifacts.
+    """
+    theme_manifest = manifest.build(theme_dir)
+    metadata = dict(metadata, version=ARTIFACT_VERSION, files=theme_manifest["files"])
+    temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as raw:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as compressed:
+                with tarfile.open(fileobj=compressed, mode="w", format=tarfile.GNU_FORMAT) as archive:
+                    data = json.dumps(metadata, indent=2, sort_keys=True).encode()
+                    add_bytes(archive, METADATA_NAME, data)
+                    for path in sorted(theme_manifest["files"]):
+                        with open(os.path.join(theme_dir, path), "rb") as f:
+                            add_bytes(archive, f"{THEME_DIR_NAME}/{path}", f.read())
+        os.replace(temp_path, artifact_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return metadata
+
+
+def extract(artifact_path, dst_dir):
+    """Extracts the artifact into dst_dir and checks it, returns its metadata.
+
+    The theme files end up in dst_dir/theme along with their manifest. Only
+    regular files with relative paths are accepted and every file must match
+    the hash recorded in the metadata. Raises ArtifactError.
+    """
+    theme_dir = os.path.join(dst_dir, THEME_DIR_NAME)
+    metadata = None
+    try:
+        with tarfile.open(artifact_path, "r:gz") as archive:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if not member.isfile() or os.path.isabs(name) or name.startswith(".."):
+                    raise ArtifactError(f"Unexpected member {member.name}")
+                data = archive.extractfile(member).read()
+                if name == METADATA_NAME:
+                    metadata = json.loads(data)
+                    continue
+                if not name.startswith(f"{THEME_DIR_NAME}/"):
+                    raise ArtifactError(f"Unexpected member {member.name}")
+                path = os.path.join(dst_dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+    except (OSError, tarfile.TarError, ValueError) as err:
+        raise ArtifactError(f"Could not read {artifact_path} ({err})")
+
+    if metadata is None or metadata.get("version") != ARTIFACT_VERSION:
+        raise ArtifactError(f"{artifact_path} has no supported {METADATA_NAME}")
+    extracted = manifest.list_files(theme_dir) if os.path.isdir(theme_dir) else []
+    if sorted(extracted) != sorted(metadata["files"]):
+        raise ArtifactError("The theme files do not match the artifact metadata")
+    for path, description in metadata["files"].items():
+        if hash_file(os.path.join(theme_dir, path)) != description["sha256"]:
+            raise ArtifactError(f"{path} does not match its hash, the artifact is corrupt")
+    manifest.write(theme_dir, {"version": manifest.MANIFEST_VERSION, "files": metadata["files"]})
+    return metadata
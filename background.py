@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Background image preprocessing for fast boots.
+
+GRUB decodes the desktop image with simple software decoders and reads it
+through firmware disk calls on every boot, so an image much bigger than the
+screen costs time for nothing. Images are fitted to the GRUB_GFXMODE
+resolution and encoded in the format that is estimated to load the fastest.
+"""
+
+import io
+import os
+import re
+import math
+from collections import namedtuple
+
+from PIL import Image, ImageOps
+
+DEFAULT_RESOLUTION = (1920, 1080)
+GFXMODE = re.compile(r"^\s*GRUB_GFXMODE=[\"']?([^\"'\n]*)", re.MULTILINE)
+RESOLUTION = re.compile(r"^(\d+)x(\d+)(?:x\d+)?$")
+
+# Rough cost model of loading an image in GRUB, the same for every format
+FIRMWARE_READ_BYTES_PER_S = 10 * 2 ** 20  # Disk reads through firmware calls
+DECODE_NS_PER_PIXEL = {
+    "TGA": 8,  # Copy, or RLE expand
+    "PNG": 45,  # Inflate and unfilter
+    "JPEG": 70,  # Huffman decode, IDCT and color conversion
+}
+JPEG_QUALITY = 92
+PREPROCESS_VERSION = 1  # Bump when preprocess() output changes, it is cached
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "TGA": "tga"}
+
+# Result of preprocess(), sizes are (width, height)
+Preprocessed = namedtuple(
+    "Preprocessed",
+    ["data", "format", "size", "original_size", "original_bytes", "original_format"],
+)
+
+
+def parse_gfxmode(grub_defaults):
+    "Returns the first explicit resolution of GRUB_GFXMODE in a grub defaults text"
+    match = GFXMODE.search(grub_defaults)
+    modes = match.group(1).split(",") if match else []
+    for mode in modes:
+        resolution = RESOLUTION.match(mode.strip())
+        if resolution:
+            return int(resolution.group(1)), int(resolution.group(2))
+    return DEFAULT_RESOLUTION
+
+
+def estimate_load_time(image_format, size_bytes, pixels):
+    "Returns the estimated seconds GRUB takes to read and decode an image"
+    decode_ns = DECODE_NS_PER_PIXEL.get(image_format, DECODE_NS_PER_PIXEL["PNG"])
+    return size_bytes / FIRMWARE_READ_BYTES_PER_S + pixels * decode_ns * 1e-9
+
+
+def is_rotated(im):
+    "Whether the EXIF orientation of im swaps its width and height"
+    try:
+        return im.getexif().get(0x0112) in (5, 6, 7, 8)
+    except (AttributeError, ValueError):
+        return False
+
+
+def fit(im, resolution, letterbox, color):
+    """Returns im cropped (or letterboxed) to the aspect ratio of resolution.
+
+    The result is scaled down to resolution but never up, GRUB stretches the
+    desktop image by itself.
+    """
+    width, height = resolution
+    if letterbox:  # Smallest canvas around the image
+        scale = max(im.width / width, im.height / height)
+    else:  # Biggest crop inside the image
+        scale = min(im.width / width, im.height / height)
+    scale = min(scale, 1)
+    canvas = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if letterbox:
+        return ImageOps.pad(im, canvas, method=Image.LANCZOS, color=color)
+    return ImageOps.fit(im, canvas, method=Image.LANCZOS)
+
+
+def encode(im, image_format):
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        # GRUB only decodes baseline jpegs
+        im.save(buffer, "JPEG", quality=JPEG_QUALITY, progressive=False)
+    elif image_format == "TGA":
+        im.save(buffer, "TGA", compression="tga_rle")
+    else:
+        im.save(buffer, "PNG", compress_level=9)
+    return buffer.getvalue()
+
+
+def preprocess(src_path, resolution, letterbox=False, color="#000000"):
+    """Returns the Preprocessed image at src_path fitted to resolution.
+
+    JPEGs are decoded with draft mode at the smallest scale still covering the
+    resolution so that huge photos never fully decode in memory. The output is
+    encoded in every format GRUB supports and the one with the lowest
+    estimated load time is kept.
+    """
+    original_bytes = os.path.getsize(src_path)
+    with Image.open(src_path) as im:
+        original_format, original_size = im.format, im.size
+        if im.format == "JPEG":
+            width, height = resolution[::-1] if is_rotated(im) else resolution
+            scale = (min if letterbox else max)(width / im.width, height / im.height)
+            im.draft("RGB", (math.ceil(im.width * scale), math.ceil(im.height * scale)))
+        im = ImageOps.exif_transpose(im)
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+        im = im.convert("RGBA" if has_alpha else "RGB")
+    im = fit(im, resolution, letterbox, color)
+
+    formats = ["PNG", "TGA"] if has_alpha else ["JPEG", "PNG", "TGA"]
+    pixels = im.width * im.height
+    data, image_format = min(
+        ((encode(im, image_format), image_format) for image_format in formats),
+        key=lambda pair: estimate_load_time(pair[1], len(pair[0]), pixels),
+    )
+    return Preprocessed(
+        data, image_format, im.size, original_size, original_bytes, original_format
+    )
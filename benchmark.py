@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the time critical paths of Matter.
+
+Run all of them with ./benchmark.py or some with ./benchmark.py <name> ...
+The script exits with a non zero status when a benchmark goes over its budget
+so it can guard against performance regressions.
+
+Benchmarks that drive matter.py run it in process against synthetic grub.cfg
+files and stub inkscape, convert, grub-mkfont and grub-mkconfig executables
+with a configurable latency, so they need neither /boot/grub nor grub tools
+and never touch the system. The grub-mkconfig stub is a shell script shaped
+like the real one, so matter.py can hook into it, and the hook runs a
+matter.py wrapper redirected to the same temporary files. Results can be saved with --save and compared
+with a previous run (e.g. of another commit) with --compare.
+"""
+
+import io
+import os
+import sys
+import json
+import shlex
+import time
+import zlib
+import shutil
+import struct
+import base64
+import tempfile
+import platform
+import statistics
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from subprocess import run, PIPE, DEVNULL
+
+# Local Matter modules
+from utils import info, warning, error
+import grubcfg
+
+INSTALLER_DIR = dirname(abspath(__file__))
+
+# `matter.py --configicons` runs inside every grub-mkconfig
+HOOK_STARTUP_BUDGET_MS = 60  # On top of a bare python interpreter startup
+HOOK_FORBIDDEN_MODULES = [
+    "PIL",
+    "urllib.request",
+    "http.client",
+    "xml.dom.minidom",
+    "xml.etree.ElementTree",
+    "concurrent.futures.thread",
+    "svg2png",
+    "download",
+    "cache",
+    "manifest",
+    "background",
+    "pngopt",
+    "mdipack",
+    "iconsearch",
+    "artifact",
+    "tint",
+    "preview",
+]
+HOOK_STARTUP_SCRIPT = """
+import sys, json
+sys.argv = ["matter.py", "--configicons"]
+import matter
+matter.user_args = matter.parse_args()
+print(json.dumps(sorted(sys.modules)))
+"""
+
+# Patching grub.cfg files as big as the ones grub-btrfs generates
+PATCH_ENTRY_COUNTS = [10000, 20000]
+PATCH_BUDGET_S = 2.0  # For the smallest entry count
+PATCH_MAX_GROWTH = 3.0  # Time ratio allowed when doubling the entries (linear is 2)
+
+GRUB_CFG_HEADER = """#
+# DO NOT EDIT THIS FILE
+#
+function load_video {
+  if [ x$feature_all_video_module = xy ]; then
+    insmod all_video
+  fi
+}
+"""
+GRUB_CFG_ENTRY = """{indent}menuentry '{name}' --class ubuntu --class gnu-linux --class os $menuentry_id_option 'gnulinux-{i}-advanced' {{
+{indent}	recordfail
+{indent}	load_video
+{indent}	insmod gzio
+{indent}	search --no-floppy --fs-uuid --set=root 0f2c3a58-5d7a-4e4b-9d7e-{i:012d}
+{indent}	echo	'Loading Linux 6.8.0-{i}-generic ...'
+{indent}	linux	/vmlinuz-6.8.0-{i}-generic root=UUID=0f2c3a58 ro quiet splash
+{indent}	initrd	/initrd.img-6.8.0-{i}-generic
+{indent}}}
+"""
+
+
+# Matter run in process against synthetic inputs and stub tools
+ENTRY_COUNTS = [10, 1000, 20000]  # For the grub.cfg reading and patching benchmarks
+BUILD_ENTRY_COUNT = 20
+BUILD_ICON_NAMES = [f"icon-{i}" for i in range(10)]
+RULE_COUNT = 300  # Icon rules of the rules benchmark, only the last ones match
+ICON_SVG = """<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"><path d="M{i} 2L22 12L{i} 22Z" /></svg>"""
+
+# Stub executables, {python} {png} {latency} and {item_latency} are filled in
+STUB_HEADER = """#!{python}
+import sys, time, base64
+PNG = base64.b64decode("{png}")
+time.sleep({latency})  # Process startup
+args = sys.argv[1:]
+"""
+STUBS = {
+    "inkscape": """
+if args == ["--version"]:
+    print("Inkscape 1.2.2 (stub)")
+elif args == ["--shell"]:
+    for line in sys.stdin:
+        for action in line.split(";"):
+            if action.strip().startswith("export-filename:"):
+                time.sleep({item_latency})
+                with open(action.strip()[len("export-filename:"):], "wb") as f:
+                    f.write(PNG)
+""",
+    "convert": """
+if args == ["-version"]:
+    print("Version: ImageMagick 6.9.11 (stub)")
+for i, arg in enumerate(args):
+    if arg == "-write":
+        time.sleep({item_latency})
+        with open(args[i + 1], "wb") as f:
+            f.write(PNG)
+""",
+    "grub-mkfont": """
+with open(args[args.index("-o") + 1], "wb") as f:
+    f.write(b"FILE\\x00\\x00\\x00\\x04PFF2" + " ".join(args).encode())
+""",
+}
+
+# Shell stubs, {latency} and {tempdir} are filled in. Like the real
+# grub-mkconfig, grub.cfg is the output of the /etc/grub.d scripts loop.
+SHELL_STUBS = {
+    "grub-mkconfig": """#!/bin/sh
+sleep {latency}
+grub_mkconfig_dir="{tempdir}/etc/grub.d"
+grub_cfg=""
+while test $# -gt 0; do
+  if test "x$1" = "x-o"; then
+    shift
+    grub_cfg="$1"
+  fi
+  shift
+done
+
+if test "x${{grub_cfg}}" != "x"; then
+  rm -f "${{grub_cfg}}.new"
+  exec > "${{grub_cfg}}.new"
+fi
+
+for i in "${{grub_mkconfig_dir}}"/* ; do
+  if test -x "$i" ; then
+    "$i"
+  fi
+done
+
+if test "x${{grub_cfg}}" != "x"; then
+  mv -f "${{grub_cfg}}.new" "${{grub_cfg}}"
+fi
+""",
+    "update-grub": """#!/bin/sh
+exec "{tempdir}/bin/grub-mkconfig" "$@"
+""",
+}
+GRUB_SCRIPT = """#!/bin/sh
+cat "{tempdir}/entries.cfg"
+"""  # The only /etc/grub.d script besides 99_matter, with the synthetic entries
+
+# Run by the grub-mkconfig hook and the sudo relaunch instead of matter.py
+MATTER_WRAPPER = """#!{python}
+import sys
+sys.path.insert(0, "{installer_dir}")
+import benchmark
+benchmark.redirect_matter("{tempdir}").main()
+"""
+
+# Where matter.py keeps each file, relative to a benchmark temporary directory
+MATTER_PATHS = {
+    "GRUB_CFG_PATH": "boot/grub.cfg",
+    "GRUB_DEFAULTS_PATH": "etc/default/grub",
+    "GRUB_SCRIPTS_PATH": "etc/grub.d",
+    "INSTALLATION_SOURCE_DIR": "Matter",
+    "INSTALLATION_TARGET_DIR": "boot/themes/Matter",
+    "ICON_SVG_PATHF": "icons/{}.svg",
+    "ICON_PNG_PATHF": "Matter/icons/{}.png",
+    "CACHE_DIR": "cache",
+    "ICON_CACHE_DIR": "cache/icons",
+    "FONT_CACHE_DIR": "cache/fonts",
+    "PNG_CACHE_DIR": "cache/pngs",
+    "MASK_CACHE_DIR": "cache/masks",
+    "BACKGROUND_CACHE_DIR": "cache/backgrounds",
+    "CONFIG_FILE_PATH": "config.json",
+    "BOOT_GRUB_PATH": "boot",
+    "INSTALLER_DIR": "",
+    "MDI_PACK_PATH": "icons/mdi.pack",
+    "MDI_INDEX_PATH": "icons/mdi.index.json",
+    "MDI_META_PATH": "icons/mdi.meta.json",
+    "MDI_SEARCH_INDEX_PATH": "icons/mdi.trigrams.json",
+}
+
+RESULTS = {}  # benchmark -> metric -> seconds, see record()
+
+
+def record(benchmark, metric, seconds):
+    RESULTS.setdefault(benchmark, {})[metric] = seconds
+
+
+def generate_grub_cfg(entry_count, submenu_size=50):
+    "Returns a grub.cfg with entry_count entries, grouped in nested submenus"
+    parts = [GRUB_CFG_HEADER]
+    i = 0
+    while i < entry_count:
+        parts.append(f"submenu 'Snapshots {i}' $menuentry_id_option 'snapshots-{i}' {{\n")
+        i += 1
+        for _ in range(min(submenu_size, entry_count - i)):
+            parts.append(GRUB_CFG_ENTRY.format(indent="\t", name=f"Ubuntu snapshot {i}", i=i))
+            i += 1
+        parts.append("}\n")
+    return "".join(parts)
+
+
+def make_png(width, height):
+    "Returns a valid RGBA png with a diagonal pattern, without needing PIL"
+    rows = b"".join(
+        b"\x00" + b"".join(
+            b"\xff\xff\xff\xff" if (x + y) % 8 == 0 else b"\x00\x00\x00\x00"
+            for x in range(width)
+        )
+        for y in range(height)
+    )
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+    )
+
+
+def write_executable(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def write_stubs(tempdir, latency, item_latency):
+    "Writes the stub executables to tempdir/bin, and the grub.d script and matter.py wrapper"
+    png = base64.b64encode(make_png(72, 72)).decode()
+    header = STUB_HEADER.format(python=sys.executable, png=png, latency=latency)
+    for name, body in STUBS.items():
+        write_executable(f"{tempdir}/bin/{name}", header + body.format(item_latency=item_latency))
+    for name, script in SHELL_STUBS.items():
+        write_executable(f"{tempdir}/bin/{name}", script.format(latency=latency, tempdir=tempdir))
+    write_executable(f"{tempdir}/etc/grub.d/10_entries", GRUB_SCRIPT.format(tempdir=tempdir))
+    wrapper = MATTER_WRAPPER.format(
+        python=sys.executable, installer_dir=INSTALLER_DIR, tempdir=tempdir
+    )
+    write_executable(f"{tempdir}/matter.py", wrapper)
+
+
+def redirect_matter(tempdir):
+    """Returns the matter module with every system path global pointed into tempdir.
+
+    Root checks are disabled and relaunching as root runs the tempdir
+    matter.py wrapper instead, which redirects itself the same way.
+    """
+    import matter
+
+    for name, path in MATTER_PATHS.items():
+        setattr(matter, name, f"{tempdir}/{path}".rstrip("/"))
+    matter.check_root_or_prompt = lambda: None
+    matter.get_grub_mkconfig_path = lambda: f"{tempdir}/bin/grub-mkconfig"
+
+    def relaunch_as_root(*extra_args):
+        args = [f"{tempdir}/matter.py"] + sys.argv[1:] + list(extra_args)
+        return matter.sh(" ".join(shlex.quote(arg) for arg in args))
+
+    matter.relaunch_as_root = relaunch_as_root
+    return matter
+
+
+def setup_matter(tempdir, args, argv):
+    """Returns the matter module set up to only use files in tempdir.
+
+    Stub tools are put first in PATH and matter is redirected into tempdir,
+    see redirect_matter(). Calling it again resets the temporary files of the
+    previous setup.
+    """
+    for name in ("boot", "etc", "icons", "cache", "Matter", "bin", "fonts"):
+        path = f"{tempdir}/{name}"
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+    for name in ("fonts", "config.json", "entries.cfg", "matter.py"):
+        if os.path.lexists(f"{tempdir}/{name}"):
+            os.remove(f"{tempdir}/{name}")
+    for name in ("boot", "etc/default", "etc/grub.d", "icons", "bin"):
+        os.makedirs(f"{tempdir}/{name}")
+    shutil.copytree(f"{INSTALLER_DIR}/Matter", f"{tempdir}/Matter")
+    os.symlink(f"{INSTALLER_DIR}/fonts", f"{tempdir}/fonts")  # INSTALLER_DIR is tempdir
+    with open(f"{tempdir}/etc/default/grub", "w") as f:
+        f.write('GRUB_DEFAULT=0\nGRUB_TIMEOUT=5\nGRUB_CMDLINE_LINUX_DEFAULT="quiet splash"\n')
+    for i, icon in enumerate(BUILD_ICON_NAMES):
+        with open(f"{tempdir}/icons/{icon}.svg", "w") as f:
+            f.write(ICON_SVG.format(i=i + 2))
+    write_stubs(tempdir, args.latency, args.item_latency)
+    if not os.environ["PATH"].startswith(f"{tempdir}/bin:"):
+        os.environ["PATH"] = f"{tempdir}/bin:{os.environ['PATH']}"
+
+    matter = redirect_matter(tempdir)
+    matter.get_mdi_pack.cache_clear()
+    grubcfg._cache.clear()
+    sys.argv = ["matter.py", *argv]
+    matter.user_args = matter.parse_args()
+    return matter
+
+
+def time_call(function, runs, setup=None):
+    "Returns the median seconds of function() over runs, setup() runs untimed before each"
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def quietly(function):
+    "Calls function with its output and the one of the tools it runs (matter.py logs) discarded"
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout, stderr = sys.stdout, sys.stderr
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        sys.stdout = sys.stderr = devnull
+        try:
+            return function()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            for fd, saved_fd in zip((1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+
+def time_python(code, runs):
+    "Runs code in fresh interpreters, returns the median seconds and last stdout"
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        stdout = run(
+            [sys.executable, "-c", code], cwd=INSTALLER_DIR, stdout=PIPE, check=True
+        ).stdout
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), stdout
+
+
+def bench_hook(args):
+    "Startup cost of the grub-mkconfig hook until it starts doing actual work"
+    baseline, _ = time_python("pass", args.runs)
+    total, stdout = time_python(HOOK_STARTUP_SCRIPT, args.runs)
+    overhead_ms = (total - baseline) * 1000
+    record("hook", "startup overhead", total - baseline)
+    modules = json.loads(stdout)
+    loaded = [module for module in HOOK_FORBIDDEN_MODULES if module in modules]
+
+    info(
+        f"hook: {total * 1000:.1f}ms median over {args.runs} runs, "
+        f"{overhead_ms:.1f}ms over bare python (budget {HOOK_STARTUP_BUDGET_MS}ms)"
+    )
+    passed = True
+    if loaded:
+        warning(f"hook: modules not needed by the hook were imported: {loaded}")
+        passed = False
+    if overhead_ms > HOOK_STARTUP_BUDGET_MS:
+        warning(f"hook: startup over budget")
+        passed = False
+    return passed
+
+
+def bench_patch(args):
+    "Parse and stream-patch synthetic grub.cfg files with thousands of entries"
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        for count in PATCH_ENTRY_COUNTS:
+            path = f"{tempdir}/grub_{count}.cfg"
+            with open(path, "w") as f:
+                f.write(generate_grub_cfg(count))
+            size_mb = os.path.getsize(path) / 2 ** 20
+
+            parse_times, patch_times = [], []
+            for _ in range(max(1, args.runs // 5)):
+                start = time.perf_counter()
+                grub_cfg = grubcfg.GrubCfg(path, open(path, "rb").read())
+                parse_times.append(time.perf_counter() - start)
+                insertions = [(e.name_end, b" --class camera") for e in grub_cfg.entries]
+                start = time.perf_counter()
+                grub_cfg.patch(insertions)
+                patch_times.append(time.perf_counter() - start)
+            timings[count] = statistics.median(parse_times) + statistics.median(patch_times)
+            record("patch", f"parse {count}", statistics.median(parse_times))
+            record("patch", f"patch {count}", statistics.median(patch_times))
+            info(
+                f"patch: {count} entries ({size_mb:.1f}MB) parsed in "
+                f"{statistics.median(parse_times):.3f}s and patched in "
+                f"{statistics.median(patch_times):.3f}s"
+            )
+
+    passed = True
+    smallest, largest = PATCH_ENTRY_COUNTS[0], PATCH_ENTRY_COUNTS[-1]
+    if timings[smallest] > PATCH_BUDGET_S:
+        warning(f"patch: {smallest} entries over the {PATCH_BUDGET_S}s budget")
+        passed = False
+    growth = timings[largest] / timings[smallest]
+    expected = PATCH_MAX_GROWTH * largest / smallest / 2
+    if growth > expected:
+        warning(f"patch: time grew {growth:.1f}x for {largest / smallest:.0f}x entries")
+        passed = False
+    return passed
+
+
+def bench_entries(args):
+    "matter.get_entry_names() on grub.cfg files from a few to thousands of entries"
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        matter = setup_matter(tempdir, args, [])
+        for count in ENTRY_COUNTS:
+            with open(matter.GRUB_CFG_PATH, "w") as f:
+                f.write(generate_grub_cfg(count))
+            seconds = time_call(
+                matter.get_entry_names, max(1, args.runs // 5), grubcfg._cache.clear
+            )
+            record("entries", f"get_entry_names {count}", seconds)
+            info(f"entries: {count} entries read in {seconds:.3f}s")
+    return True
+
+
+def bench_iconpatch(args):
+    "matter.do_patch_grub_cfg_icons(), patch_from_config_file() and do_filter_icons()"
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        matter = setup_matter(tempdir, args, [])
+        for count in ENTRY_COUNTS:
+            content = generate_grub_cfg(count)
+
+            def reset():
+                with open(matter.GRUB_CFG_PATH, "w") as f:
+                    f.write(content)
+
+            reset()
+            entries = matter.get_entry_names()
+            icons = [BUILD_ICON_NAMES[i % len(BUILD_ICON_NAMES)] for i in range(len(entries))]
+            runs = max(1, args.runs // 5)
+            seconds = time_call(lambda: quietly(lambda: matter.do_patch_grub_cfg_icons(icons)), runs, reset)
+            record("iconpatch", f"do_patch_grub_cfg_icons {count}", seconds)
+
+            reset()
+            matter.user_args.icons = icons
+            matter.create_config_file()
+            seconds_config = time_call(lambda: quietly(matter.patch_from_config_file), runs, reset)
+            record("iconpatch", f"patch_from_config_file {count}", seconds_config)
+
+            def filter_icons():
+                stdin = sys.stdin
+                sys.stdin = io.TextIOWrapper(io.BytesIO(content.encode()))
+                try:
+                    matter.do_filter_icons()  # Output discarded by quietly()
+                finally:
+                    sys.stdin = stdin
+
+            seconds_filter = time_call(lambda: quietly(filter_icons), runs)
+            record("iconpatch", f"do_filter_icons {count}", seconds_filter)
+            info(
+                f"iconpatch: {count} entries patched in {seconds:.3f}s, "
+                f"from config.json in {seconds_config:.3f}s, filtered in {seconds_filter:.3f}s"
+            )
+    return True
+
+
+def bench_rules(args):
+    "matter.get_config_icons() resolving new entries with --iconrule rules"
+    rules = [[f"Distro {i} *", BUILD_ICON_NAMES[0]] for i in range(RULE_COUNT)]
+    rules += [["re:.*snapshot [0-9]*5", BUILD_ICON_NAMES[1]], ["*snapshot*", BUILD_ICON_NAMES[2]]]
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        matter = setup_matter(tempdir, args, [])
+        for count in ENTRY_COUNTS:
+            with open(matter.GRUB_CFG_PATH, "w") as f:
+                f.write(generate_grub_cfg(count))
+            entries = matter.get_entry_names()
+            config = {"icons": {}, "rules": rules}
+            seconds = time_call(
+                lambda: quietly(lambda: matter.get_config_icons(entries, config)), args.runs
+            )
+            record("rules", f"get_config_icons {count}", seconds)
+            info(f"rules: {count} entries matched against {len(rules)} rules in {seconds:.3f}s")
+    return True
+
+
+def bench_build(args):
+    "matter.prepare_source_dir() with stub tools, cold, warm and recolored, and do_preview()"
+    passed = True
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        for converter in ("inkscape", "convert"):
+            icons = [BUILD_ICON_NAMES[i % len(BUILD_ICON_NAMES)] for i in range(BUILD_ENTRY_COUNT)]
+            argv = ["--buildonly", "--converter", converter, "-i", *icons]
+            matter = setup_matter(tempdir, args, argv)
+            with open(matter.GRUB_CFG_PATH, "w") as f:
+                f.write(generate_grub_cfg(BUILD_ENTRY_COUNT))
+
+            cold = time_call(lambda: quietly(matter.prepare_source_dir), 1)
+            warm = time_call(lambda: quietly(matter.prepare_source_dir), max(1, args.runs // 5))
+            record("build", f"{converter} cold", cold)
+            record("build", f"{converter} warm", warm)
+            matter.user_args.iconcolor = "red"  # Only tints the cached icon masks
+            recolor = time_call(lambda: quietly(matter.prepare_source_dir), 1)
+            record("build", f"{converter} recolor", recolor)
+            preview = time_call(
+                lambda: quietly(lambda: matter.do_preview(f"{tempdir}/preview.png")), 1
+            )
+            record("build", f"{converter} preview", preview)
+            info(
+                f"build: {len(BUILD_ICON_NAMES)} icons with {converter} stub in {cold:.3f}s, "
+                f"{warm:.3f}s with warm caches, {recolor:.3f}s in another color, "
+                f"previewed in {preview:.3f}s"
+            )
+            if warm > cold:
+                warning(f"build: warm build with {converter} slower than cold one")
+                passed = False
+    return passed
+
+
+def bench_install(args):
+    "matter.do_install() then update-grub through the hook, in both --hookmode"
+    passed = True
+    with tempfile.TemporaryDirectory(prefix="matter-bench-") as tempdir:
+        for hookmode in ("append", "filter"):
+            icons = [BUILD_ICON_NAMES[i % len(BUILD_ICON_NAMES)] for i in range(BUILD_ENTRY_COUNT)]
+            argv = ["--converter", "inkscape", "--hookmode", hookmode, "-i", *icons]
+            matter = setup_matter(tempdir, args, argv)
+            content = generate_grub_cfg(BUILD_ENTRY_COUNT)
+            for path in (matter.GRUB_CFG_PATH, f"{tempdir}/entries.cfg"):
+                with open(path, "w") as f:
+                    f.write(content)
+
+            install = time_call(lambda: quietly(matter.do_install), 1)
+            reinstall = time_call(lambda: quietly(matter.do_install), max(1, args.runs // 5))
+            update = time_call(lambda: quietly(matter.update_grub_cfg), max(1, args.runs // 5))
+            record("install", f"{hookmode} install", install)
+            record("install", f"{hookmode} reinstall", reinstall)
+            record("install", f"{hookmode} update-grub", update)
+            info(
+                f"install: {hookmode} hook installed in {install:.3f}s, "
+                f"reinstalled in {reinstall:.3f}s, grub updated through it in {update:.3f}s"
+            )
+
+            with open(matter.GRUB_CFG_PATH, "rb") as f:
+                grub_cfg = grubcfg.GrubCfg(matter.GRUB_CFG_PATH, f.read())
+            with_icons = [e for e in grub_cfg.entries if e.classes[:1] and e.classes[0] in icons]
+            if len(with_icons) != len(matter.get_entry_names()):
+                warning(f"install: update-grub through the {hookmode} hook did not set icons")
+                passed = False
+    return passed
+
+
+BENCHMARKS = {
+    "hook": bench_hook,
+    "patch": bench_patch,
+    "entries": bench_entries,
+    "iconpatch": bench_iconpatch,
+    "rules": bench_rules,
+    "build": bench_build,
+    "install": bench_install,
+}
+
+
+def get_commit():
+    "Returns the current git commit of the installer or None"
+    result = run(
+        ["git", "rev-parse", "--short", "HEAD"], cwd=INSTALLER_DIR, stdout=PIPE, stderr=DEVNULL
+    )
+    return result.stdout.decode().strip() or None
+
+
+def save_results(path):
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": RESULTS,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    info(f"Results saved to {path}")
+
+
+def compare_results(path):
+    "Prints the current results next to the ones saved at path"
+    with open(path) as f:
+        baseline = json.load(f)
+    info(f"Compared with {baseline.get('commit')} ({baseline.get('time')}), ratio = now / then")
+    for benchmark, metrics in RESULTS.items():
+        for metric, seconds in metrics.items():
+            then = baseline["results"].get(benchmark, {}).get(metric)
+            ratio = f"{seconds / then:6.2f}x" if then else "      -"
+            then = f"{then:9.4f}s" if then is not None else "        -"
+            print(f"{benchmark:<10}{metric:<34}{then} {seconds:9.4f}s {ratio}")
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}",
+        default=list(BENCHMARKS),
+    )
+    parser.add_argument(
+        "--runs", "-r", type=int, help="repetitions per measurement", default=10,
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="seconds each stub tool takes to start",
+        default=0.05,
+    )
+    parser.add_argument(
+        "--item-latency",
+        type=float,
+        help="seconds stub converters take per icon",
+        default=0.01,
+    )
+    parser.add_argument("--save", help="save the results as json to this file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        error(f"Unknown benchmarks: {unknown}", f"Available: {list(BENCHMARKS)}")
+    results = [BENCHMARKS[name](args) for name in args.benchmarks]
+    if args.compare:
+        compare_results(args.compare)
+    if args.save:
+        save_results(args.save)
+    if not all(results):
+        error("Some benchmarks failed")
+    info("All benchmarks passed")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+from shutil import copyfile
+
+
+def hash_key(*parts):
+    "Returns a hex digest identifying the given str/bytes parts"
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, "little"))  # Avoid ambiguous joins
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    "Returns the sha256 hex digest of the file contents"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileCache:
+    """Directory of files addressed by a content key.
+
+    The total size is capped at max_bytes, when exceeded the least recently
+    used files are evicted. Files are stamped with their last use time on
+    every hit, as atime is not reliable on most mounts.
+    """
+
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    def path(self, key):
+        return f"{self.directory}/{key}{self.suffix}"
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key, dst_path):
+        "Hardlinks (or copies) the cached file to dst_path, returns False on miss"
+        cached_path = self.path(key)
+        if not os.path.exists(cached_path):
+            return False
+        try:
+            os.utime(cached_path)
+        except OSError:
+            pass  # The cache could belong to another user (e.g. root)
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)  # Never write through an existing link
+        try:
+            os.link(cached_path, dst_path)
+        except OSError:
+            copyfile(cached_path, dst_path)
+        return True
+
+    def put(self, key, src_path):
+        "Stores a copy of src_path under key, returns False if it couldn't"
+        cached_path = self.path(key)
+        temp_path = f"{cached_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            copyfile(src_path, temp_path)
+            os.replace(temp_path, cached_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        "Removes least recently used files until the cache fits in max_bytes"
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError:
+            return
+        stats = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries),
+            reverse=True,
+        )
+        total = 0
+        for _, size, path in stats:
+            total += size
+            if total > self.max_bytes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+from urllib.request import url2pathname
+
+USER_AGENT = "matter-grub-theme"
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_REDIRECTS = 3
+CHUNK_SIZE = 1 << 16  # Bytes read at once when streaming to disk
+
+
+class FetchError(Exception):
+    "A single url could not be fetched, the message is the reason"
+
+
+class ConnectionPool:
+    """Hands out persistent HTTP(S) connections, one per thread and host.
+
+    Connections are reused between requests made from the same worker thread,
+    so a batch of downloads to the same CDN only pays a handful of TLS
+    handshakes instead of one per file.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault("connections", {})
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == "http":
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise FetchError(f"Unsupported url scheme '{scheme}'")
+            connections[key] = conn
+            with self.lock:
+                self.opened.append(conn)
+        return connections[key]
+
+    def drop(self, scheme, netloc):
+        "Closes the current thread connection to netloc, a new one will be made"
+        connections = self.local.__dict__.get("connections", {})
+        conn = connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        "Closes every connection, ones used again reconnect and are closed by the next call"
+        with self.lock:
+            for conn in self.opened:
+                conn.close()
+
+
+def read_file_url(url):
+    "Returns the content of a file:// url, e.g. from a local mirror"
+    try:
+        with open(url2pathname(urlsplit(url).path), "rb") as f:
+            return f.read()
+    except OSError as err:
+        raise FetchError(err.strerror or str(err))
+
+
+def fetch(pool, url, retries=2, backoff=0.5):
+    "GETs url through pool and returns the body, raises FetchError on failure"
+    if urlsplit(url).scheme == "file":
+        return read_file_url(url)
+    reason = "unknown error"
+    redirects = 0
+    attempt = 0
+    while attempt <= retries:
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+        conn = pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path, headers={"User-Agent": USER_AGENT})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            # Stale keep-alive connections end up here too, so retry on a new one
+            pool.drop(parts.scheme, parts.netloc)
+            reason = str(err) or type(err).__name__
+            attempt += 1
+            time.sleep(backoff * attempt)
+            continue
+        if response.will_close:
+            pool.drop(parts.scheme, parts.netloc)
+
+        status = response.status
+        if status == 200:
+            return body
+        if status in REDIRECT_STATUSES and redirects < MAX_REDIRECTS:
+            redirects += 1
+            url = urljoin(url, response.getheader("Location", ""))
+            continue
+        reason = f"{status} {response.reason}"
+        if status not in RETRY_STATUSES:
+            break
+        attempt += 1
+        time.sleep(backoff * attempt)
+    raise FetchError(reason)
+
+
+def fetch_all(urls, workers=8, timeout=10, retries=2, timings=None):
+    """Downloads every url concurrently with at most `workers` connections.
+
+    Returns a tuple (results, failures), both dicts keyed by url, with the
+    fetched bytes and the failure reason respectively. It never raises for a
+    single failed url so the caller can report all of them at once. If a
+    timings dict is given, the seconds spent on each url are stored in it.
+    """
+    urls = list(dict.fromkeys(urls))  # Deduplicate keeping order
+    results, failures = {}, {}
+    if not urls:
+        return results, failures
+
+    pool = ConnectionPool(timeout)
+
+    def job(url):
+        start = time.perf_counter()
+        try:
+            results[url] = fetch(pool, url, retries=retries)
+        except FetchError as err:
+            failures[url] = str(err)
+        if timings is not None:
+            timings[url] = time.perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as executor:
+            list(executor.map(job, urls))
+    finally:
+        pool.close()
+    return results, failures
+
+
+def open_url(pool, url, headers):
+    """Sends a GET for url through pool following redirects.
+
+    Returns the response with its body still unread, the caller must read it
+    whole before reusing the connection. Network errors are raised as is.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+        conn = pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path, headers=dict(headers, **{"User-Agent": USER_AGENT}))
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            pool.drop(parts.scheme, parts.netloc)  # Maybe a stale keep-alive
+            raise
+        if response.status not in REDIRECT_STATUSES:
+            return response
+        response.read()
+        url = urljoin(url, response.getheader("Location", ""))
+    return response
+
+
+def get_validators(response):
+    "Returns the cache validators (ETag and Last-Modified) sent with response"
+    return {
+        "etag": response.getheader("ETag"),
+        "last_modified": response.getheader("Last-Modified"),
+    }
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def download_file_url(url, dst_path, validators=None, max_bytes=None):
+    "download() of a file:// url, e.g. a local mirror, its size and mtime act as ETag"
+    path = url2pathname(urlsplit(url).path)
+    part_path = f"{dst_path}.part"
+    try:
+        stat = os.stat(path)
+        new_validators = {"etag": f"{stat.st_size}-{stat.st_mtime_ns}", "last_modified": None}
+        if validators and validators.get("etag") == new_validators["etag"]:
+            return False, validators
+        if max_bytes is not None and stat.st_size > max_bytes:
+            raise FetchError(f"File is bigger than {max_bytes} bytes")
+        with open(path, "rb") as src, open(part_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                dst.write(chunk)
+        os.replace(part_path, dst_path)
+    except OSError as err:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise FetchError(err.strerror or str(err))
+    return True, new_validators
+
+
+def download(url, dst_path, validators=None, max_bytes=None, timeout=10, retries=2, backoff=0.5):
+    """Streams url into dst_path without holding the body in memory.
+
+    validators are the ones returned by a previous download of url, they make
+    the request conditional and (False, validators) is returned if the server
+    answers 304 Not Modified. Otherwise the body is written in chunks to dst_path.part,
+    moved to dst_path once complete, and (True, new validators) is returned.
+    An interrupted download leaves its .part file, which later calls resume
+    with a Range request when the server supports it and the remote file has
+    not changed. Bodies over max_bytes are refused. file:// urls are copied,
+    see download_file_url(). Raises FetchError.
+    """
+    if urlsplit(url).scheme == "file":
+        return download_file_url(url, dst_path, validators, max_bytes)
+    part_path = f"{dst_path}.part"
+    part_meta_path = f"{part_path}.json"
+    pool = ConnectionPool(timeout)
+    reason = "unknown error"
+    attempt = 0
+    try:
+        while attempt <= retries:
+            headers = {}
+            if validators and validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators and validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+            # Resume only what was downloaded from the same remote version
+            part_meta = read_json(part_meta_path) or {}
+            part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if_range = part_meta.get("etag") or part_meta.get("last_modified")
+            if part_size and part_meta.get("url") == url and if_range:
+                headers["Range"] = f"bytes={part_size}-"
+                headers["If-Range"] = if_range
+
+            try:
+                response = open_url(pool, url, headers)
+                if response.status == 304:
+                    response.read()
+                    return False, validators
+                if response.status == 416:  # The .part is no longer valid
+                    response.read()
+                    os.remove(part_path)
+                    continue
+                if response.status not in (200, 206):
+                    response.read()
+                    reason = f"{response.status} {response.reason}"
+                    if response.status not in RETRY_STATUSES:
+                        break
+                    attempt += 1
+                    time.sleep(backoff * attempt)
+                    continue
+
+                offset = part_size if response.status == 206 else 0
+                length = response.getheader("Content-Length")
+                expected = offset + int(length) if length is not None else None
+                if max_bytes is not None and (expected or 0) > max_bytes:
+                    raise FetchError(f"File is bigger than {max_bytes} bytes")
+
+                new_validators = get_validators(response)
+                with open(part_meta_path, "w") as f:
+                    json.dump(dict(new_validators, url=url), f)
+                with open(part_path, "r+b" if offset else "wb") as f:
+                    f.seek(offset)
+                    f.truncate()
+                    size = offset
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        size += len(chunk)
+                        if max_bytes is not None and size > max_bytes:
+                            raise FetchError(f"File is bigger than {max_bytes} bytes")
+                        f.write(chunk)
+                if expected is not None and size != expected:
+                    raise http.client.IncompleteRead(b"", expected - size)
+            except FetchError:
+                if os.path.exists(part_path):
+                    os.remove(part_path)  # Not worth resuming
+                raise
+            except (OSError, http.client.HTTPException) as err:
+                pool.close()  # Closed connections reconnect on their next request
+                reason = str(err) or type(err).__name__
+                attempt += 1
+                time.sleep(backoff * attempt)
+                continue
+
+            os.replace(part_path, dst_path)
+            os.remove(part_meta_path)
+            return True, new_validators
+    finally:
+        pool.close()
+    raise FetchError(reason)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+In-memory model of a grub.cfg built with a single pass lexer.
+
+The lexer follows grub script quoting rules (single quotes, double quotes with
+backslash escapes, backslash escapes, comments) so entry titles with escaped
+quotes, nested submenus and existing --class arguments are all understood.
+Parsed files are cached by path and invalidated when their mtime or size change.
+
+Files are memory mapped and lexed as bytes, so offsets are byte offsets and a
+patched copy can be streamed from the source without decoding or building it
+in memory, which keeps multi megabyte configs (e.g. grub-btrfs) cheap.
+"""
+
+import os
+import re
+import mmap
+from collections import namedtuple
+
+from utils import atomic_open
+
+ENTRY_KEYWORDS = (b"menuentry", b"submenu")
+ID_OPTIONS = (b"--id", b"$menuentry_id_option")
+CHUNK_SIZE = 1 << 20  # Bytes copied at once when streaming a patched file
+
+# A shell-like word: value is unquoted bytes, start and end are raw offsets
+Word = namedtuple("Word", ["value", "start", "end"])
+
+# A menuentry or submenu, start and end span its header from keyword to "{"
+Entry = namedtuple(
+    "Entry",
+    ["kind", "name", "start", "end", "name_start", "name_end", "depth", "id", "classes"],
+)
+
+TOKEN = re.compile(
+    rb"(?P<space>[ \t\r]+|\\\n)"  # Blanks and line continuations
+    rb"|(?P<separator>[\n;])"
+    rb"|(?P<comment>#[^\n]*)"
+    rb"|(?P<brace>[{}])(?=[\s;]|\Z)"
+    rb"|(?P<word>(?:[^\s;'\"\\]+|'[^']*'|\"(?:[^\"\\]|\\.)*\"|\\.)+)",
+    re.DOTALL,
+)
+WORD_PART = re.compile(
+    rb"""([^'"\\]+)"""  # Plain characters
+    rb"|'([^']*)'"  # Single quoted, no escapes
+    rb'|"((?:[^"\\]|\\.)*)"'  # Double quoted, with escapes
+    rb"|\\(.)",  # Escaped character
+    re.DOTALL,
+)
+# Whole lines with simple commands that can't affect entries or nesting, most
+# lines inside entry bodies are like this and are skipped in one step
+PLAIN_LINES = re.compile(
+    rb"(?:[ \t]*(?![ \t]|(?:menuentry|submenu)[\s;])"  # Not an entry header
+    rb"(?:[^\n'\"\\{};#]|'[^'\n]*')*\n)+"  # No braces outside single quotes
+)
+DOUBLE_QUOTE_ESCAPE = re.compile(rb'\\(["\\$\n])')
+QUOTED = re.compile(rb"['\"\\]")
+
+_cache = {}  # path -> GrubCfg
+
+
+class GrubCfgError(Exception):
+    "The grub.cfg could not be lexed or parsed"
+
+
+def unescape(match):
+    "Escaped newlines are removed, other escaped characters are kept"
+    return b"" if match.group(1) == b"\n" else match.group(1)
+
+
+def unquote(raw):
+    "Returns the value of a raw word, removing its quotes and escapes"
+    if QUOTED.search(raw) is None:
+        return raw
+    value = []
+    for plain, single, double, escaped in WORD_PART.findall(raw):
+        if plain or single:
+            value.append(plain or single)
+        elif double:
+            value.append(DOUBLE_QUOTE_ESCAPE.sub(unescape, double))
+        elif escaped != b"\n":
+            value.append(escaped)
+    return b"".join(value)
+
+
+def lex(data):
+    """Yields the words of a grub script and None at every command separator.
+
+    data can be bytes or a mmap. "{" and "}" are yielded as standalone words
+    when unquoted.
+    """
+    pos, end = 0, len(data)
+    match_token, match_plain_lines = TOKEN.match, PLAIN_LINES.match
+    command_start = True
+    while pos < end:
+        if command_start:
+            match = match_plain_lines(data, pos)
+            if match is not None:
+                yield None
+                pos = match.end()
+                continue
+        match = match_token(data, pos)
+        if match is None:
+            raise GrubCfgError(f"Unterminated quote at offset {pos}")
+        kind = match.lastgroup
+        if kind == "word" or kind == "brace":
+            yield Word(unquote(match.group()), pos, match.end())
+            command_start = False
+        elif kind == "separator":
+            yield None
+            command_start = True
+        pos = match.end()
+
+
+def parse(data):
+    "Returns the list of entries (menuentries and submenus) in document order"
+    entries = []
+    blocks = []  # Stack of open braces, True for entries and False for others
+    command = []  # Words of the current command
+    header = None  # Words of an entry header while looking for its "{"
+
+    def is_brace(word, brace):
+        return word.value == brace and word.end - word.start == 1  # Not quoted
+
+    for word in lex(data):
+        if header is not None:
+            if word is None:
+                continue  # The "{" may be on the next line
+            if not is_brace(word, b"{"):
+                header.append(word)
+                continue
+            entries.append(make_entry(header, word, sum(blocks)))
+            blocks.append(True)
+            header = None
+        elif word is None:
+            command = []
+        elif is_brace(word, b"{"):  # e.g. function bodies
+            blocks.append(False)
+            command = []
+        elif is_brace(word, b"}") and not command:
+            if not blocks:
+                raise GrubCfgError(f"Unbalanced closing brace at offset {word.start}")
+            blocks.pop()
+        elif not command and word.value in ENTRY_KEYWORDS:
+            header = [word]
+        else:
+            command.append(word)
+
+    if header is not None:
+        raise GrubCfgError(f"Entry header without body at offset {header[0].start}")
+    return entries
+
+
+def make_entry(header, brace, depth):
+    keyword, arguments = header[0], header[1:]
+    if not arguments:
+        raise GrubCfgError(f"Entry without title at offset {keyword.start}")
+    title = arguments[0]
+    entry_id, classes = None, []
+    for option, value in zip(arguments, arguments[1:]):
+        if option.value == b"--class":
+            classes.append(value.value.decode(errors="replace"))
+        elif option.value in ID_OPTIONS:
+            entry_id = value.value.decode(errors="replace")
+    return Entry(
+        kind=keyword.value.decode(),
+        name=title.value.decode(errors="replace"),
+        start=keyword.start,
+        end=brace.end,
+        name_start=title.start,
+        name_end=title.end,
+        depth=depth,
+        id=entry_id,
+        classes=classes,
+    )
+
+
+class GrubCfg:
+    "A parsed grub.cfg, get instances with load() to share them during a run"
+
+    def __init__(self, path, data, stat=None):
+        self.path = path
+        self.data = data  # bytes or mmap
+        self.stat = stat
+        self.entries = parse(data)
+
+    def is_fresh(self):
+        "Whether the file on disk has not changed since it was parsed"
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return self.stat is not None and (stat.st_mtime_ns, stat.st_size) == (
+            self.stat.st_mtime_ns,
+            self.stat.st_size,
+        )
+
+    def write_patched(self, insertions, dst):
+        """Streams the file to the binary file object dst with insertions spliced in.
+
+        insertions is an iterable of (offset, bytes) sorted by offset. Runs in
+        linear time, copying at most CHUNK_SIZE bytes of the source at once.
+        """
+        data, seek = self.data, 0
+        for offset, content in insertions:
+            for start in range(seek, offset, CHUNK_SIZE):
+                dst.write(data[start:min(start + CHUNK_SIZE, offset)])
+            dst.write(content)
+            seek = offset
+        for start in range(seek, len(data), CHUNK_SIZE):
+            dst.write(data[start:start + CHUNK_SIZE])
+
+    def patch(self, insertions):
+        """Replaces the file on disk with a patched copy, see write_patched.
+
+        The copy is streamed to a temporary file next to the original which
+        then atomically replaces it, keeping its permissions.
+        """
+        with atomic_open(self.path, "wb", buffering=CHUNK_SIZE) as dst:
+            self.write_patched(insertions, dst)
+
+
+def load(path):
+    "Returns the GrubCfg for path, only reading and parsing it when it changed"
+    grub_cfg = _cache.get(path)
+    if grub_cfg is not None and grub_cfg.is_fresh():
+        return grub_cfg
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            data = b""  # Empty files can't be mapped
+        else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    grub_cfg = GrubCfg(path, data, stat)
+    _cache[path] = grub_cfg
+    return grub_cfg
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Trigram index over the Material Design Icons names and aliases.
+
+The index is built once from the MDI meta.json and saved next to it, then
+queries only touch the posting lists of their own trigrams so matching every
+grub entry against thousands of icons takes milliseconds.
+"""
+
+import re
+import json
+from collections import Counter
+
+from cache import hash_file
+
+INDEX_VERSION = 2
+WORD = re.compile(r"[a-z]+")
+STOPWORDS = {"the", "and", "for", "with", "on", "of", "options", "advanced", "gnu", "generic", "mode"}
+NAME_BONUS = 0.05  # Prefer the icon name over an equal alias
+
+
+def trigrams(text):
+    "Returns the set of trigrams of the words of text, padded at word boundaries"
+    padded = f"  {' '.join(WORD.findall(text.lower()))} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def query_words(text):
+    "Returns the words of text worth searching, e.g. without versions or stopwords"
+    words = WORD.findall(text.lower())
+    return [word for word in words if len(word) > 1 and word not in STOPWORDS]
+
+
+def build(meta_path, index_path):
+    """Builds the index of the icons in the MDI meta.json at meta_path.
+
+    Deprecated icons are left out of the search but still known, they exist
+    in the pack. Returns the index, also saved to index_path.
+    """
+    with open(meta_path) as f:
+        meta = json.load(f)
+    names, terms, postings, deprecated = [], [], {}, []
+    for icon in meta:
+        if icon.get("deprecated"):
+            deprecated.append(icon["name"])
+            continue
+        for term in [icon["name"]] + icon.get("aliases", []):
+            for trigram in trigrams(term):
+                postings.setdefault(trigram, []).append(len(terms))
+            terms.append([len(names), term, len(trigrams(term))])
+        names.append(icon["name"])
+    index = {
+        "version": INDEX_VERSION,
+        "meta": hash_file(meta_path),
+        "names": names,
+        "terms": terms,
+        "trigrams": postings,
+        "deprecated": deprecated,
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    return index
+
+
+def load(meta_path, index_path):
+    "Returns the index for meta_path, rebuilding it if missing or outdated"
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["version"] == INDEX_VERSION and index["meta"] == hash_file(meta_path):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return build(meta_path, index_path)
+
+
+def search(index, text, limit=5):
+    """Returns up to limit (icon name, score) pairs ranked for text, best first.
+
+    Each word of text is scored against each name and alias of an icon by the
+    share of the word trigrams found in it, weighted by how much of the term
+    they cover, and an icon scores the mean of its best match per word.
+    """
+    words = query_words(text) or WORD.findall(text.lower())
+    names, terms, postings = index["names"], index["terms"], index["trigrams"]
+    scores = Counter()
+    for word in words:
+        word_trigrams = trigrams(word)
+        shared = Counter()
+        for trigram in word_trigrams:
+            shared.update(postings.get(trigram, ()))
+        best = {}  # icon -> best score of this word
+        for term_id, count in shared.items():
+            icon, term, term_trigram_count = terms[term_id]
+            containment = count / len(word_trigrams)
+            precision = count / term_trigram_count
+            score = containment * (0.5 + 0.5 * precision)
+            if term == names[icon]:
+                score += NAME_BONUS
+            best[icon] = max(best.get(icon, 0), score)
+        for icon, score in best.items():
+            scores[icon] += score / len(words)
+    return [(names[icon], score) for icon, score in scores.most_common(limit)]
+
+
+def find_unknown(index, names):
+    "Returns the names that are not icons of the index, deprecated or not"
+    known = set(index["names"]) | set(index["deprecated"])
+    return [name for name in names if name not in known]
+
+
+def find_deprecated(index, names):
+    "Returns the names that are deprecated icons"
+    deprecated = set(index["deprecated"])
+    return [name for name in names if name in deprecated]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Content manifests of theme directories.
+
+A manifest maps the relative path of every file in a directory to its size
+and sha256. The build writes one next to the theme so that installing only
+touches the files that were added, changed or removed, and so that an
+installed theme can be verified against what was built.
+"""
+
+import os
+import json
+from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import hash_file
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+HASH_WORKERS = 8  # Hashing is mostly I/O bound, hashlib releases the GIL
+
+
+def list_files(directory):
+    "Returns the sorted relative paths of the files in directory, manifest excluded"
+    paths = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), directory)
+            if path != MANIFEST_NAME:
+                paths.append(path)
+    return sorted(paths)
+
+
+def hash_files(directory, paths, workers=HASH_WORKERS):
+    "Returns {path: {size, sha256}} for the relative paths, hashed concurrently"
+
+    def describe(path):
+        full_path = os.path.join(directory, path)
+        return {"size": os.path.getsize(full_path), "sha256": hash_file(full_path)}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(describe, paths)))
+
+
+def build(directory, workers=HASH_WORKERS):
+    "Returns the manifest of the current content of directory"
+    files = hash_files(directory, list_files(directory), workers)
+    return {"version": MANIFEST_VERSION, "files": files}
+
+
+def write(directory, manifest):
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def read(directory):
+    "Returns the manifest stored in directory or None if missing or unreadable"
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def diff(expected, actual):
+    "Returns the (added, changed, removed) paths going from actual to expected files"
+    added = [path for path in expected if path not in actual]
+    changed = [
+        path for path in expected if path in actual and actual[path] != expected[path]
+    ]
+    removed = [path for path in actual if path not in expected]
+    return added, changed, removed
+
+
+def stat_key(path):
+    "Returns what tells cheaply if a file changed since it was last seen, rsync style"
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def sync(src, dst, manifest):
+    """Makes dst match the src directory described by manifest.
+
+    The manifest stored in dst by the previous sync tells what dst contains,
+    along with the size and mtime of each file when it was copied. Files
+    whose description and stat still match are left untouched, without
+    rehashing /boot. Changed files are replaced atomically and the dst
+    manifest is written last, so an interrupted sync is completed by the
+    next one. Returns (added, changed, removed) paths.
+    """
+    previous = read(dst) or {"files": {}, "installed": {}}
+    current = {}  # path -> description or None for untracked or modified files
+    for path in list_files(dst) if os.path.isdir(dst) else []:
+        seen = previous.get("installed", {}).get(path)
+        if seen is not None and seen == stat_key(os.path.join(dst, path)):
+            current[path] = previous["files"].get(path)
+        else:
+            current[path] = None
+    added, changed, removed = diff(manifest["files"], current)
+
+    for path in added + changed:
+        src_path, dst_path = os.path.join(src, path), os.path.join(dst, path)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        temp_path = f"{dst_path}.{os.getpid()}.tmp"
+        copyfile(src_path, temp_path)
+        os.replace(temp_path, dst_path)
+    for path in removed:
+        os.remove(os.path.join(dst, path))
+        remove_empty_dirs(dst, os.path.dirname(path))
+
+    os.makedirs(dst, exist_ok=True)
+    installed = {path: stat_key(os.path.join(dst, path)) for path in manifest["files"]}
+    write(dst, dict(manifest, installed=installed))
+    return added, changed, removed
+
+
+def install(src_path, dst, path):
+    """Atomically replaces the file path of the synced dst with src_path.
+
+    The dst manifest is updated to describe the new file, so the next sync
+    or verify sees it as installed rather than tampered with.
+    """
+    dst_path = os.path.join(dst, path)
+    temp_path = f"{dst_path}.{os.getpid()}.tmp"
+    copyfile(src_path, temp_path)
+    os.replace(temp_path, dst_path)
+    installed = read(dst)
+    if installed is None:
+        return
+    installed["files"][path] = {"size": os.path.getsize(dst_path), "sha256": hash_file(dst_path)}
+    installed.setdefault("installed", {})[path] = stat_key(dst_path)
+    write(dst, installed)
+
+
+def remove_empty_dirs(root, path):
+    "Removes the relative directory path and its parents inside root while empty"
+    while path:
+        try:
+            os.rmdir(os.path.join(root, path))
+        except OSError:
+            return
+        path = os.path.dirname(path)
+
+
+def verify(directory, manifest, workers=HASH_WORKERS):
+    "Hashes directory concurrently, returns its (missing, changed, extra) paths against manifest"
+    actual = hash_files(directory, list_files(directory), workers)
+    return diff(manifest["files"], actual)
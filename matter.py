@@ -3,24 +3,27 @@
 # Standard library modules
 import sys
 import os
+import io
 import re
 import json
+import time
+import string
 import argparse
-import urllib.request as request
-from urllib.error import HTTPError, URLError
 from argparse import ArgumentParser, RawTextHelpFormatter
+from functools import lru_cache
 from os.path import dirname, basename, isdir, exists
-from shutil import which, rmtree, copytree, copyfile
-try:
-    from PIL import Image
-except:
-    has_PIL = False
-else:
-    has_PIL = True
+from shutil import which, rmtree, copyfile
 
 # Local Matter modules
 from utils import *
-from svg2png import inkscape_convert_svg2png, magick_convert_svg2png
+from profiler import Profiler
+import grubcfg
+
+# NOTE: `matter.py --configicons` runs inside every grub-mkconfig, so only what
+# that path needs is imported here. Heavier modules (PIL, urllib, svg2png,
+# download, cache, manifest, background, pngopt, mdipack, iconsearch,
+# artifact, tint, preview, concurrent.futures) are imported by the functions using them.
+# Run ./benchmark.py hook to check the startup cost after touching this.
 
 # Configuration constants
 
@@ -39,7 +42,7 @@ if exists("/boot/grub"):
 elif exists("/boot/grub2"):
     BOOT_GRUB_PATH = "/boot/grub2"
 else:
-    error("Could not find your grub's boot path (tried /boot/grub and /boot/grub2)")
+    BOOT_GRUB_PATH = None  # Reported by check_boot_grub_path()
 
 INSTALLER_ABSPATH = os.path.abspath(__file__)
 INSTALLER_NAME = basename(INSTALLER_ABSPATH)
@@ -53,13 +56,15 @@ THEME_DEFAULT_BACKGROUND = "bluegrey-900"
 THEME_DEFAULT_FONT_NAME = "Josefin Sans Regular"
 THEME_DEFAULT_FONT = THEME_DEFAULT_FONT_NAME.replace(" ", "_")
 THEME_DEFAULT_FONT_SIZE = 32
+FONT_SUBSET_MARGINS = {
+    "none": "",
+    "ascii": string.printable[:-5],  # Without \t\n\r\x0b\x0c
+    "latin1": string.printable[:-5] + "".join(map(chr, range(0xA0, 0x100))),
+}
 
 GRUB_DEFAULTS_PATH = "/etc/default/grub"
 GRUB_SCRIPTS_PATH = "/etc/grub.d"
 GRUB_CFG_PATH = f"{BOOT_GRUB_PATH}/grub.cfg"
-GRUB_MKCONFIG_PATH = which("grub-mkconfig") or which("grub2-mkconfig")
-if GRUB_MKCONFIG_PATH is None:
-    error("Could not find grub-mkconfig command file (grub2-mkconfig neither)")
 
 
 THEME_TEMPLATE_PATH = f"{INSTALLER_DIR}/theme.txt.template"
@@ -70,11 +75,56 @@ THEME_OVERRIDES_TITLE = f"{THEME_NAME} Theme Overrides"
 BEGIN_THEME_OVERRIDES = f"### BEGIN {THEME_OVERRIDES_TITLE}"
 END_THEME_OVERRIDES = f"### END {THEME_OVERRIDES_TITLE}"
 
+# Blocks around the grub-mkconfig scripts loop for --hookmode filter
+FILTER_TITLE = f"{THEME_NAME} Icon Filter"
+BEGIN_FILTER = f"### BEGIN {FILTER_TITLE}"
+END_FILTER = f"### END {FILTER_TITLE}"
+FILTER_END_TITLE = f"{THEME_NAME} Icon Filter End"
+BEGIN_FILTER_END = f"### BEGIN {FILTER_END_TITLE}"
+END_FILTER_END = f"### END {FILTER_END_TITLE}"
+# grub-mkconfig writes grub.cfg running each /etc/grub.d script in this loop
+GRUB_MKCONFIG_LOOP = re.compile(
+    r'^for i in "\$\{grub_mkconfig_dir\}"/\* ?; ?do$.*?^done\n', re.MULTILINE | re.DOTALL
+)
+# The loop output goes through a fifo to the filter, or to cat if it fails to start
+FILTER_START_SCRIPT = """set +e
+matter_fifo="$(mktemp -u "${{TMPDIR:-/tmp}}/matter-filter.XXXXXX")"
+if [ -n "$matter_fifo" ] && mkfifo -m 600 "$matter_fifo"; then
+  ({filter_call} || cat) < "$matter_fifo" &
+  matter_filter_pid=$!
+  exec 9>&1 > "$matter_fifo"
+  rm -f "$matter_fifo"
+fi
+set -e"""
+FILTER_END_SCRIPT = """if [ -n "$matter_filter_pid" ]; then
+  exec 1>&9 9>&-
+  wait "$matter_filter_pid" || true
+  matter_filter_pid=
+fi"""
+
 ICON_SVG_PATHF = f"{INSTALLER_DIR}/icons/{{}}.svg"
 ICON_PNG_PATHF = f"{INSTALLATION_SOURCE_DIR}/icons/{{}}.png"
 
+CACHE_DIR = f"{INSTALLER_DIR}/cache"
+ICON_CACHE_DIR = f"{CACHE_DIR}/icons"
+ICON_CACHE_MAX_BYTES = 32 * 1024 * 1024
+FONT_CACHE_DIR = f"{CACHE_DIR}/fonts"
+FONT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PNG_CACHE_DIR = f"{CACHE_DIR}/pngs"
+PNG_CACHE_MAX_BYTES = 32 * 1024 * 1024
+MASK_CACHE_DIR = f"{CACHE_DIR}/masks"  # Icon alpha masks, see tint.py
+MASK_CACHE_MAX_BYTES = 16 * 1024 * 1024
+BACKGROUND_CACHE_DIR = f"{CACHE_DIR}/backgrounds"  # Fitted and encoded backgrounds
+BACKGROUND_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Bundled single color pixmaps, tinted with --tintassets to the given color
+TINTABLE_ASSETS = {"select": "highlight", "terminal_box": "background"}
+TINTED_ASSET_PREFIX = "tinted_"
+
 BACKGROUND_TMP_PATHF = f"{INSTALLER_DIR}/bg/{{}}.tmp"
 BACKGROUND_PNG_PATHF = f"{INSTALLER_DIR}/bg/{{}}.png"
+BACKGROUND_META_PATHF = f"{INSTALLER_DIR}/bg/{{}}.json"  # Cache validators
+BACKGROUND_MAX_BYTES = 64 * 1024 * 1024
 
 CONFIG_FILE_PATH = f"{INSTALLER_DIR}/config.json"
 
@@ -107,10 +157,50 @@ PALETTE = {
 AVAILABLE_COLORS = list(PALETTE.keys())
 
 MDI_CDN = "https://raw.githubusercontent.com/Templarian/MaterialDesign-SVG/master/svg/"
+MDI_PACK_PATH = f"{INSTALLER_DIR}/icons/mdi.pack"  # See --importmdi
+MDI_INDEX_PATH = f"{INSTALLER_DIR}/icons/mdi.index.json"
+MDI_META_PATH = f"{INSTALLER_DIR}/icons/mdi.meta.json"
+MDI_META_VALIDATORS_PATH = f"{INSTALLER_DIR}/icons/mdi.meta.validators.json"
+MDI_SEARCH_INDEX_PATH = f"{INSTALLER_DIR}/icons/mdi.trigrams.json"
+ICON_SUGGESTIONS = 5  # Candidates shown per grub entry
+ICON_RULE_GROUPF = "_matter_rule_{}"  # Group of each rule in the combined regex
+ICON_RULE_REGEX_PREFIX = "re:"  # Rule patterns are globs unless prefixed by this
+# Escapes and conditionals, to find group references like \1 or (?(1)...)
+ICON_RULE_GROUP_REFERENCE = re.compile(r"\\.|\(\?\(", re.DOTALL)
+DOWNLOAD_WORKERS = 8  # Concurrent connections to MDI_CDN
+DOWNLOAD_TIMEOUT = 10  # Seconds per request
+DOWNLOAD_RETRIES = 2
+
+# Steps of an install that need root, in the order apply_plan() runs them
+PLAN_VERSION = 1
+PLAN_STEPS = ["sync", "defaults", "icons", "configicons", "hook", "hookcheck", "grubcfg"]
+
+# User arguments recorded in theme artifacts, see --artifact
+ARTIFACT_OPTIONS = [
+    "highlight",
+    "foreground",
+    "background",
+    "image",
+    "imagefit",
+    "downloadbackground",
+    "iconcolor",
+    "tintassets",
+    "icons",
+    "iconrule",
+    "converter",
+    "font",
+    "fontfile",
+    "fontname",
+    "fontsize",
+    "fontsubset",
+]
 
 # Global user arguments set in main()
 user_args: argparse.Namespace
 
+# Enabled in main() with --profile
+profiler = Profiler()
+
 # Utils
 
 def check_python_version():
@@ -120,16 +210,44 @@ def check_python_version():
         error(f"Python {required[0]}.{required[1]} or later required")
 
 
+def check_boot_grub_path():
+    if BOOT_GRUB_PATH is None:
+        error("Could not find your grub's boot path (tried /boot/grub and /boot/grub2)")
+
+
+@lru_cache(maxsize=None)
+def get_grub_mkconfig_path():
+    grub_mkconfig_path = which("grub-mkconfig") or which("grub2-mkconfig")
+    if grub_mkconfig_path is None:
+        error("Could not find grub-mkconfig command file (grub2-mkconfig neither)")
+    return grub_mkconfig_path
+
+
+def import_PIL_Image():
+    "Returns PIL's Image module or None if PIL is not installed"
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def relaunch_as_root(*extra_args):
+    "Runs this script again with sudo, the same arguments and extra_args, returns its exit code"
+    import shlex
+
+    info("Request root access")
+    exit_code = sh("sudo -v")
+    if exit_code != 0:
+        error("Could not verify root access, you could try with sudo")
+    args = " ".join(shlex.quote(arg) for arg in sys.argv[1:] + list(extra_args))
+    return sh(f"sudo {INSTALLER_DIR}/{INSTALLER_NAME} {args}")
+
+
 def check_root_or_prompt():
     if os.geteuid() != 0:
-        info("Request root access")
-        exit_code = sh("sudo -v")
-        if exit_code != 0:
-            error("Could not verify root access, you could try with sudo")
         # Relaunch the program with sudo
-        args = " ".join(sys.argv[1:])
-        child_exit_code = sh(f"sudo {INSTALLER_DIR}/{INSTALLER_NAME} {args}")
-        exit(child_exit_code)  # Propagate exit code
+        exit(relaunch_as_root())  # Propagate exit code
 
 
 def delete_dir(directory):
@@ -137,73 +255,166 @@ def delete_dir(directory):
         rmtree(directory)
 
 
-def read_cleaned_grub_defaults():
-    # Read previous defaults
-    with open(GRUB_DEFAULTS_PATH, "r", newline="") as f:
-        grub_defaults = f.read()
+def update_theme_overrides(path, block=None, prompt_root=False):
+    """Sets the theme overrides block of the file at path, or removes it if None.
 
-    # Remove previous theme defaults
-    cleaned_grub_defaults = re.sub(
-        f"\n*{BEGIN_THEME_OVERRIDES}.*{END_THEME_OVERRIDES}\n*",
-        "",
-        grub_defaults,
-        flags=re.DOTALL,
+    The file is only rewritten (atomically) when its content changes,
+    returns whether it did.
+    """
+    with open(path, "r", newline="") as f:
+        content = f.read()
+    new_content = set_marker_block(
+        content, BEGIN_THEME_OVERRIDES, END_THEME_OVERRIDES, block
     )
-    return cleaned_grub_defaults
-
+    if new_content == content:
+        if block is not None:
+            info(f"{path} already up to date")
+        return False
+    if prompt_root:
+        check_root_or_prompt()
+    return write_if_changed(path, new_content)
+
+
+def update_icon_filter(path, filter_call=None, prompt_root=False):
+    """Sets the icon filter blocks around the scripts loop of grub-mkconfig at path.
+
+    filter_call is the command reading grub.cfg from stdin and writing it
+    back with icons, the blocks are removed if None. Returns whether the file
+    changed, or None if the loop was not found.
+    """
+    with open(path, "r", newline="") as f:
+        content = f.read()
+    new_content = content
+    for begin, end in ((BEGIN_FILTER, END_FILTER), (BEGIN_FILTER_END, END_FILTER_END)):
+        # Exact inverse of the insertion below, without touching blank lines
+        pattern = f"^{re.escape(begin)}$.*?^{re.escape(end)}\n"
+        new_content = re.sub(pattern, "", new_content, flags=re.MULTILINE | re.DOTALL)
+    if filter_call is not None:
+        loop = GRUB_MKCONFIG_LOOP.search(new_content)
+        if loop is None:
+            return None
+        start_script = FILTER_START_SCRIPT.format(filter_call=filter_call)
+        new_content = (
+            f"{new_content[:loop.start()]}{BEGIN_FILTER}\n{start_script}\n{END_FILTER}\n"
+            f"{loop.group()}"
+            f"{BEGIN_FILTER_END}\n{FILTER_END_SCRIPT}\n{END_FILTER_END}\n"
+            f"{new_content[loop.end():]}"
+        )
+    if new_content == content:
+        return False
+    if prompt_root:
+        check_root_or_prompt()
+    return write_if_changed(path, new_content)
 
-def read_cleaned_grub_mkconfig():
-    # Read previous defaults
-    with open(GRUB_MKCONFIG_PATH, "r", newline="") as f:
-        grub_mkconfig = f.read()
 
-    # Remove previous theme defaults
-    cleaned_grub_mkconfig = re.sub(
-        f"\n*{BEGIN_THEME_OVERRIDES}.*{END_THEME_OVERRIDES}\n*",
-        "",
-        grub_mkconfig,
-        flags=re.DOTALL,
+def download_icon(icon_name):
+    return download_icons([icon_name])[0]
+
+
+def get_mdi_cdn():
+    "Returns the --mdicdn base url, local mirror directories become file:// urls"
+    from pathlib import Path
+
+    cdn = user_args.mdicdn
+    if "://" not in cdn:
+        cdn = Path(cdn).resolve().as_uri()
+    return cdn if cdn.endswith("/") else f"{cdn}/"
+
+
+@lru_cache(maxsize=None)
+def get_mdi_pack():
+    "Returns the imported MDI archive, empty if none was imported"
+    from mdipack import IconPack
+
+    return IconPack(MDI_PACK_PATH, MDI_INDEX_PATH)
+
+
+def download_icons(icon_names, cdn=None):
+    """Gets the icons svgs, reports all failed icons at once.
+
+    Icons are taken from the imported MDI archive when there, the rest are
+    downloaded concurrently from cdn (default --mdicdn).
+    """
+    from download import fetch_all
+
+    svg_paths = []
+    mdi_pack = get_mdi_pack()
+    for name in [name for name in icon_names if mdi_pack.has(name)]:
+        svg_path = ICON_SVG_PATHF.format(name)
+        with profiler.timed_item("download", f"{name} (archive)"):
+            mdi_pack.extract(name, svg_path)
+        svg_paths.append(svg_path)
+    icon_names = [name for name in icon_names if not mdi_pack.has(name)]
+    if not icon_names:
+        return svg_paths
+
+    cdn = cdn or get_mdi_cdn()
+    info(f"Download {', '.join(f'{name}.svg' for name in icon_names)}")
+    urls = {f"{cdn}{name}.svg": name for name in icon_names}
+    timings = {}
+    results, failures = fetch_all(
+        urls,
+        workers=DOWNLOAD_WORKERS,
+        timeout=DOWNLOAD_TIMEOUT,
+        retries=DOWNLOAD_RETRIES,
+        timings=timings,
     )
-    return cleaned_grub_mkconfig
+    for url, seconds in timings.items():
+        profiler.item("download", urls[url], seconds)
 
+    for url, response in results.items():
+        svg_path = ICON_SVG_PATHF.format(urls[url])
+        with open(svg_path, "wb") as f:
+            f.write(response)
+        svg_paths.append(svg_path)
+
+    if failures:
+        error(
+            f"Couldn't get {len(failures)} of {len(urls)} icons",
+            *(f"{urls[url]} ({reason}) at URL {url}" for url, reason in failures.items()),
+        )
+    return svg_paths
 
-def download_icon(icon_name):
-    info(f"Download {icon_name}.svg")
-    url = f"{MDI_CDN}{icon_name}.svg"
-    try:
-        with request.urlopen(url) as f:
-            response = f.read()
-    except HTTPError as err:  # A subclass of URLError
-        error(f"Couldn't get icon {icon_name} ({err.reason})", f"At URL {err.geturl()}")
-    except URLError as err:
-        error(f"Couldn't get icon {icon_name} ({err.reason})")
-    svg_path = ICON_SVG_PATHF.format(icon_name)
-    with open(svg_path, "wb") as f:
-        f.write(response)
-    return svg_path
 
+def download_background(url):
+    "Downloads the image at url as a png, reusing the last download if unchanged"
+    from cache import hash_key
+    from download import download, read_json, FetchError
 
-def download_background(background_path):
-    if not has_PIL:
-        error("PIL not detected, cannot download background")
     info(f"Downloading background image")
-    
-    url = f"{background_path}"
-    try:
-        with request.urlopen(url) as f:
-            response = f.read()
-    except HTTPError as err:  # A subclass of URLError
-        error(f"Couldn't get background image ({err.reason})", f"At URL {err.geturl()}")
-    except URLError as err:
-        error(f"Couldn't get background image ({err.reason})")
-    bg_path = BACKGROUND_TMP_PATHF.format('background_image')
-    conv_path = BACKGROUND_PNG_PATHF.format('background_image')
-    with open(bg_path, "wb") as f:
-        f.write(response)
-    im = Image.open(bg_path)
-    im.save(conv_path)
-    return conv_path
+    key = hash_key(url)[:16]
+    raw_path = BACKGROUND_TMP_PATHF.format(key)
+    png_path = BACKGROUND_PNG_PATHF.format(key)
+    meta_path = BACKGROUND_META_PATHF.format(key)
 
+    meta = read_json(meta_path) if exists(png_path) else None
+    validators = meta["validators"] if meta and meta.get("url") == url else None
+    try:
+        modified, validators = download(
+            url,
+            raw_path,
+            validators=validators,
+            max_bytes=BACKGROUND_MAX_BYTES,
+            timeout=DOWNLOAD_TIMEOUT,
+            retries=DOWNLOAD_RETRIES,
+        )
+    except FetchError as err:
+        error(f"Couldn't get background image ({err})", f"At URL {url}")
+    if not modified:
+        info("Background image not modified since last download, reusing it")
+        return png_path
+
+    Image = import_PIL_Image()
+    if Image is None:
+        error("PIL not detected, cannot convert downloaded background")
+    if exists(meta_path):
+        os.remove(meta_path)  # Never pair the old validators with a new image
+    with Image.open(raw_path) as im:
+        im.save(png_path, "PNG")
+    os.remove(raw_path)
+    with open(meta_path, "w") as f:
+        json.dump({"url": url, "validators": validators}, f)
+    return png_path
 
 
 def get_converted_icons():
@@ -215,41 +426,474 @@ def get_converted_icons():
 
 
 def is_icon_downloaded(icon_name):
+    "Whether the icon svg is available, extracting it from the MDI archive if needed"
     svg_path = ICON_SVG_PATHF.format(icon_name)
-    return exists(svg_path)
+    return exists(svg_path) or get_mdi_pack().extract(icon_name, svg_path)
 
 
-def convert_icon_svg2png(icon_name, whisper=False):
-    if not has_command("inkscape"):
-        if not has_command("convert"):
+def download_icon_meta(required):
+    "Downloads the MDI meta.json next to --mdicdn, only if it changed since last time"
+    from urllib.parse import urljoin
+    from download import download, read_json, FetchError
+
+    url = urljoin(get_mdi_cdn(), "../meta.json")
+    meta = read_json(MDI_META_VALIDATORS_PATH) if exists(MDI_META_PATH) else None
+    validators = meta["validators"] if meta and meta.get("url") == url else None
+    info(f"Download icon names from {url}")
+    try:
+        modified, validators = download(
+            url,
+            MDI_META_PATH,
+            validators=validators,
+            timeout=DOWNLOAD_TIMEOUT,
+            retries=DOWNLOAD_RETRIES,
+        )
+    except FetchError as err:
+        if required:
+            error(f"Couldn't get the icon names ({err}) at URL {url}")
+        return False
+    if modified:
+        with open(MDI_META_VALIDATORS_PATH, "w") as f:
+            json.dump({"url": url, "validators": validators}, f)
+    return True
+
+
+def get_icon_index(required=True, refresh=False):
+    """Returns the search index of the MDI icon names and aliases.
+
+    It is built from the meta.json imported with --importmdi or downloaded
+    from next to --mdicdn, and revalidated against the server on refresh.
+    If neither is available it errors, or returns None when not required.
+    """
+    import iconsearch
+
+    if refresh or not exists(MDI_META_PATH):
+        if not download_icon_meta(required):
+            return None
+    try:
+        return iconsearch.load(MDI_META_PATH, MDI_SEARCH_INDEX_PATH)
+    except (ValueError, KeyError, TypeError) as err:
+        if required:
+            error(f"Invalid icon names file {MDI_META_PATH} ({err})")
+        return None
+
+
+def check_icon_names(icons):
+    "Fails early with suggestions if some of the given icons don't exist"
+    import iconsearch
+
+    unknown = [
+        icon for icon in dict.fromkeys(icons)
+        if icon != "_"
+        and not exists(ICON_SVG_PATHF.format(icon))
+        and not get_mdi_pack().has(icon)
+    ]
+    if not unknown:
+        return
+    index = get_icon_index(required=False)
+    if index is None:
+        return  # Can't tell offline, downloading them will
+    invalid = iconsearch.find_unknown(index, unknown)
+    if invalid:  # Maybe added upstream since the names were downloaded
+        index = get_icon_index(required=False, refresh=True)
+        if index is None:
+            return
+        invalid = iconsearch.find_unknown(index, unknown)
+    deprecated = iconsearch.find_deprecated(index, unknown)
+    if deprecated:
+        warning(f"Deprecated icons, they may be gone in future MDI releases: {deprecated}")
+    if invalid:
+        error(
+            f"Stop. Unknown icons: {invalid}",
+            *(
+                f"{icon}: did you mean "
+                f"{', '.join(name for name, _ in iconsearch.search(index, icon.replace('-', ' ')))}?"
+                for icon in invalid
+            ),
+        )
+
+
+def do_search_icons(query):
+    import iconsearch
+
+    index = get_icon_index()
+    for name, score in iconsearch.search(index, query, limit=ICON_SUGGESTIONS * 2):
+        print(f"{name} ({score:.2f})")
+
+
+def do_suggest_icons():
+    import iconsearch
+
+    index = get_icon_index()
+    best = []
+    for i, entry in enumerate(get_entry_names()):
+        candidates = [name for name, _ in iconsearch.search(index, entry.name, ICON_SUGGESTIONS)]
+        best.append(candidates[0] if candidates else "_")
+        print(f"{i + 1}. {entry.name}: {', '.join(candidates) or '(no match)'}")
+    info("Suggested install command:")
+    info(f"./{INSTALLER_NAME} -i {' '.join(best)}")
+
+
+def do_import_mdi_archive(archive_path):
+    from mdipack import import_archive, PackError
+
+    info(f"Import icons from {archive_path}")
+    try:
+        count = import_archive(archive_path, MDI_PACK_PATH, MDI_INDEX_PATH, MDI_META_PATH)
+    except (OSError, PackError) as err:
+        error(f"Could not import {archive_path} ({err})")
+    info(f"{count} icons imported, they will be used instead of downloading them")
+
+
+def get_icon_converter(batch=False):
+    "Returns the (command, converter) pair for the svg to png tool to use"
+    from svg2png import (
+        has_PIL as has_PIL_rasterizer,
+        inkscape_convert_svg2png,
+        inkscape_batch_convert_svg2png,
+        magick_convert_svg2png,
+        magick_batch_convert_svg2png,
+        builtin_convert_svg2png,
+        builtin_batch_convert_svg2png,
+    )
+
+    command = user_args.converter
+    if command == "auto":
+        if has_command("inkscape"):
+            command = "inkscape"
+        elif has_PIL_rasterizer:
+            command = "builtin"
+        elif has_command("convert"):
+            command = "convert"
+        else:
             error(
-                "Stop. Both `inkscape` and `convert` command from imagemagick were not found",
-                "Consider installing `inkscape` for the best results",
+                "Stop. Neither `inkscape`, PIL nor `convert` command from imagemagick were found",
+                "Consider installing `inkscape` or PIL for the best results",
             )
-        else:
-            command = "convert"
-    else:
-        command = "inkscape"
+    elif command == "builtin" and not has_PIL_rasterizer:
+        error("PIL not detected, cannot use the builtin icon rasterizer")
+    elif command != "builtin" and not has_command(command):
+        error(f"Stop. The `{command}` command was not found")
 
-    color = (
+    if command == "convert":
+        warning("Resulting icons could look a bit off, consider installing inkscape")
+        converter = magick_batch_convert_svg2png if batch else magick_convert_svg2png
+    elif command == "inkscape":
+        converter = inkscape_batch_convert_svg2png if batch else inkscape_convert_svg2png
+    elif command == "builtin":
+        converter = builtin_batch_convert_svg2png if batch else builtin_convert_svg2png
+    return command, converter
+
+
+def get_icon_color():
+    return (
         parse_color(user_args.iconcolor)
         if user_args.iconcolor
         else parse_color(user_args.foreground)
     )
+
+
+def convert_icon_svg2png(icon_name, whisper=False):
+    command, converter = get_icon_converter()
+    color = get_icon_color()
     src_path = ICON_SVG_PATHF.format(icon_name)
     dst_path = ICON_PNG_PATHF.format(icon_name)
 
-    if command == "convert":
-        warning("Resulting icons could look a bit off, consider installing inkscape")
-        converter = magick_convert_svg2png
-    elif command == "inkscape":
-        converter = inkscape_convert_svg2png
-
     exit_code = converter(color, src_path, dst_path, whisper=whisper)
     if exit_code != 0:
         error(f"Stop. The `{command}` command returned an error")
 
 
+def get_converter_id(command):
+    "Identifies the converter and its version, as different ones render differently"
+    from svg2png import BUILTIN_VERSION, inkscape_version, magick_version
+
+    if command == "inkscape":
+        return "inkscape {}.{}".format(*inkscape_version())
+    elif command == "builtin":
+        return f"builtin {BUILTIN_VERSION}"
+    return magick_version()
+
+
+def get_icon_cache_key(icon_name, color, converter_id):
+    from svg2png import ICON_SIZE
+    from cache import hash_key
+
+    with open(ICON_SVG_PATHF.format(icon_name), "rb") as f:
+        svg = f.read()
+    return hash_key(svg, color, str(ICON_SIZE), converter_id)
+
+
+def convert_icons_svg2png(icon_names, jobs=None):
+    """Converts the icons to pngs in the icon color.
+
+    With PIL, icons are rasterized once into color independent masks which
+    are then tinted, so changing colors does not convert them again.
+    """
+    icon_names = list(dict.fromkeys(icon_names))  # Deduplicate keeping order
+    if not icon_names:
+        return
+    color = get_icon_color()
+    if import_PIL_Image() is None:
+        rasterize_icons(icon_names, color, ICON_CACHE_DIR, ICON_CACHE_MAX_BYTES, ICON_PNG_PATHF, jobs)
+        return
+
+    import tempfile
+    import tint
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="masks-", dir=CACHE_DIR) as tempdir:
+        mask_pathf = f"{tempdir}/{{}}.png"
+        rasterize_icons(
+            icon_names,
+            tint.MASK_COLOR,
+            MASK_CACHE_DIR,
+            MASK_CACHE_MAX_BYTES,
+            mask_pathf,
+            jobs,
+            postprocess=tint.save_mask,
+        )
+        masks = [tint.load_mask(mask_pathf.format(icon)) for icon in icon_names]
+
+    with profiler.phase("tint"):
+        for icon, im in zip(icon_names, tint.tint(masks, color)):
+            dst_path = ICON_PNG_PATHF.format(icon)
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)  # It may be a link to a cached icon
+            im.save(dst_path, "PNG")
+    info(f"Tinted {len(icon_names)} icons {color}")
+
+
+def rasterize_icons(icon_names, color, cache_dir, cache_max_bytes, pathf, jobs=None, postprocess=None):
+    """Rasterizes the icons to pathf paths with up to `jobs` batch converters (default: CPU count).
+
+    Each batch drives a single inkscape (or convert) process for its share of
+    icons, so the converter startup is paid once per batch and not per icon.
+    The builtin converter runs each batch in a worker process instead.
+    Icons already rasterized with the same svg, color, size and converter are
+    taken from the cache instead, postprocess(path) runs on the others before
+    caching them.
+    """
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from cache import FileCache
+
+    command, converter = get_icon_converter(batch=True)
+
+    cache = FileCache(cache_dir, cache_max_bytes, suffix=".png")
+    converter_id = get_converter_id(command)
+    keys = {icon: get_icon_cache_key(icon, color, converter_id) for icon in icon_names}
+    icon_names = [
+        icon for icon in icon_names
+        if not cache.get(keys[icon], pathf.format(icon))
+    ]
+    if not icon_names:
+        info("All icons found in cache")
+        return
+
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(icon_names)))
+    paths = [(ICON_SVG_PATHF.format(i), pathf.format(i)) for i in icon_names]
+    batches = [paths[i::jobs] for i in range(jobs)]
+
+    if command == "builtin":  # Pure Python holding the GIL, it needs processes
+        Executor = ProcessPoolExecutor
+    else:  # Threads only wait on the converter processes
+        Executor = ThreadPoolExecutor
+    start_ns = int(time.time() * 1e9)
+    with Executor(max_workers=jobs) as executor:
+        # Only show the output of the first batch
+        futures = [executor.submit(converter, color, batch, i > 0) for i, batch in enumerate(batches)]
+        results = [future.result() for future in futures]
+    if profiler.enabled:
+        for batch, result in zip(batches, results):
+            profile_batch(batch, result, start_ns)
+    failed = [basename(dst)[:-4] for result in results for _, dst in result]
+
+    if failed:
+        error(f"Stop. The `{command}` command returned an error for icons: {failed}")
+
+    for icon in icon_names:
+        if postprocess is not None:
+            postprocess(pathf.format(icon))
+        cache.put(keys[icon], pathf.format(icon))
+
+
+def prepare_tinted_assets(colors):
+    """Tints the bundled pixmaps to their colors with --tintassets.
+
+    colors maps the TINTABLE_ASSETS colors to their values. The tinted copies
+    are written next to the pristine ones, returns the pixmap style of each
+    asset to use in theme.txt.
+    """
+    for filename in os.listdir(INSTALLATION_SOURCE_DIR):
+        if filename.startswith(TINTED_ASSET_PREFIX):  # Remove tints of previous builds
+            os.remove(f"{INSTALLATION_SOURCE_DIR}/{filename}")
+    styles = {asset: f"{asset}_*.png" for asset in TINTABLE_ASSETS}
+    if not user_args.tintassets:
+        return styles
+    if import_PIL_Image() is None:
+        warning("PIL not detected, theme assets will keep their colors")
+        return styles
+    import tint
+
+    for asset, color_name in TINTABLE_ASSETS.items():
+        filenames = sorted(
+            filename for filename in os.listdir(INSTALLATION_SOURCE_DIR)
+            if filename.startswith(f"{asset}_") and filename.endswith(".png")
+        )
+        masks = [tint.load_mask(f"{INSTALLATION_SOURCE_DIR}/{filename}") for filename in filenames]
+        for filename, im in zip(filenames, tint.tint(masks, colors[color_name])):
+            im.save(f"{INSTALLATION_SOURCE_DIR}/{TINTED_ASSET_PREFIX}{filename}", "PNG")
+        styles[asset] = f"{TINTED_ASSET_PREFIX}{asset}_*.png"
+    info(f"Tinted theme assets {', '.join(styles.values())}")
+    return styles
+
+
+def optimize_pngs():
+    "Losslessly shrinks the theme pngs, which grub reads from /boot on every boot"
+    if import_PIL_Image() is None:
+        info("PIL not detected, skipping png optimization")
+        return
+    from pngopt import optimize_files
+
+    paths = [
+        f"{root}/{filename}"
+        for root, _, filenames in os.walk(INSTALLATION_SOURCE_DIR)
+        for filename in filenames
+        if filename.endswith(".png")
+    ]
+    old_size, new_size = optimize_files(
+        paths, PNG_CACHE_DIR, PNG_CACHE_MAX_BYTES, user_args.jobs
+    )
+    info(
+        f"Optimized {len(paths)} pngs from {old_size // 1024}KiB "
+        f"to {new_size // 1024}KiB"
+    )
+
+
+def profile_batch(batch, failed, start_ns):
+    """Records the time of each icon converted in a batch as a profiler item.
+
+    Batch converters write their outputs one after the other, so the time
+    between consecutive output mtimes is what each icon took.
+    """
+    failed = set(failed)
+    finished = sorted(
+        (os.stat(dst).st_mtime_ns, dst)
+        for src, dst in batch
+        if (src, dst) not in failed and exists(dst)
+    )
+    previous_ns = start_ns
+    for mtime_ns, dst in finished:
+        profiler.item("convert", basename(dst)[:-4], max(0, mtime_ns - previous_ns) / 1e9)
+        previous_ns = max(previous_ns, mtime_ns)
+
+
+def get_font_pf2_path(fontsizes, fontsize):
+    "The first size is the theme font.pf2, extra sizes get their own file"
+    if fontsize == fontsizes[0]:
+        return f"{INSTALLATION_SOURCE_DIR}/font.pf2"
+    return f"{INSTALLATION_SOURCE_DIR}/font_{fontsize}.pf2"
+
+
+@lru_cache(maxsize=None)
+def get_mkfont_id(grub_mkfont):
+    "Identifies the grub-mkfont binary by its hash, so upgrading grub rebuilds the fonts"
+    from cache import hash_file
+
+    return f"{basename(grub_mkfont)} {hash_file(os.path.realpath(grub_mkfont))}"
+
+
+def build_font(grub_mkfont, fontfile, fontsize, dst_path, fonthash, charset=None):
+    """Compiles fontfile at fontsize into dst_path with grub-mkfont.
+
+    Only the glyphs in charset are included when given. Fonts already built
+    from the same ttf and options are taken from the font cache. Returns the
+    unexpected grub-mkfont output, empty when clean.
+    """
+    from cache import FileCache, hash_key
+
+    options = f"-s {fontsize}"
+    if charset is not None:
+        options += f" -r {get_unicode_ranges(charset)}"
+    cache = FileCache(FONT_CACHE_DIR, FONT_CACHE_MAX_BYTES, suffix=".pf2")
+    key = hash_key(fonthash, options, get_mkfont_id(grub_mkfont))
+    if cache.get(key, dst_path):
+        return ""
+    with profiler.timed_item("mkfont", f"size {fontsize}"):
+        stdout = shout(f"{grub_mkfont} -o {dst_path} {fontfile} {options}", silence=True)
+    if not stdout:
+        cache.put(key, dst_path)
+    return stdout
+
+
+def get_theme_texts():
+    "Returns the fixed texts that theme.txt renders with the theme font"
+    with open(THEME_TEMPLATE_PATH, "r", newline="") as f:
+        texts = re.findall(r'^\s*text = "(.*)"', f.read(), flags=re.MULTILINE)
+    # e.g. the countdown "%d" renders digits
+    return [text.replace("%d", string.digits) for text in texts]
+
+
+def get_font_charset(entries, margin):
+    "Returns the sorted characters grub renders with the theme font plus a margin"
+    characters = set("".join(entry.name for entry in entries))
+    characters.update("".join(get_theme_texts()))
+    characters.update(FONT_SUBSET_MARGINS[margin])
+    return "".join(sorted(characters))
+
+
+def get_unicode_ranges(charset):
+    "Returns the grub-mkfont --range argument covering the characters of charset"
+    ranges = []
+    for codepoint in sorted(map(ord, set(charset))):
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ",".join(f"0x{start:X}-0x{end:X}" for start, end in ranges)
+
+
+def check_font_charset(font, entries):
+    """Rebuilds the installed font in full if entries need glyphs left out of it.
+
+    Runs from the grub-mkconfig hook, so new entries (e.g. a kernel with a
+    non ascii name) are never rendered with missing glyphs. Only the
+    installed theme gets the full font, the next matter.py build subsets it
+    again for the new entries.
+    """
+    charset = font.get("charset")
+    if charset is None:
+        return
+    missing = set("".join(entry.name for entry in entries)) - set(charset)
+    if not missing:
+        return
+    warning(
+        f"Entries use characters out of the font subset ({''.join(sorted(missing))}), "
+        "installing the full font"
+    )
+    import tempfile
+    import manifest
+
+    grub_mkfont = which("grub-mkfont") or which("grub2-mkfont")
+    if grub_mkfont is None or not exists(font["file"]) or not isdir(INSTALLATION_TARGET_DIR):
+        warning("Could not build the full font, rerun matter.py to fix it")
+        return
+    # Runs as root, so build away from the user's checkout and font cache
+    build_dir = tempfile.mkdtemp(prefix="matter-font-")
+    try:
+        names = [basename(get_font_pf2_path(font["sizes"], size)) for size in font["sizes"]]
+        for name, size in zip(names, font["sizes"]):
+            stdout = shout(f"{grub_mkfont} -o {build_dir}/{name} {font['file']} -s {size}", silence=True)
+            if stdout:
+                warning(f"{grub_mkfont} execution was not clean", stdout)
+                return
+        for name in names:
+            manifest.install(f"{build_dir}/{name}", INSTALLATION_TARGET_DIR, name)
+    finally:
+        rmtree(build_dir)
+    update_config_file(font=dict(font, charset=None))
+
+
 def get_available_fonts():
     "Returns the fonts present in /fonts"
     return [
@@ -299,8 +943,71 @@ def clean_install_dir():
         rmtree(INSTALLATION_TARGET_DIR)
 
 
+def prepare_background(image, background):
+    "Fits image to the screen in the fastest format for grub, returns its theme name"
+    for filename in os.listdir(INSTALLATION_SOURCE_DIR):
+        if filename.startswith("background."):  # Remove previous builds backgrounds
+            os.remove(f"{INSTALLATION_SOURCE_DIR}/{filename}")
+
+    if import_PIL_Image() is None:
+        warning("PIL not detected, the background image will not be optimized")
+        image_name = basename(image)
+        copyfile(image, f"{INSTALLATION_SOURCE_DIR}/{image_name}")
+        return image_name
+
+    import background as bg
+    from cache import FileCache, hash_key, hash_file
+
+    with open(GRUB_DEFAULTS_TEMPLATE_PATH, "r", newline="") as f:
+        resolution = bg.parse_gfxmode(f.read())
+    letterbox = user_args.imagefit == "letterbox"
+    cache = FileCache(BACKGROUND_CACHE_DIR, BACKGROUND_CACHE_MAX_BYTES)
+    key = hash_key(
+        hash_file(image),
+        "x".join(map(str, resolution)),
+        user_args.imagefit,
+        background,
+        str(bg.PREPROCESS_VERSION),
+    )
+    for extension in bg.EXTENSIONS.values():
+        image_name = f"background.{extension}"
+        if cache.get(f"{key}.{extension}", f"{INSTALLATION_SOURCE_DIR}/{image_name}"):
+            info(f"Background already fitted to {'x'.join(map(str, resolution))}, reusing it")
+            return image_name
+
+    result = bg.preprocess(image, resolution, letterbox, background)
+    extension = bg.EXTENSIONS[result.format]
+    image_name = f"background.{extension}"
+    with open(f"{INSTALLATION_SOURCE_DIR}/{image_name}", "wb") as f:
+        f.write(result.data)
+    cache.put(f"{key}.{extension}", f"{INSTALLATION_SOURCE_DIR}/{image_name}")
+
+    saved_kib = (result.original_bytes - len(result.data)) // 1024
+    original_pixels = result.original_size[0] * result.original_size[1]
+    saved_seconds = bg.estimate_load_time(
+        result.original_format, result.original_bytes, original_pixels
+    ) - bg.estimate_load_time(
+        result.format, len(result.data), result.size[0] * result.size[1]
+    )
+    info(
+        f"Background {'x'.join(map(str, result.original_size))} {result.original_format} "
+        f"({result.original_bytes // 1024}KiB) fitted to "
+        f"{'x'.join(map(str, result.size))} {result.format} ({len(result.data) // 1024}KiB), "
+        f"{abs(saved_kib)}KiB {'saved' if saved_kib >= 0 else 'added'} "
+        f"and about {saved_seconds * 1000:.0f}ms less to load at boot"
+    )
+    return image_name
+
+
 def prepare_source_dir():
+    from concurrent.futures import ThreadPoolExecutor
+    from cache import hash_file
+    import manifest
+
     info("Build theme from user preferences")
+    # Rules set icons to future entries, so their icons are built now as well
+    rule_icons = [icon for _, icon in parse_icon_rules(user_args.iconrule)]
+    check_icon_names(user_args.icons + rule_icons)
     # Get user color preferences
     highlight = parse_color(user_args.highlight)
     foreground = parse_color(user_args.foreground)
@@ -309,15 +1016,17 @@ def prepare_source_dir():
         if user_args.background is None
         else user_args.background
     )
-    image = (
-        user_args.image
-        if user_args.downloadbackground is None
-        else download_background(user_args.downloadbackground)
-    )
+    with profiler.phase("download"):
+        image = (
+            user_args.image
+            if user_args.downloadbackground is None
+            else download_background(user_args.downloadbackground)
+        )
     fontkey = user_args.font
     fontfile = user_args.fontfile
     fontname = user_args.fontname
-    fontsize = user_args.fontsize
+    fontsizes = list(dict.fromkeys(user_args.fontsize))  # Deduplicate keeping order
+    fontsize = fontsizes[0]
     icons = user_args.icons
 
     # Image checks
@@ -326,9 +1035,10 @@ def prepare_source_dir():
             error(f"{image} does not exist")
         if os.path.splitext(image)[1] not in (".png", ".jpg", ".jpeg", ".tga"):
             error("Background image must be one of .png, .jpg, .jpeg or .tga formats.")
-        image_name = basename(image)
-        copyfile(image, f"{INSTALLATION_SOURCE_DIR}/{image_name}")
-        if user_args.background:
+        image_name = prepare_background(image, background)
+        # Letterboxing fills the bars with the background color
+        letterboxed = user_args.imagefit == "letterbox" and import_PIL_Image() is not None
+        if user_args.background and not letterboxed:
             warning(
                 f"Both --background and --image arguments specified. Background color {background} will be ignored."
             )
@@ -345,7 +1055,7 @@ def prepare_source_dir():
             should_exit=False,
         )
         for i, m in enumerate(entries):
-            print(f"{i + 1}. {m['entryname']}")
+            print(f"{i + 1}. {m.name}")
         exit(1)
 
     # Font checks
@@ -371,34 +1081,77 @@ def prepare_source_dir():
         fontfile = dst_fontfile
         fontname = f"{fontname} {fontsize}"  # e.g. Open Sans Regular 32
 
+    # Prepare Font
+
+    # Only compile the glyphs grub will render if asked to
+    if user_args.fontsubset is None:
+        charset = None
+    else:
+        charset = get_font_charset(entries, user_args.fontsubset)
+        info(f"Subset font to {len(charset)} characters")
+    update_config_file(
+        font={"file": fontfile, "sizes": fontsizes, "charset": charset}
+    )
+
+    # Generate font files in the background while icons are prepared
+    info(f"Build font with sizes {', '.join(map(str, fontsizes))}")
+    for filename in os.listdir(INSTALLATION_SOURCE_DIR):
+        if filename.endswith(".pf2"):  # Remove fonts from previous builds
+            os.remove(f"{INSTALLATION_SOURCE_DIR}/{filename}")
+    fonthash = hash_file(fontfile)
+    font_executor = ThreadPoolExecutor(max_workers=len(fontsizes))
+    font_builds = {
+        size: font_executor.submit(
+            build_font,
+            grub_mkfont,
+            fontfile,
+            size,
+            get_font_pf2_path(fontsizes, size),
+            fonthash,
+            charset,
+        )
+        for size in fontsizes
+    }
+
     # Prepare Icons
 
     # Download not-yet-downloaded icons
-    for icon in icons:
-        if not is_icon_downloaded(icon) and icon != "_":
-            download_icon(icon)
+    missing_icons = [
+        icon for icon in dict.fromkeys(icons + rule_icons)
+        if icon != "_" and not is_icon_downloaded(icon)
+    ]
+    if missing_icons:
+        with profiler.phase("download"):
+            download_icons(missing_icons)
 
     # Convert icons
     info("Convert icons")
-    for i, icon in enumerate(icons):
-        if icon != "_":
-            if i == 0:
-                convert_icon_svg2png(icon)
-            else:
-                convert_icon_svg2png(icon, whisper=True)
+    with profiler.phase("convert"):
+        convert_icons_svg2png(
+            [icon for icon in dict.fromkeys(icons + rule_icons) if icon != "_"], user_args.jobs
+        )
 
-    # Prepare Font
+    # Wait for the fonts
+    with profiler.phase("mkfont"):  # Only the wait, fonts build during the above
+        font_executor.shutdown(wait=True)
+    for size, build in font_builds.items():
+        stdout = build.result()
+        if stdout:
+            error(
+                f"{grub_mkfont} execution was not clean",
+                f"for fontfile: {fontfile} at size {size}",
+                stdout,
+            )
 
-    # Generate font file
-    info("Build font")
-    stdout = shout(
-        f"{grub_mkfont} -o {INSTALLATION_SOURCE_DIR}/font.pf2 {fontfile} -s {fontsize}"
-    )
-    if stdout:
-        error(
-            f"{grub_mkfont} execution was not clean", f"for fontfile: {fontfile}",
+    with profiler.phase("tint"):
+        pixmap_styles = prepare_tinted_assets(
+            {"highlight": highlight, "foreground": foreground, "background": background}
         )
 
+    # Shrink every png of the theme
+    with profiler.phase("optimize"):
+        optimize_pngs()
+
     # Prepare Theme.txt
 
     # Parse theme template with user preferences
@@ -412,6 +1165,8 @@ def prepare_source_dir():
         "background": background,
         "image_name": image_name,
         "fontname": fontname,
+        "select_pixmaps": pixmap_styles["select"],
+        "terminal_box_pixmaps": pixmap_styles["terminal_box"],
     }
     parsed_theme = template.format(**context)
 
@@ -422,17 +1177,28 @@ def prepare_source_dir():
     with open(theme_file_path, "w") as f:
         f.write(parsed_theme)
 
+    # Hash the built theme so installs only copy what changed
+    manifest.write(INSTALLATION_SOURCE_DIR, manifest.build(INSTALLATION_SOURCE_DIR))
 
-def prepare_target_dir():
-    info("Prepare installation directory")
-    clean_install_dir()
 
+@profiler.phase("copy")
+def sync_source_to_target():
+    import manifest
 
-def copy_source_to_target():
-    info("Copy built theme to installation directory")
-    copytree(INSTALLATION_SOURCE_DIR, INSTALLATION_TARGET_DIR)
+    info("Sync built theme to installation directory")
+    source_manifest = manifest.read(INSTALLATION_SOURCE_DIR)
+    if source_manifest is None:
+        error(f"No build manifest found in {INSTALLATION_SOURCE_DIR}, rebuild the theme")
+    added, changed, removed = manifest.sync(
+        INSTALLATION_SOURCE_DIR, INSTALLATION_TARGET_DIR, source_manifest
+    )
+    info(
+        f"{len(added)} files added, {len(changed)} changed and {len(removed)} removed "
+        f"in {INSTALLATION_TARGET_DIR}"
+    )
 
 
+@profiler.phase("update_grub_cfg")
 def update_grub_cfg():
     info("Update grub.cfg")
     update_command = (
@@ -447,37 +1213,29 @@ def update_grub_cfg():
     sh(command)
 
 
+@profiler.phase("defaults patch")
 def update_grub_defaults():
     info(f"Patch {GRUB_DEFAULTS_PATH} with {THEME_OVERRIDES_TITLE}")
-    grub_configs = read_cleaned_grub_defaults()
-
-    # Parse grub defaults template, append parsed contents, and write back
 
+    # Parse grub defaults template and set it as the overrides block
     with open(GRUB_DEFAULTS_TEMPLATE_PATH, "r", newline="") as f:
         template = f.read()
 
     context = {"installation_dir": INSTALLATION_TARGET_DIR}
     parsed_extra_grub = template.format(**context)
-    grub_configs += (
-        f"\n\n{BEGIN_THEME_OVERRIDES}\n{parsed_extra_grub}\n{END_THEME_OVERRIDES}\n\n"
-    )
-
-    with open(GRUB_DEFAULTS_PATH, "w") as f:
-        f.write(grub_configs)
+    update_theme_overrides(GRUB_DEFAULTS_PATH, parsed_extra_grub)
 
 
 def clean_grub_defaults():
     info(f"Clean {THEME_OVERRIDES_TITLE} from {GRUB_DEFAULTS_PATH}")
-    cleaned_grub_defaults = read_cleaned_grub_defaults()
-    with open(GRUB_DEFAULTS_PATH, "w") as f:
-        f.write(cleaned_grub_defaults)
+    update_theme_overrides(GRUB_DEFAULTS_PATH)
 
 
 def clean_grub_mkconfig():
-    info(f"Clean {THEME_OVERRIDES_TITLE} from {GRUB_MKCONFIG_PATH}")
-    cleaned_grub_mkconfig = read_cleaned_grub_mkconfig()
-    with open(GRUB_MKCONFIG_PATH, "w") as f:
-        f.write(cleaned_grub_mkconfig)
+    grub_mkconfig_path = get_grub_mkconfig_path()
+    info(f"Clean {THEME_OVERRIDES_TITLE} and {FILTER_TITLE} from {grub_mkconfig_path}")
+    update_theme_overrides(grub_mkconfig_path)
+    update_icon_filter(grub_mkconfig_path)
 
 
 def clean_hookcheck():
@@ -487,20 +1245,17 @@ def clean_hookcheck():
         os.remove(hookcheck)
 
 
+def load_grub_cfg():
+    "Returns the parsed grub.cfg, it is shared during the run until the file changes"
+    try:
+        return grubcfg.load(GRUB_CFG_PATH)
+    except grubcfg.GrubCfgError as err:
+        error(f"Could not parse {GRUB_CFG_PATH}", str(err))
+
+
 def get_entry_names():
-    "Gets the entry names from grub.cfg contents"
-    with open(GRUB_CFG_PATH, "r", newline="") as f:
-        grub_cfg = f.read()
-    pattern = (
-        r"(?P<head>(?:submenu|menuentry) ?)"  # menuentry or submenu
-        r"(?:\"|')"  # " or '
-        r"(?P<entryname>[^\"']*)"  # capture the entry name (without quotes)
-        r"(?:\"|')"  # " or '
-        r"(?P<tail>[^\{]*\{)"  # The rest of the entry header until a { is found
-    )
-    matchiter = re.finditer(pattern, grub_cfg)
-    matches = list(matchiter)
-    return matches
+    "Gets the entries from grub.cfg contents"
+    return load_grub_cfg().entries
 
 
 # Main procedures
@@ -517,6 +1272,7 @@ def do_preinstall_hint():
     info("Your grub entries are:")
     do_list_grub_cfg_entries()
     info("Look for icons you like at https://materialdesignicons.com/")
+    info(f"or get suggestions for each entry with ./{INSTALLER_NAME} --suggest")
     info("Then install with:")
     info("./matter.py -i icon-for-entry-1 icon-for-entry-2 ...")
     info("Example (with 8 entries, _ means ignore):")
@@ -538,16 +1294,205 @@ def do_test():
     sh(f"grub2-theme-preview {INSTALLATION_SOURCE_DIR}")
 
 
+def run_plan(steps, icons=None):
+    """Runs the steps of an install that need root, see PLAN_STEPS.
+
+    Everything else (building, downloading, converting) must be done before,
+    as the user. If not root already, matter.py is relaunched with sudo and
+    --applyplan so the root process applies the plan without redoing it.
+    """
+    import manifest
+
+    plan = {"version": PLAN_VERSION, "steps": steps, "icons": icons, "build": None}
+    plan["profile"] = None  # Where root leaves its phases for the --profile report
+    if "sync" in steps:
+        # Pin the build so root installs exactly what was built here
+        build_manifest = f"{INSTALLATION_SOURCE_DIR}/{manifest.MANIFEST_NAME}"
+        plan["build"] = (file_fingerprint(build_manifest) or b"").hex()
+    if os.geteuid() == 0:
+        apply_plan(plan)
+        return
+
+    import tempfile
+
+    fd, plan_path = tempfile.mkstemp(prefix="matter-plan-", suffix=".json")
+    if profiler.enabled:
+        profile_fd, plan["profile"] = tempfile.mkstemp(prefix="matter-profile-", suffix=".json")
+        os.close(profile_fd)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(plan))
+        exit_code = relaunch_as_root("--applyplan", plan_path)
+        if plan["profile"] is not None and os.path.getsize(plan["profile"]) > 0:
+            with open(plan["profile"]) as f:
+                profiler.merge(json.loads(f.read()))
+    finally:
+        os.remove(plan_path)
+        if plan["profile"] is not None:
+            os.remove(plan["profile"])
+    if exit_code != 0:
+        exit(exit_code)  # Propagate exit code
+
+
+def apply_plan(plan):
+    "Runs the steps of a plan made by run_plan(), as root"
+    import manifest
+
+    if plan.get("version") != PLAN_VERSION or not set(plan["steps"]) <= set(PLAN_STEPS):
+        error("Unsupported install plan, was it made by another version of Matter?")
+    if plan["build"] is not None:
+        build_manifest = f"{INSTALLATION_SOURCE_DIR}/{manifest.MANIFEST_NAME}"
+        if (file_fingerprint(build_manifest) or b"").hex() != plan["build"]:
+            error(f"{INSTALLATION_SOURCE_DIR} changed since it was built, install again")
+
+    steps = plan["steps"]
+    if "sync" in steps:
+        sync_source_to_target()
+    if "defaults" in steps:
+        update_grub_defaults()
+    if "icons" in steps:
+        do_patch_grub_cfg_icons(plan["icons"])
+    if "configicons" in steps:
+        patch_from_config_file()
+    if "hook" in steps:
+        hook_grub_mkconfig()
+    if "hookcheck" in steps:
+        install_hookcheck()
+    if "grubcfg" in steps:
+        update_grub_cfg()
+
+
+def do_apply_plan(plan_path):
+    with open(plan_path) as f:
+        plan = json.loads(f.read())
+    check_root_or_prompt()
+    if plan.get("profile") is not None:
+        profiler.enable()
+    apply_plan(plan)
+    if plan.get("profile") is not None:
+        profiler.write_report(plan["profile"])  # Merged by the user process
+
+
+def get_grub_timeout():
+    "Returns the GRUB_TIMEOUT of the grub defaults, or grub's default of 5 seconds"
+    try:
+        with open(GRUB_DEFAULTS_PATH) as f:
+            match = re.search(r"^\s*GRUB_TIMEOUT=[\"']?(\d+)", f.read(), re.MULTILINE)
+    except OSError:
+        match = None
+    return int(match.group(1)) if match else 5
+
+
+@profiler.phase("preview")
+def do_preview(preview_path):
+    "Renders the built theme as shown at boot to preview_path, without grub or a VM"
+    if import_PIL_Image() is None:
+        error("PIL not detected, it is needed for --preview")
+    import preview
+    import background as bg
+
+    start = time.perf_counter()
+    theme_path = f"{INSTALLATION_SOURCE_DIR}/theme.txt"
+    if not exists(theme_path):
+        error(f"No built theme in {INSTALLATION_SOURCE_DIR}, build it first e.g. with -b -i ...")
+    config = {}
+    if exists(CONFIG_FILE_PATH):
+        with open(CONFIG_FILE_PATH) as f:
+            config = json.loads(f.read())
+
+    # The requested icons, or else the ones set by the last install
+    entries = get_entry_names()
+    if user_args.icons:
+        icons = user_args.icons
+    else:
+        try:
+            icons = get_config_icons(entries, dict({"icons": {}}, **config))
+        except re.error as err:
+            error(f"Invalid icon rules in {CONFIG_FILE_PATH}", str(err))
+    items = []
+    for entry, icon in zip(entries, icons):
+        if entry.depth > 0:
+            continue  # Only the top level menu shows at boot
+        # grub shows the icon of the first class with one, like patched entries
+        classes = ([icon] if icon != "_" else []) + entry.classes
+        paths = [ICON_PNG_PATHF.format(name) for name in classes]
+        items.append(preview.Item(entry.name, next(filter(exists, paths), None)))
+
+    if user_args.previewsize:
+        resolution = bg.RESOLUTION.match(user_args.previewsize)
+        if resolution is None:
+            error(f"Invalid preview size {user_args.previewsize}, it must be like 1920x1080")
+        resolution = int(resolution.group(1)), int(resolution.group(2))
+    else:
+        with open(GRUB_DEFAULTS_TEMPLATE_PATH, "r", newline="") as f:
+            resolution = bg.parse_gfxmode(f.read())
+    font_path = config.get("font", {}).get("file", f"{INSTALLER_DIR}/fonts/{THEME_DEFAULT_FONT}.ttf")
+
+    image, skipped = preview.render(theme_path, items, resolution, font_path, get_grub_timeout())
+    image.save(preview_path)
+    if skipped:
+        warning(f"Theme components not previewed: {', '.join(sorted(set(skipped)))}")
+    info(
+        f"Preview of {len(items)} entries at {resolution[0]}x{resolution[1]} saved to "
+        f"{preview_path} in {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+
+
 def do_install():
     info(f"Begin {THEME_NAME} install")
     prepare_source_dir()
-    check_root_or_prompt()
-    prepare_target_dir()
-    copy_source_to_target()
-    update_grub_defaults()
-    do_set_icons(patch_grubcfg=True)
-    install_hookcheck()
-    update_grub_cfg()
+    icons = check_set_icons()
+    create_config_file()
+    run_plan(["sync", "defaults", "icons", "hook", "hookcheck", "grubcfg"], icons)
+    info(f"{THEME_NAME} successfully installed")
+
+
+def do_build_artifact(artifact_path):
+    "Packs the built theme with its options and entry icons, see --artifact"
+    import artifact
+
+    info(f"Create theme artifact {artifact_path}")
+    with open(CONFIG_FILE_PATH) as f:
+        font = json.loads(f.read()).get("font")
+    options = {name: getattr(user_args, name) for name in ARTIFACT_OPTIONS}
+    metadata = artifact.create(
+        INSTALLATION_SOURCE_DIR,
+        artifact_path,
+        {
+            "theme": THEME_NAME,
+            "options": options,
+            "icons": get_entries_to_icons(user_args.icons),
+            "rules": parse_icon_rules(user_args.iconrule),
+            "font": font,
+        },
+    )
+    info(f"{len(metadata['files'])} theme files packed into {artifact_path}")
+
+
+def do_install_artifact(artifact_path):
+    "Installs a theme built elsewhere with --buildonly --artifact, without building"
+    import tempfile
+    import artifact
+    import manifest
+
+    info(f"Begin {THEME_NAME} install from {artifact_path}")
+    with tempfile.TemporaryDirectory(prefix="matter-artifact-") as tempdir:
+        try:
+            metadata = artifact.extract(artifact_path, tempdir)
+        except artifact.ArtifactError as err:
+            error(f"Invalid artifact {artifact_path}", str(err))
+        # The artifact becomes the last build, as if it was built here
+        theme_dir = f"{tempdir}/{artifact.THEME_DIR_NAME}"
+        manifest.sync(theme_dir, INSTALLATION_SOURCE_DIR, manifest.read(theme_dir))
+    font = metadata["font"]
+    if font and font.get("charset") is not None:  # Made before --fontsubset was refused
+        warning(
+            "The artifact font was subset on the build machine, entries using other "
+            "characters will miss glyphs. Rebuild it without --fontsubset to fix it"
+        )
+        font = dict(font, charset=None)  # Its ttf is not here to rebuild it anyway
+    update_config_file(icons=metadata["icons"], rules=metadata.get("rules", []), font=font)
+    run_plan(["sync", "defaults", "configicons", "hook", "hookcheck", "grubcfg"])
     info(f"{THEME_NAME} successfully installed")
 
 
@@ -562,93 +1507,250 @@ def do_uninstall():
     info(f"{THEME_NAME} successfully uninstalled")
 
 
+def do_verify():
+    import manifest
+
+    info(f"Verify {INSTALLATION_TARGET_DIR} against the last build")
+    source_manifest = manifest.read(INSTALLATION_SOURCE_DIR)
+    if source_manifest is None:
+        error(f"No build manifest found in {INSTALLATION_SOURCE_DIR}, build the theme first")
+    if not isdir(INSTALLATION_TARGET_DIR):
+        error(f"{THEME_NAME} is not installed in {INSTALLATION_TARGET_DIR}")
+    missing, changed, extra = manifest.verify(INSTALLATION_TARGET_DIR, source_manifest)
+    for label, paths in (("Missing", missing), ("Changed", changed), ("Extra", extra)):
+        for path in paths:
+            warning(f"{label}: {INSTALLATION_TARGET_DIR}/{path}")
+    if missing or changed or extra:
+        error(f"Installed theme drifted from the build, reinstall to fix it")
+    info(f"{len(source_manifest['files'])} installed files match the build")
+
+
 def do_list_grub_cfg_entries():
     # Read current grub cfg
-    with open(GRUB_CFG_PATH, "r", newline="") as f:
-        grub_cfg = f.read()
-
     entries = get_entry_names()
 
     for i, m in enumerate(entries):
-        print(f"{i + 1}. {m['entryname']}")
+        print(f"{i + 1}. {m.name}")
 
 
-def create_config_file():
-    icons = user_args.icons
+def get_entries_to_icons(icons):
     # Read current grub cfg
     entries = get_entry_names()
 
     entries_to_icons = {}
     for icon, entry in zip(icons, entries):
-        entryname = entry.group("entryname")
+        entryname = entry.name
         if entryname in entries_to_icons:
             warning(f"Duplicate entry '{entryname}'. Unexpected behaviour may occur. Consider changing names using Grub Customizer.")
         entries_to_icons[entryname]  = icon
+    return entries_to_icons
 
-    config = {"icons": entries_to_icons}
 
-    with open(CONFIG_FILE_PATH, 'w') as f:
-        f.write(json.dumps(config))
+def create_config_file():
+    update_config_file(
+        icons=get_entries_to_icons(user_args.icons),
+        rules=parse_icon_rules(user_args.iconrule),
+    )
 
 
-def patch_from_config_file():
-    # Read current grub cfg
-    current_entries = get_entry_names()
+def update_config_file(**sections):
+    """Sets the given top level sections of the config file keeping the others.
 
-    with open(CONFIG_FILE_PATH) as f:
-        config = json.loads(f.read())
+    The file is replaced rather than written in place, as installs before the
+    build ran as the user left it owned by root.
+    """
+    config = {}
+    if exists(CONFIG_FILE_PATH):
+        with open(CONFIG_FILE_PATH) as f:
+            config = json.loads(f.read())
+    config.update(sections)
 
-    entries_to_icons = config["icons"]
+    write_if_changed(CONFIG_FILE_PATH, json.dumps(config))
+
+
+def parse_icon_rules(rules):
+    "Returns the [pattern, icon] pairs of the given --iconrule PATTERN=ICON arguments"
+    pairs = []
+    for rule in rules or []:
+        pattern, _, icon = rule.rpartition("=")
+        if not pattern or not icon:
+            error(f"Invalid icon rule '{rule}', it must be PATTERN=ICON e.g. 'Ubuntu*=ubuntu'")
+        pairs.append([pattern, icon])
+    try:
+        compile_icon_rules(pairs)
+    except re.error as err:
+        error("Invalid icon rule", str(err))
+    return pairs
+
+
+def compile_icon_rules(rules):
+    """Returns a function giving the icon of the first rule matching an entry name.
+
+    rules are [pattern, icon] pairs, patterns are globs or regexes prefixed
+    with re: that must match the whole entry name. Rules are compiled into a
+    single regex with each rule as a named group of one alternation, so one
+    match finds the first matching rule. Group numbers shift when joined, so
+    regexes referencing groups are refused. There is one such regex per first
+    character of the entry names, compiled on first use, with only the rules
+    that can match names starting with it. The function returns None for
+    unmatched names. Raises re.error for invalid regexes.
+    """
+    import fnmatch
+
+    alternatives = []  # (first character of matched names or None if any, regex)
+    for i, (pattern, _) in enumerate(rules):
+        if pattern.startswith(ICON_RULE_REGEX_PREFIX):
+            regex = pattern[len(ICON_RULE_REGEX_PREFIX):]
+            try:
+                compiled = re.compile(regex)
+            except re.error as err:
+                raise re.error(f"'{pattern}': {err}")
+            references = [
+                token for token in ICON_RULE_GROUP_REFERENCE.findall(regex)
+                if token == "(?(" or token[1] in "123456789"
+            ]
+            if compiled.groupindex or references or compiled.flags & ~re.UNICODE:
+                raise re.error(
+                    f"'{pattern}': regexes can't have named groups, group references "
+                    f"or global flags, e.g. use (?i:...) instead of (?i)"
+                )
+            first = None
+        else:
+            regex = fnmatch.translate(pattern)
+            first = pattern[0] if pattern[:1] not in ("", "*", "?", "[") else None
+        alternatives.append((first, f"(?P<{ICON_RULE_GROUPF.format(i)}>(?:{regex})\\Z)"))
+    icons = {ICON_RULE_GROUPF.format(i): icon for i, (_, icon) in enumerate(rules)}
+    matchers = {}  # First character -> combined regex
+
+    def get_icon(entryname):
+        first = entryname[:1]
+        matcher = matchers.get(first)
+        if matcher is None:
+            regex = "|".join(
+                alternative for alternative_first, alternative in alternatives
+                if alternative_first is None or alternative_first == first
+            )
+            matcher = matchers[first] = re.compile(regex or "(?!)", re.DOTALL)
+        match = matcher.match(entryname)
+        return None if match is None else icons[match.lastgroup]
+
+    return get_icon
+
+
+def get_config_icons(entries, config):
+    """Returns the icon of each entry from the config file, _ for new entries.
 
+    Entries get the icon of their exact name or else of the first matching
+    rule. Raises re.error if the rules are invalid.
+    """
+    entries_to_icons = config["icons"]
+    get_rule_icon = compile_icon_rules(config.get("rules", []))
     icons = []
-    for entry in current_entries:
-        entryname = entry.group("entryname")
+    for entry in entries:
+        entryname = entry.name
         if entryname in entries_to_icons:
             icons.append(entries_to_icons[entryname])
+            continue
+        icon = get_rule_icon(entryname)
+        if icon is not None:
+            icons.append(icon)
         else:
             warning(
                     f"{entryname} is a new grub menu entry, no icon will be set for it. "
-                    f"Rerun matter.py to set icons"
+                    f"Rerun matter.py to set icons or add an --iconrule for it"
                 )
             icons.append("_")
+    return icons
+
+
+def get_icon_insertions(entries, icons):
+    "Returns the grubcfg insertions adding each icon right after its entry title"
+    return [
+        (entry.name_end, f" --class {icon}".encode())
+        for entry, icon in zip(entries, icons)
+        if icon != "_" and entry.classes[:1] != [icon]  # No icon or already patched
+    ]
 
+
+def patch_from_config_file():
+    # Read current grub cfg
+    current_entries = get_entry_names()
+
+    with open(CONFIG_FILE_PATH) as f:
+        config = json.loads(f.read())
+
+    try:
+        icons = get_config_icons(current_entries, config)
+    except re.error as err:
+        error(f"Invalid icon rules in {CONFIG_FILE_PATH}", str(err))
     do_patch_grub_cfg_icons(icons)
+    check_font_charset(config.get("font", {}), current_entries)
+
+
+@profiler.phase("icon patch")
+def do_filter_icons():
+    """Copies grub.cfg from stdin to stdout adding the icons of the config file.
+
+    With --hookmode filter grub-mkconfig output goes through this, so grub.cfg
+    is written once, already with icons. If anything goes wrong the input is
+    passed through as is, a grub.cfg without icons beats a broken one.
+    """
+    output = sys.stdout.buffer
+    sys.stdout = sys.stderr  # Logs must not end up in grub.cfg
+    data = sys.stdin.buffer.read()
+    try:
+        grub_cfg = grubcfg.GrubCfg("<stdin>", data)
+        with open(CONFIG_FILE_PATH) as f:
+            config = json.loads(f.read())
+        icons = get_config_icons(grub_cfg.entries, config)
+        insertions = get_icon_insertions(grub_cfg.entries, icons)
+        patched = io.BytesIO()  # Nothing is written until the patch is complete
+        grub_cfg.write_patched(insertions, patched)
+    except (Exception, SystemExit) as err:  # Even a bug must not lose grub.cfg
+        warning(f"Could not set icons, grub.cfg is generated without them ({err!r})")
+        output.write(data)
+        output.flush()
+        return
+
+    output.write(patched.getvalue())
+    output.flush()
+    info(f"{len(insertions)} icons set while generating grub.cfg")
+    try:
+        check_font_charset(config.get("font", {}), grub_cfg.entries)
+    except (Exception, SystemExit) as err:
+        warning(f"Could not check the font charset ({err!r})")
 
 
+@profiler.phase("icon patch")
 def do_patch_grub_cfg_icons(icons):
 
     info(f"Begin {GRUB_CFG_PATH} patch")
-    with open(GRUB_CFG_PATH, "r", newline="") as f:
-        grub_cfg = f.read()
     # Read current grub cfg
-    entries = get_entry_names()
+    grub_cfg = load_grub_cfg()
+
+    # Insert the given icons right after each entry title
+    insertions = get_icon_insertions(grub_cfg.entries, icons)
 
-    # Build new grub cfg with given icons
-    new_grub_cfg = ""
-    next_seek = 0
-    for m, i in zip(entries, icons):
-        mstart, mend = m.span()
-        new_grub_cfg += grub_cfg[next_seek:mstart]
-        icon_class = f" --class {i} " if i != "_" else ""
-        new_grub_cfg += f'{m["head"]}"{m["entryname"]}"{icon_class}{m["tail"]}'
-        next_seek = mend
-    new_grub_cfg += grub_cfg[mend:]
-
-    # Write new grub cfg back
+    if not insertions:
+        info(f"{GRUB_CFG_PATH} icons already up to date")
+        return
+
+    # Stream the patched grub cfg back
     check_root_or_prompt()
-    with open(GRUB_CFG_PATH, "w") as f:
-        f.write(new_grub_cfg)
+    grub_cfg.patch(insertions)
 
     info(f"{len(icons)} icons successfully patched onto {GRUB_CFG_PATH}")
 
 
-def do_set_icons(patch_grubcfg):
-
+def check_set_icons():
+    "Returns the icons given with --icons once checked against the grub.cfg entries"
     icons = user_args.icons
 
     if icons is None:
         error("Stop. Unspecified icons (--icons/-i argument)")
     icons = [check_icon_converted(i) for i in icons]
+    for _, icon in parse_icon_rules(user_args.iconrule):
+        check_icon_converted(icon)
 
     # Read current grub cfg
     entries = get_entry_names()
@@ -659,68 +1761,84 @@ def do_set_icons(patch_grubcfg):
             should_exit=False,
         )
         for i, m in enumerate(entries):
-            print(f"{i + 1}. {m['entryname']}")
+            print(f"{i + 1}. {m.name}")
         # NOTE: We exit with 0 here to not stop the apt upgrade process
         # eventually it will be solved with an autoremove
         exit(0)
+    return icons
 
-    do_patch_grub_cfg_icons(user_args.icons)
 
+def do_set_icons(patch_grubcfg):
+    icons = check_set_icons()
     if patch_grubcfg:
         create_config_file()
-
-        # Patch grub-mkconfig so everytime it executes, it patches grub.cfg
-        info(f"Begin {GRUB_MKCONFIG_PATH} patch")
-        info(f"Clean old {GRUB_MKCONFIG_PATH} patch if any")
-
-        # cmd_icons = " ".join(user_args.icons)
-        # seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} -so -i {cmd_icons} >&2"
-        seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} --configicons >&2"
-        new_grub_mkconfig = read_cleaned_grub_mkconfig()
-
-        # grub-mkconfig is called on upgrade, and on failure it halts.
-        # A failure on our part should not halt an upgrade, let's temporarily
-        # disable the stop-on-error functionality with set +e. See #67
-        new_grub_mkconfig += (
-            f"\n\n{BEGIN_THEME_OVERRIDES}\n"
-            f"set +e\n"
-            f"{seticons_call}\n"
-            f"set -e\n"
-            f"{END_THEME_OVERRIDES}\n\n"
+        run_plan(["icons", "hook"], icons)
+    else:
+        run_plan(["icons"], icons)
+
+
+@profiler.phase("icon patch")
+def hook_grub_mkconfig():
+    # Patch grub-mkconfig so everytime it executes, it patches grub.cfg
+    grub_mkconfig_path = get_grub_mkconfig_path()
+    info(f"Begin {grub_mkconfig_path} patch")
+    info(f"Replace old {grub_mkconfig_path} patch if any")
+
+    if user_args.hookmode == "filter":
+        # Icons are set while grub-mkconfig writes grub.cfg, not patched after
+        filter_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} --filtericons"
+        filtered = update_icon_filter(grub_mkconfig_path, filter_call, prompt_root=True)
+        if filtered is not None:
+            update_theme_overrides(grub_mkconfig_path, prompt_root=True)
+            info(f"{grub_mkconfig_path} successfully patched, icons will now be set on every grub update.")
+            return
+        warning(
+            f"Could not find the scripts loop of {grub_mkconfig_path}, "
+            f"using --hookmode append instead"
         )
 
-        check_root_or_prompt()
-        with open(GRUB_MKCONFIG_PATH, "w") as f:
-            f.write(new_grub_mkconfig)
+    # cmd_icons = " ".join(user_args.icons)
+    # seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} -so -i {cmd_icons} >&2"
+    seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} --configicons >&2"
+
+    # grub-mkconfig is called on upgrade, and on failure it halts.
+    # A failure on our part should not halt an upgrade, let's temporarily
+    # disable the stop-on-error functionality with set +e. See #67
+    update_icon_filter(grub_mkconfig_path, prompt_root=True)
+    update_theme_overrides(
+        grub_mkconfig_path,
+        f"set +e\n{seticons_call}\nset -e",
+        prompt_root=True,
+    )
 
-        info(
-            f"{GRUB_MKCONFIG_PATH} successfully patched, icons will now persist between grub updates."
-        )
+    info(
+        f"{grub_mkconfig_path} successfully patched, icons will now persist between grub updates."
+    )
 
 
+@profiler.phase("hookcheck")
 def install_hookcheck():
     info(f"Create hook check script")
     with open(HOOKCHECK_TEMPLATE_PATH, "r", newline="") as f:
         template = f.read()
 
-    cmd_icons = " ".join(user_args.icons)
-    # seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} -so -i {cmd_icons} >&2"
-    seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} --configicons"
+    # Hooking back appends --configicons, which in filter mode moves to the filter
+    seticons_call = f"{INSTALLER_DIR}/{INSTALLER_NAME} --configicons --hookmode {user_args.hookmode}"
 
     context = {
-        "GRUB_MKCONFIG_PATH": GRUB_MKCONFIG_PATH,
+        "GRUB_MKCONFIG_PATH": get_grub_mkconfig_path(),
         "THEME_NAME": THEME_NAME,
         "THEME_OVERRIDES_TITLE": THEME_OVERRIDES_TITLE,
         "BEGIN_THEME_OVERRIDES": BEGIN_THEME_OVERRIDES,
         "END_THEME_OVERRIDES": END_THEME_OVERRIDES,
+        "BEGIN_FILTER": BEGIN_FILTER,
         "SETICONS_CALL": seticons_call,
     }
 
     parsed_script = template.format(**context)
     script_file_path = f"{GRUB_SCRIPTS_PATH}/99_matter"
 
-    with open(script_file_path, "w") as f:
-        f.write(parsed_script)
+    write_if_changed(script_file_path, parsed_script)
 
     # Make it executable by user, group and others
     st = os.stat(script_file_path)
@@ -730,33 +1848,98 @@ def install_hookcheck():
 # Script arguments
 
 
+class MatterArgumentParser(ArgumentParser):
+    "Builds the help epilog only when printed, as it needs to scan the fonts directory"
+
+    def format_help(self):
+        self.epilog = (
+            f"[Available colors] are: {', '.join(AVAILABLE_COLORS)}.\n"
+            "You can specify your own hex colors as well (e.g. C0FFEE, FF00FF, etc).\n"
+            f"[Available fonts] are: {', '.join(get_available_fonts())}\n"
+            "You can always specify your own with the -ff argument\n"
+            f"[Available icons] can be found at https://materialdesignicons.com/\n"
+            "For requests open an issue on:\n"
+            "https://github.com/mateosss/matter/issues"
+        )
+        return super().format_help()
+
+
 def parse_args():
-    parser = ArgumentParser(
+    parser = MatterArgumentParser(
         description=THEME_DESCRIPTION,
-        epilog=f"[Available colors] are: {', '.join(AVAILABLE_COLORS)}.\n"
-        "You can specify your own hex colors as well (e.g. C0FFEE, FF00FF, etc).\n"
-        f"[Available fonts] are: {', '.join(get_available_fonts())}\n"
-        "You can always specify your own with the -ff argument\n"
-        f"[Available icons] can be found at https://materialdesignicons.com/\n"
-        "For requests open an issue on:\n"
-        "https://github.com/mateosss/matter/issues",
         formatter_class=RawTextHelpFormatter,
     )
     parser.add_argument(
         "--listentries", "-l", action="store_true", help=f"list grub entries",
     )
+    parser.add_argument(
+        "--suggest",
+        "-sg",
+        action="store_true",
+        help=f"suggest icons for each grub entry",
+    )
+    parser.add_argument(
+        "--searchicons",
+        "-sci",
+        type=str,
+        nargs="+",
+        help=f"search icons by name or alias, e.g. -sci windows boot manager",
+    )
     parser.add_argument(
         "--buildonly",
         "-b",
         action="store_true",
         help=f"prepare the theme but do not install it",
     )
+    parser.add_argument(
+        "--verify",
+        "-vf",
+        action="store_true",
+        help=f"check the installed theme files against the last build without copying anything",
+    )
+    parser.add_argument(
+        "--artifact",
+        "-a",
+        type=str,
+        help=f"with --buildonly, also pack the built theme into this .tar.gz for --installartifact",
+    )
+    parser.add_argument(
+        "--installartifact",
+        "-ia",
+        type=str,
+        help=f"install a theme artifact made with --buildonly --artifact, without building anything",
+    )
+    parser.add_argument(
+        "--applyplan",
+        type=str,
+        help=argparse.SUPPRESS,  # Root half of an install, see run_plan()
+    )
+    parser.add_argument(
+        "--profile",
+        "-p",
+        type=str,
+        nargs="?",
+        const="",
+        help=f"print the time and resources used by each phase, and save them as json to the given file",
+    )
     parser.add_argument(
         "--test",
         "-t",
         action="store_true",
         help=f"test the generated theme with grub2-theme-preview",
     )
+    parser.add_argument(
+        "--preview",
+        "-pv",
+        type=str,
+        help=f"render how the built theme looks at boot to this png, e.g. with -b -i ... -pv out.png",
+    )
+    parser.add_argument(
+        "--previewsize",
+        "-pvs",
+        type=str,
+        help=f"resolution of --preview, by default the GRUB_GFXMODE of grub.template",
+    )
     parser.add_argument(
         "--icons",
         "-i",
@@ -764,6 +1947,17 @@ def parse_args():
         nargs="*",
         help=f"specify icons for each grub entry listed with -l",
     )
+    parser.add_argument(
+        "--iconrule",
+        "-ir",
+        type=str,
+        nargs="+",
+        help=(
+            f"icons for entries not listed with -l yet, e.g. new kernels or snapshots, as\n"
+            f"PATTERN=ICON glob rules like 'Ubuntu*=ubuntu' or regexes like 're:.*snap.*=camera'\n"
+            f"matching whole entry names, the first matching rule is used"
+        ),
+    )
     parser.add_argument(
         "--seticons",
         "-si",
@@ -807,19 +2001,47 @@ def parse_args():
         type=str,
         help=f"image file to use as background, supported extensions: PNG, JPG, JPEG, TGA",
     )
+    parser.add_argument(
+        "--imagefit",
+        "-if",
+        type=str,
+        help=f"how to fit the background image to the screen resolution of grub.template",
+        default="crop",
+        choices=["crop", "letterbox"],
+    )
     parser.add_argument(
         "--iconcolor",
         "-ic",
         type=str,
         help=f"icons fill color, by default same as foreground",
     )
+    parser.add_argument(
+        "--tintassets",
+        "-ta",
+        action="store_true",
+        help=f"tint the selected entry box with the highlight color and the terminal box with the background",
+    )
+    parser.add_argument(
+        "--converter",
+        "-cv",
+        type=str,
+        help=f"svg to png icon converter, by default inkscape, then builtin (PIL) and then convert",
+        default="auto",
+        choices=["auto", "inkscape", "builtin", "convert"],
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help=f"number of parallel icon converters, by default the CPU count",
+        default=os.cpu_count(),
+    )
     parser.add_argument(
         "--font",
         "-f",
         type=str,
-        help=f"theme font from already downloaded fonts",
+        help=f"theme font from already downloaded fonts, see [Available fonts] below",
         default=THEME_DEFAULT_FONT,
-        choices=get_available_fonts(),
     )
     parser.add_argument(
         "--fontfile", "-ff", type=str, help=f"import theme font from custom .ttf file"
@@ -835,8 +2057,21 @@ def parse_args():
         "--fontsize",
         "-fs",
         type=int,
-        help=f"theme font size",
-        default=THEME_DEFAULT_FONT_SIZE,
+        nargs="+",
+        help=f"theme font size, extra sizes are also built and shipped as font_<size>.pf2",
+        default=[THEME_DEFAULT_FONT_SIZE],
+    )
+    parser.add_argument(
+        "--fontsubset",
+        "-fss",
+        type=str,
+        nargs="?",
+        const="ascii",
+        help=(
+            f"only include in the font the characters of the grub entries and theme texts,\n"
+            f"plus a safety margin of extra characters: none, ascii (default) or latin1"
+        ),
+        choices=list(FONT_SUBSET_MARGINS),
     )
     parser.add_argument(
         "--configicons",
@@ -844,6 +2079,37 @@ def parse_args():
         action="store_true",
         help="set grub entries icons using config file. "
     )
+    parser.add_argument(
+        "--hookmode",
+        "-hm",
+        type=str,
+        help=(
+            f"how icons persist between grub updates: append a --configicons call to\n"
+            f"grub-mkconfig that patches grub.cfg after it is written (default), or\n"
+            f"filter the grub-mkconfig output so grub.cfg is written once with its icons"
+        ),
+        default="append",
+        choices=["append", "filter"],
+    )
+    parser.add_argument(
+        "--filtericons",
+        "-fi",
+        action="store_true",
+        help=f"copy a grub.cfg from stdin to stdout setting the config file icons, see --hookmode",
+    )
+    parser.add_argument(
+        "--mdicdn",
+        "-cdn",
+        type=str,
+        help=f"base url to download icon svgs from, can be a local mirror directory or file:// url",
+        default=MDI_CDN,
+    )
+    parser.add_argument(
+        "--importmdi",
+        "-imdi",
+        type=str,
+        help=f"import icons from a MaterialDesign-SVG release archive (tar or zip) for offline use",
+    )
     parser.add_argument(
         "--downloadbackground",
         "-dlbg",
@@ -853,23 +2119,53 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == "__main__":
+def main():
+    global user_args
     try:
         check_python_version()
         user_args = parse_args()
-
-        if user_args.listentries:
+        check_boot_grub_path()
+        if user_args.profile is not None:
+            profiler.enable()
+
+        if user_args.applyplan:
+            do_apply_plan(user_args.applyplan)
+            exit(0)  # The user process that made the plan does the rest
+        elif user_args.importmdi:
+            do_import_mdi_archive(user_args.importmdi)
+        elif user_args.searchicons:
+            do_search_icons(" ".join(user_args.searchicons))
+        elif user_args.suggest:
+            do_suggest_icons()
+        elif user_args.listentries:
             do_list_grub_cfg_entries()
         elif user_args.buildonly:
+            if user_args.artifact and user_args.fontsubset is not None:
+                error(
+                    "--fontsubset can't be used with --artifact",
+                    "The subset would only cover the grub entries of this machine",
+                )
             prepare_source_dir()
+            if user_args.artifact:
+                do_build_artifact(user_args.artifact)
+        elif user_args.installartifact:
+            do_install_artifact(user_args.installartifact)
+        elif user_args.verify:
+            do_verify()
         elif user_args.seticons_once:
             do_set_icons(patch_grubcfg=False)
         elif user_args.seticons:
             do_set_icons(patch_grubcfg=True)
         elif user_args.uninstall:
             do_uninstall()
+        elif user_args.filtericons:
+            do_filter_icons()
         elif user_args.configicons:
             patch_from_config_file()
+            if user_args.hookmode == "filter":
+                hook_grub_mkconfig()  # Hooked back by 99_matter after a grub upgrade
+        elif user_args.preview and user_args.icons is None:
+            pass  # Only preview the last build, see below
         elif user_args.icons is None:
             do_preinstall_hint()
         else:
@@ -877,6 +2173,18 @@ if __name__ == "__main__":
 
         if user_args.test:
                 do_test()
+        if user_args.preview:
+            do_preview(user_args.preview)
+
+        if profiler.enabled:
+            print(profiler.format_report(), file=sys.stderr)
+            if user_args.profile:
+                profiler.write_report(user_args.profile)
+                info(f"Profile saved to {user_args.profile}")
     except KeyboardInterrupt:
         error("Stop. Script halted by user")
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Local store of Material Design Icons imported from an MDI-SVG release archive.
+
+Importing concatenates every svg of the archive into a single pack file and
+writes an index with the offset and length of each icon, so an icon is read
+with one slice of the memory mapped pack instead of unpacking thousands of
+small files. The archive meta.json (names, aliases, tags) is kept next to it.
+"""
+
+import os
+import json
+import mmap
+import tarfile
+import zipfile
+
+PACK_VERSION = 1
+
+
+class PackError(Exception):
+    "The archive or the pack could not be read"
+
+
+def iter_archive(archive_path):
+    "Yields (member name, read function) for the files of a tar or zip archive"
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    yield member.filename, lambda member=member: archive.read(member)
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            for member in archive:  # Streams compressed tars in a single pass
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read
+    else:
+        raise PackError(f"{archive_path} is not a tar or zip archive")
+
+
+def import_archive(archive_path, pack_path, index_path, meta_path):
+    """Imports the svg/*.svg icons and meta.json of an archive, returns the icon count.
+
+    Files are replaced only once the import succeeded.
+    """
+    icons = {}
+    meta = None
+    temp_pack_path = f"{pack_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_pack_path, "wb") as pack:
+            for name, read in iter_archive(archive_path):
+                parent, filename = os.path.split(name)
+                if os.path.basename(parent) == "svg" and filename.endswith(".svg"):
+                    data = read()
+                    icons[filename[:-4]] = [pack.tell(), len(data)]
+                    pack.write(data)
+                elif filename == "meta.json":
+                    meta = read()
+        if not icons:
+            raise PackError(f"No svg/*.svg icons found in {archive_path}")
+        os.replace(temp_pack_path, pack_path)
+    finally:
+        if os.path.exists(temp_pack_path):
+            os.remove(temp_pack_path)
+
+    if meta is not None:
+        with open(meta_path, "wb") as f:
+            f.write(meta)
+    index = {
+        "version": PACK_VERSION,
+        "source": os.path.basename(archive_path),
+        "icons": icons,
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+    return len(icons)
+
+
+class IconPack:
+    "Read access to an imported pack, the index and the mapping are loaded lazily"
+
+    def __init__(self, pack_path, index_path):
+        self.pack_path = pack_path
+        self.index_path = index_path
+        self._icons = None
+        self._data = None
+
+    @property
+    def icons(self):
+        "Dict of icon name to (offset, length), empty if nothing was imported"
+        if self._icons is None:
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            valid = index.get("version") == PACK_VERSION
+            self._icons = index["icons"] if valid else {}
+        return self._icons
+
+    def has(self, name):
+        return name in self.icons
+
+    def read(self, name):
+        "Returns the svg bytes of the icon name, raises KeyError if not in the pack"
+        offset, length = self.icons[name]
+        if self._data is None:
+            with open(self.pack_path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if offset + length > len(self._data):
+            raise PackError(f"{self.pack_path} is truncated, import the archive again")
+        return self._data[offset:offset + length]
+
+    def extract(self, name, dst_path):
+        "Writes the svg of icon name to dst_path, returns False if not in the pack"
+        if not self.has(name):
+            return False
+        with open(dst_path, "wb") as f:
+            f.write(self.read(name))
+        return True
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Lossless PNG optimizer for the theme assets.
+
+Every image is decoded and encoded again without ancillary chunks (text,
+XMP metadata, etc.) in the smallest color type that represents its pixels
+exactly, trying each zlib strategy and keeping the smallest result.
+
+GRUB's PNG reader does not decode indexed (palette) images, so colors are
+only reduced to grayscale or without alpha when that is exact, never to a
+palette.
+"""
+
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from cache import FileCache, hash_key, hash_file
+
+OPTIMIZER_VERSION = 1  # Bump to invalidate cached results
+# zlib strategies: default, filtered, huffman only, rle and fixed
+ZLIB_STRATEGIES = (0, 1, 2, 3, 4)
+EXACT_MODES = ("1", "L", "LA", "P", "PA", "RGB", "RGBA")  # 8 bit or less per channel
+
+
+def reduce_mode(im):
+    "Returns im in the smallest mode among L, LA, RGB and RGBA holding it exactly"
+    im = im.convert("RGBA")
+    alpha = im.getchannel("A")
+    is_opaque = alpha.getextrema() == (255, 255)
+    red, green, blue = im.getchannel("R"), im.getchannel("G"), im.getchannel("B")
+    is_gray = red.tobytes() == green.tobytes() == blue.tobytes()
+    if is_gray:
+        return red if is_opaque else Image.merge("LA", (red, alpha))
+    return im.convert("RGB") if is_opaque else im
+
+
+def encode(im, strategy):
+    buffer = io.BytesIO()
+    im.save(buffer, "PNG", compress_level=9, compress_type=strategy)
+    return buffer.getvalue()
+
+
+def optimize(data):
+    "Returns the smallest lossless encoding of the png data, data itself if none is"
+    with Image.open(io.BytesIO(data)) as im:
+        if im.mode not in EXACT_MODES:
+            return data  # e.g. 16 bit images, converting them would lose depth
+        im = reduce_mode(im)
+    candidates = [encode(im, strategy) for strategy in ZLIB_STRATEGIES]
+    return min(candidates + [data], key=len)
+
+
+def optimize_file(path, cache):
+    "Optimizes the png at path in place, returns its (old, new) sizes"
+    input_key = hash_key(str(OPTIMIZER_VERSION), hash_file(path))
+    size = os.path.getsize(path)
+    if cache.get(input_key, path):
+        return size, os.path.getsize(path)
+
+    with open(path, "rb") as f:
+        data = f.read()
+    optimized = optimize(data)
+    if optimized is not data:
+        # Replace instead of writing through, path may be a link to a cache
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(optimized)
+        os.replace(temp_path, path)
+    cache.put(input_key, path)
+    # Optimizing again gives the same file, remember it is already optimal
+    cache.put(hash_key(str(OPTIMIZER_VERSION), hash_file(path)), path)
+    return size, len(optimized)
+
+
+def optimize_files(paths, cache_dir, cache_max_bytes, workers=None):
+    """Optimizes the pngs at paths concurrently, returns their total (old, new) sizes.
+
+    Results are cached by input hash so only new or changed images are
+    optimized.
+    """
+    cache = FileCache(cache_dir, cache_max_bytes, suffix=".png")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(lambda path: optimize_file(path, cache), paths))
+    return sum(old for old, _ in sizes), sum(new for _, new in sizes)
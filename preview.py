@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+"""
+Headless preview of a built theme, see --preview.
+
+theme.txt is parsed and its boot_menu and label components are laid out the
+way grub does: the background, the selected entry pixmap box, icons and
+texts are composited with PIL. It approximates the real thing, grub still has
+the last word, but takes milliseconds instead of booting a VM. Only one
+statement per line is understood, as theme.txt.template generates.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+# A menu entry to show, icon is the path of its png or None
+Item = namedtuple("Item", ["name", "icon"])
+
+PROPERTY = re.compile(r'^\s*([\w-]+)\s*[:=]\s*(?:"([^"]*)"|([^\s#]+))')
+COMPONENT = re.compile(r"^\s*\+\s*(\w+)\s*\{")
+CLOSE = re.compile(r"^\s*\}")
+LENGTH_TERM = re.compile(r"([+-]?)\s*(\d+(?:\.\d+)?)(%?)")
+FONT_SIZE = re.compile(r"(\d+)\s*$")  # e.g. "Josefin Sans Regular 32"
+PIXMAP_PARTS = ("nw", "n", "ne", "w", "c", "e", "sw", "s", "se")
+
+# grub defaults for the properties theme.txt.template leaves out
+MENU_DEFAULTS = {
+    "item_height": "42",
+    "item_spacing": "14",
+    "icon_width": "32",
+    "icon_height": "32",
+    "item_icon_space": "4",
+    "item_color": "black",
+    "selected_item_color": "black",
+}
+LABEL_DEFAULTS = {"left": "0", "top": "0", "width": "100%", "align": "left", "color": "black"}
+
+
+def parse_theme(text):
+    """Returns the global properties and the (type, properties) of each component.
+
+    Components are listed in document order, nested ones included.
+    """
+    properties, components, stack = {}, [], []
+    for line in text.splitlines():
+        component = COMPONENT.match(line)
+        if component:
+            stack.append((component.group(1), {}))
+            components.append(stack[-1])
+            continue
+        if CLOSE.match(line):
+            if stack:
+                stack.pop()
+            continue
+        match = PROPERTY.match(line)
+        if match:
+            value = match.group(2) if match.group(2) is not None else match.group(3)
+            (stack[-1][1] if stack else properties)[match.group(1)] = value
+    return properties, components
+
+
+def parse_length(value, total):
+    "Returns the pixels of a grub length like 100, 36% or 50%-20 relative to total"
+    pixels = 0.0
+    for sign, number, percent in LENGTH_TERM.findall(value):
+        length = float(number) * total / 100 if percent else float(number)
+        pixels += -length if sign == "-" else length
+    return int(pixels)
+
+
+def load_font(font_path, font_name):
+    "Returns the font at font_path in the size of the grub font_name, or PIL's default"
+    match = FONT_SIZE.search(font_name or "")
+    size = int(match.group(1)) if match else 16
+    if font_path is not None and os.path.exists(font_path):
+        return ImageFont.truetype(font_path, size)
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # Pillow < 10.1 has a single size
+        return ImageFont.load_default()
+
+
+def draw_pixmap_box(canvas, theme_dir, pattern, box):
+    """Draws the 9-slice pixmaps of pattern (e.g. select_*.png) around box.
+
+    box is the (left, top, right, bottom) content area, the sides and corners
+    are drawn outside of it and the center is stretched to fill it.
+    """
+    parts = {}
+    for part in PIXMAP_PARTS:
+        path = os.path.join(theme_dir, pattern.replace("*", part))
+        if os.path.exists(path):
+            with Image.open(path) as im:
+                parts[part] = im.convert("RGBA")
+    if not parts:
+        return
+
+    def size(part, index):
+        return parts[part].size[index] if part in parts else 0
+
+    left, top, right, bottom = box
+    xs = (left - size("w", 0), left, right, right + size("e", 0))
+    ys = (top - size("n", 1), top, bottom, bottom + size("s", 1))
+    for i, part in enumerate(PIXMAP_PARTS):
+        column, row = i % 3, i // 3
+        width, height = xs[column + 1] - xs[column], ys[row + 1] - ys[row]
+        if part in parts and width > 0 and height > 0:
+            im = parts[part].resize((width, height), Image.NEAREST)
+            canvas.alpha_composite(im, (xs[column], ys[row]))
+
+
+def render_boot_menu(canvas, theme_dir, menu, items, selected, font_path):
+    screen_width, screen_height = canvas.size
+    menu = dict(MENU_DEFAULTS, **menu)
+    left = parse_length(menu.get("left", "0"), screen_width)
+    top = parse_length(menu.get("top", "0"), screen_height)
+    width = parse_length(menu.get("width", "100%"), screen_width)
+    height = parse_length(menu.get("height", "100%"), screen_height)
+    item_height = int(menu["item_height"])
+    item_spacing = int(menu["item_spacing"])
+    icon_width, icon_height = int(menu["icon_width"]), int(menu["icon_height"])
+    font = load_font(font_path, menu.get("item_font"))
+    ascent, descent = font.getmetrics()
+    draw = ImageDraw.Draw(canvas)
+
+    visible = max(1, (height + item_spacing) // (item_height + item_spacing))
+    item_top = top
+    for i, item in enumerate(items[:visible]):
+        is_selected = i == selected
+        if is_selected and "selected_item_pixmap_style" in menu:
+            box = (left, item_top, left + width, item_top + item_height - 1)
+            draw_pixmap_box(canvas, theme_dir, menu["selected_item_pixmap_style"], box)
+        if item.icon is not None:
+            with Image.open(item.icon) as im:
+                icon = im.convert("RGBA").resize((icon_width, icon_height), Image.BILINEAR)
+            canvas.alpha_composite(icon, (left, item_top + (item_height - icon_height) // 2))
+        color = menu["selected_item_color" if is_selected else "item_color"]
+        baseline = item_top + (item_height - (ascent + descent)) // 2 + ascent
+        text_left = left + icon_width + int(menu["item_icon_space"])
+        draw.text((text_left, baseline), item.name, fill=color, font=font, anchor="ls")
+        item_top += item_height + item_spacing
+
+
+def render_label(canvas, label, font_path, timeout):
+    screen_width, screen_height = canvas.size
+    label = dict(LABEL_DEFAULTS, **label)
+    left = parse_length(label["left"], screen_width)
+    top = parse_length(label["top"], screen_height)
+    width = parse_length(label["width"], screen_width)
+    text = label.get("text", "").replace("%d", str(timeout))
+    font = load_font(font_path, label.get("font"))
+    draw = ImageDraw.Draw(canvas)
+    text_width = draw.textlength(text, font=font)
+    if label["align"] == "center":
+        left += (width - text_width) / 2
+    elif label["align"] == "right":
+        left += width - text_width
+    draw.text((left, top), text, fill=label["color"], font=font, anchor="la")
+
+
+def render(theme_path, items, resolution, font_path=None, timeout=5, selected=0):
+    """Returns the preview image of the theme at theme_path and the skipped components.
+
+    items are the top level menu entries as Item, font_path the ttf the
+    theme fonts were built from and timeout the seconds shown by labels.
+    """
+    theme_dir = os.path.dirname(theme_path)
+    with open(theme_path) as f:
+        properties, components = parse_theme(f.read())
+
+    color = ImageColor.getrgb(properties.get("desktop-color", "black"))
+    canvas = Image.new("RGBA", resolution, color)
+    image_path = properties.get("desktop-image")
+    if image_path and os.path.exists(os.path.join(theme_dir, image_path)):
+        with Image.open(os.path.join(theme_dir, image_path)) as im:
+            canvas.alpha_composite(im.convert("RGBA").resize(resolution, Image.BILINEAR))
+
+    skipped = []
+    for kind, component in components:
+        if kind == "boot_menu":
+            render_boot_menu(canvas, theme_dir, component, items, selected, font_path)
+        elif kind == "label":
+            render_label(canvas, component, font_path, timeout)
+        else:
+            skipped.append(kind)
+    return canvas.convert("RGB"), skipped
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Per phase timing and resource usage of a matter.py run, see --profile.
+
+Phases measure wall time, process CPU time (all threads), CPU time of child
+processes (e.g. inkscape, grub-mkfont) and the peak RSS reached so far.
+Items break a phase down, e.g. per icon, with their wall time only. The
+process counters are shared, so phases that overlap with background work
+also account for it.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+def get_peak_rss_kib():
+    "Peak resident set size in KiB of this process and its waited children"
+    import resource
+
+    usage = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return usage  # Already KiB on Linux
+
+
+def get_counters():
+    times = os.times()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": times.user + times.system,
+        "children": times.children_user + times.children_system,
+    }
+
+
+class Profiler:
+    "Records phases and items when enabled, otherwise does (almost) nothing"
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self.lock = threading.Lock()  # Items are added from worker threads
+        self.start = get_counters() if enabled else None
+
+    def enable(self):
+        self.enabled = True
+        self.start = get_counters()
+
+    @contextmanager
+    def phase(self, name):
+        "Measures the enclosed code as the phase name"
+        if not self.enabled:
+            yield
+            return
+        phase = self.get_phase(name)
+        start = get_counters()
+        try:
+            yield
+        finally:
+            end = get_counters()
+            with self.lock:
+                for counter in ("wall", "cpu", "children"):
+                    phase[counter] += end[counter] - start[counter]
+                phase["peak_rss_kib"] = get_peak_rss_kib()
+
+    def get_phase(self, name):
+        with self.lock:
+            for phase in self.phases:
+                if phase["name"] == name:
+                    return phase
+            phase = {
+                "name": name,
+                "wall": 0.0,
+                "cpu": 0.0,
+                "children": 0.0,
+                "peak_rss_kib": 0,
+                "items": [],
+            }
+            self.phases.append(phase)
+            return phase
+
+    def item(self, phase_name, name, wall):
+        "Records wall seconds spent on name as part of phase_name"
+        if not self.enabled:
+            return
+        phase = self.get_phase(phase_name)
+        with self.lock:
+            phase["items"].append({"name": name, "wall": wall})
+
+    @contextmanager
+    def timed_item(self, phase_name, name):
+        "Measures the enclosed code as the item name of phase_name"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.item(phase_name, name, time.perf_counter() - start)
+
+    def merge(self, report):
+        "Adds the phases of a report of another process, e.g. the root one of an install"
+        for other in report["phases"]:
+            phase = self.get_phase(other["name"])
+            with self.lock:
+                for counter in ("wall", "cpu", "children"):
+                    phase[counter] += other[counter]
+                phase["peak_rss_kib"] = max(phase["peak_rss_kib"], other["peak_rss_kib"])
+                phase["items"].extend(other["items"])
+
+    def report(self):
+        "Returns the recorded profile as a json serializable dict"
+        end = get_counters()
+        total = {
+            counter: end[counter] - self.start[counter]
+            for counter in ("wall", "cpu", "children")
+        }
+        total["peak_rss_kib"] = get_peak_rss_kib()
+        return {"phases": self.phases, "total": total}
+
+    def format_report(self, max_items=10):
+        "Returns the report as a table, showing the slowest items of each phase"
+        report = self.report()
+        header = f"{'phase':<24}{'wall s':>9}{'cpu s':>9}{'child s':>9}{'peak MiB':>10}"
+        lines = [header, "-" * len(header)]
+        rows = report["phases"] + [dict(report["total"], name="total", items=[])]
+        for row in rows:
+            lines.append(
+                f"{row['name']:<24}{row['wall']:>9.3f}{row['cpu']:>9.3f}"
+                f"{row['children']:>9.3f}{row['peak_rss_kib'] / 1024:>10.1f}"
+            )
+            items = sorted(row["items"], key=lambda item: -item["wall"])
+            for item in items[:max_items]:
+                lines.append(f"  {item['name'][:22]:<22}{item['wall']:>9.3f}")
+            if len(items) > max_items:
+                lines.append(f"  ... {len(items) - max_items} more")
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -2,47 +2,50 @@
 
 import os
 import re
+import math
+import tempfile
 import xml.etree.ElementTree as ET
-import xml.dom.minidom
+from functools import lru_cache
+from subprocess import run, DEVNULL
+try:
+    from PIL import Image
+except:
+    has_PIL = False
+else:
+    has_PIL = True
 
 # Local Matter modules
-from utils import sh, shout, error
+from utils import shout, error
 
+FRAC = 0.6  # Fraction of the png the icon takes, the rest is padding
+ICON_SIZE = 72
+BUILTIN_VERSION = 2  # Bump when the builtin rasterizer output changes
+BUILTIN_SUPERSAMPLING = 4  # Subpixels per pixel side for antialiasing
+BUILTIN_CURVE_SEGMENTS = 16
 
-def inkscape_convert_svg2png(color, src_path, dst_path, whisper=False):
+
+def parse_with_map(source):
+    """Parses file, returns a tuple containing the parsed ElementTree and a namespace map (dict).
+
+    The ElementTree object returned is the same as if parsed using xml.etree.ElementTree.parse. For
+    some reason, ElementTree objects by the xml package will not provide a namespace map, unlike the
+    lxml package.
+    """
+
+    root = None
+    ns_map = []
+    for event, node in ET.iterparse(source, events=["start-ns", "start"]):
+        if event == "start-ns":
+            ns_map.append(node)
+        elif event == "start":
+            if root is None:
+                root = node
+    return (ET.ElementTree(root), dict(ns_map))
+
+
+def recolor_svg(color, src_path):
+    "Returns the svg at src_path as a string, filled with color and padded by FRAC"
     # SVG_URI = "http://www.w3.org/2000/svg"
-    FRAC = 0.6
-    TEMPFILE = "temp.svg"
-
-    def parse_with_map(source):
-        """Parses file, returns a tuple containing the parsed ElementTree and a namespace map (dict).
-
-        The ElementTree object returned is the same as if parsed using xml.etree.ElementTree.parse. For
-        some reason, ElementTree objects by the xml package will not provide a namespace map, unlike the
-        lxml package.
-        """
-
-        root = None
-        ns_map = []
-        for event, node in ET.iterparse(source, events=["start-ns", "start"]):
-            if event == "start-ns":
-                ns_map.append(node)
-            elif event == "start":
-                if root is None:
-                    root = node
-        return (ET.ElementTree(root), dict(ns_map))
-
-    def int_ignore_units(s):
-        return int("".join(ch for ch in s if ch.isdigit()))
-
-    def prettify(xml_string):
-        return "\n".join(
-            line
-            for line in xml.dom.minidom.parseString(xml_string)
-            .toprettyxml(indent="  ")
-            .splitlines()
-            if not line.isspace() and line != ""
-        )
 
     # Fixes undefined namespace tags in output xml (not a big issue)
     dom, ns_map = parse_with_map(src_path)
@@ -73,28 +76,99 @@ def inkscape_convert_svg2png(color, src_path, dst_path, whisper=False):
     # Shrink the svg by a factor of FRAC for padding around icon
     group.attrib["transform"] = f"matrix({FRAC},0,0,{FRAC},{width_gap},{height_gap})"
 
-    xml_string = ET.tostring(root).decode()
-    xml_string = prettify(xml_string)
-    with open(TEMPFILE, "w") as f:
-        f.write(xml_string)
-
-    # Check inkscape version
-    version_string = shout("inkscape --version 2>/dev/null", silence=whisper)
-    inkscape_major = re.search(r"(\d+)\.\d+(\.\d+)?", version_string).group(1)
-    command = "inkscape "
-    if inkscape_major == "1":
-        command += f"--export-filename={dst_path} "
-    elif inkscape_major == "0":
-        command += f"--without-gui --export-png={dst_path} "
+    return ET.tostring(root, encoding="unicode")
+
+
+@lru_cache(maxsize=None)
+def inkscape_version():
+    "Probes `inkscape --version` once per run and returns a (major, minor) tuple"
+    version_string = shout("inkscape --version 2>/dev/null", silence=True)
+    match = re.search(r"(\d+)\.(\d+)(\.\d+)?", version_string)
+    if match is None:
+        error("Could not parse inkscape version", version_string)
+    return int(match.group(1)), int(match.group(2))
+
+
+def inkscape_convert_svg2png(color, src_path, dst_path, whisper=False):
+    "Exports one recolored icon, the svg is piped through stdin"
+    major, _ = inkscape_version()
+    if major == 1:
+        command = [
+            "inkscape", "--pipe", "--export-type=png",
+            f"--export-filename={dst_path}", f"--export-width={ICON_SIZE}",
+        ]
+    elif major == 0:
+        command = [
+            "inkscape", "--without-gui", f"--export-png={dst_path}",
+            f"--export-width={ICON_SIZE}", "/dev/stdin",
+        ]
     else:
         error("Unsupported inkscape version")
-    command += f"-w 72 {TEMPFILE}"
-    if whisper:
-        command += " 2>&1 | tail -1"
-    exit_code = sh(command)
+    svg = recolor_svg(color, src_path)
+    stdout = DEVNULL if whisper else None
+    return run(command, input=svg.encode(), stdout=stdout, stderr=stdout).returncode
+
+
+def inkscape_batch_convert_svg2png(color, jobs, whisper=False):
+    """Exports every (src_path, dst_path) in jobs from a single `inkscape --shell`.
+
+    Inkscape is started once for the whole batch instead of twice per icon.
+    Shell mode can only open documents by path, so the recolored svgs are
+    written once to a private temporary directory that lives for the batch.
+    Returns the list of jobs whose png could not be exported.
+    """
+    major, minor = inkscape_version()
+    if major not in (0, 1):
+        error("Unsupported inkscape version")
+
+    with tempfile.TemporaryDirectory(prefix="matter-") as tempdir:
+        lines = []
+        for i, (src_path, dst_path) in enumerate(jobs):
+            svg_path = f"{tempdir}/{i}.svg"
+            with open(svg_path, "w") as f:
+                f.write(recolor_svg(color, src_path))
+            if os.path.exists(dst_path):
+                os.remove(dst_path)  # So that failed exports can be detected
+            if major == 1:
+                actions = [
+                    f"file-open:{svg_path}",
+                    "export-type:png",
+                    f"export-filename:{dst_path}",
+                    f"export-width:{ICON_SIZE}",
+                    "export-do",
+                ]
+                if minor >= 1:  # Older shells keep every document open
+                    actions.append("file-close")
+                lines.append("; ".join(actions))
+            else:
+                lines.append(f'"{svg_path}" --export-png="{dst_path}" -w {ICON_SIZE}')
+        lines.append("quit")
+
+        stdout = DEVNULL if whisper else None
+        run(
+            ["inkscape", "--shell"],
+            input="\n".join(lines).encode(),
+            stdout=stdout,
+            stderr=stdout,
+        )
+    return [job for job in jobs if not os.path.exists(job[1])]
+
+
+@lru_cache(maxsize=None)
+def magick_version():
+    "Probes `convert -version` once per run and returns its first line"
+    return shout("convert -version 2>/dev/null", silence=True).partition("\n")[0]
+
 
-    os.remove(TEMPFILE)
-    return exit_code
+def magick_arguments(color, src_path, dst_path):
+    "ImageMagick operations that turn src_path into the icon png at dst_path"
+    return [
+        "-density", "300", "-background", "none", src_path,
+        "-trim", "-scale", "36x36", "-gravity", "center", "-extent", "72x72",
+        "-colorspace", "sRGB", "-channel", "RGB", "-threshold", "-1",
+        "-fill", color, "+opaque", "none", "+channel",
+        "-define", "png:color-type=6", "-write", dst_path,
+    ]
 
 
 def magick_convert_svg2png(color, src_path, dst_path, whisper=None):
@@ -107,10 +181,292 @@ def magick_convert_svg2png(color, src_path, dst_path, whisper=None):
     return os.system(cmd)
 
 
+def magick_batch_convert_svg2png(color, jobs, whisper=False):
+    """Converts every (src_path, dst_path) in jobs with a single `convert` call.
+
+    Each icon is processed in its own parenthesized image sequence that is
+    written and then discarded. Returns the list of jobs that failed.
+    """
+    command = ["convert"]
+    for src_path, dst_path in jobs:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        command += ["(", *magick_arguments(color, src_path, dst_path), "+delete", ")"]
+    command += ["xc:none", "null:"]
+    stdout = DEVNULL if whisper else None
+    run(command, stdout=stdout, stderr=stdout)
+    return [job for job in jobs if not os.path.exists(job[1])]
+
+
+# Builtin rasterizer for single color svgs made of plain paths such as MDI icons
+
+PATH_TOKEN = re.compile(
+    r"[\s,]*(?:([MmLlHhVvCcSsQqTtAaZz])|([-+]?(?:\d*\.\d+|\d+\.?)(?:[eE][-+]?\d+)?))"
+)
+PATH_FLAG = re.compile(r"[\s,]*([01])")
+PATH_ARGUMENTS = dict(M=2, L=2, H=1, V=1, C=6, S=4, Q=4, T=2, A=7, Z=0)
+
+
+def parse_path_commands(d):
+    "Yields (command, arguments) from svg path data, repeated commands are split"
+    pos, command = 0, None
+    d = d.rstrip()
+    while pos < len(d):
+        match = PATH_TOKEN.match(d, pos)
+        if match is None:
+            raise ValueError(f"Invalid path data at {d[pos:pos + 10]!r}")
+        if match.group(1):
+            command = match.group(1)
+            pos = match.end()
+        elif command is None:
+            raise ValueError("Path data does not start with a command")
+        count = PATH_ARGUMENTS[command.upper()]
+        arguments = []
+        for i in range(count):
+            # Arc flags are single digits that may be written without separators
+            pattern = PATH_FLAG if command in "Aa" and i in (3, 4) else PATH_TOKEN
+            match = pattern.match(d, pos)
+            if match is None or (pattern is PATH_TOKEN and not match.group(2)):
+                raise ValueError(f"Missing {command} arguments at {d[pos:pos + 10]!r}")
+            arguments.append(float(match.group(match.lastindex)))
+            pos = match.end()
+        yield command, arguments
+        if count == 0:
+            command = None
+        elif command == "M":
+            command = "L"  # Extra moveto coordinates are implicit linetos
+        elif command == "m":
+            command = "l"
+
+
+def arc_points(x1, y1, rx, ry, phi, large_arc, sweep, x2, y2):
+    "Flattens an svg endpoint-parameterized arc, see SVG 1.1 implementation notes F.6"
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0:
+        return [(x2, y2)]
+    phi = math.radians(phi)
+    cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+    dx, dy = (x1 - x2) / 2, (y1 - y2) / 2
+    x1p = cos_phi * dx + sin_phi * dy
+    y1p = -sin_phi * dx + cos_phi * dy
+    scale = x1p ** 2 / rx ** 2 + y1p ** 2 / ry ** 2
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    numerator = rx ** 2 * ry ** 2 - rx ** 2 * y1p ** 2 - ry ** 2 * x1p ** 2
+    denominator = rx ** 2 * y1p ** 2 + ry ** 2 * x1p ** 2
+    coef = math.sqrt(max(0, numerator / denominator)) if denominator else 0
+    if large_arc == sweep:
+        coef = -coef
+    cxp, cyp = coef * rx * y1p / ry, -coef * ry * x1p / rx
+    cx = cos_phi * cxp - sin_phi * cyp + (x1 + x2) / 2
+    cy = sin_phi * cxp + cos_phi * cyp + (y1 + y2) / 2
+
+    def angle(ux, uy, vx, vy):
+        return math.atan2(ux * vy - uy * vx, ux * vx + uy * vy)
+
+    theta = angle(1, 0, (x1p - cxp) / rx, (y1p - cyp) / ry)
+    delta = angle((x1p - cxp) / rx, (y1p - cyp) / ry, (-x1p - cxp) / rx, (-y1p - cyp) / ry)
+    if not sweep and delta > 0:
+        delta -= 2 * math.pi
+    elif sweep and delta < 0:
+        delta += 2 * math.pi
+
+    segments = max(2, math.ceil(abs(delta) / (math.pi / BUILTIN_CURVE_SEGMENTS)))
+    points = []
+    for i in range(1, segments + 1):
+        t = theta + delta * i / segments
+        x, y = rx * math.cos(t), ry * math.sin(t)
+        points.append((cos_phi * x - sin_phi * y + cx, sin_phi * x + cos_phi * y + cy))
+    return points
+
+
+def flatten_path(d):
+    "Returns the subpaths of svg path data as lists of (x, y) polygon points"
+    subpaths, points = [], []
+    x = y = start_x = start_y = 0.0
+    control = None  # Last control point for the S and T smooth curves
+    previous = None
+    n = BUILTIN_CURVE_SEGMENTS
+
+    for command, args in parse_path_commands(d):
+        relative = command.islower()
+        command = command.upper()
+        ox, oy = (x, y) if relative else (0.0, 0.0)
+        if command == "M":
+            if len(points) > 1:
+                subpaths.append(points)
+            x, y = ox + args[0], oy + args[1]
+            start_x, start_y = x, y
+            points = [(x, y)]
+        elif command == "L":
+            x, y = ox + args[0], oy + args[1]
+            points.append((x, y))
+        elif command == "H":
+            x = ox + args[0]
+            points.append((x, y))
+        elif command == "V":
+            y = oy + args[0]
+            points.append((x, y))
+        elif command in "CS":
+            if command == "C":
+                x1, y1 = ox + args[0], oy + args[1]
+                x2, y2, ex, ey = ox + args[2], oy + args[3], ox + args[4], oy + args[5]
+            else:
+                reflect = control is not None and previous in "CS"
+                x1, y1 = (2 * x - control[0], 2 * y - control[1]) if reflect else (x, y)
+                x2, y2, ex, ey = ox + args[0], oy + args[1], ox + args[2], oy + args[3]
+            for i in range(1, n + 1):
+                t = i / n
+                a, b, c, e = (1 - t) ** 3, 3 * (1 - t) ** 2 * t, 3 * (1 - t) * t ** 2, t ** 3
+                points.append(
+                    (a * x + b * x1 + c * x2 + e * ex, a * y + b * y1 + c * y2 + e * ey)
+                )
+            control = (x2, y2)
+            x, y = ex, ey
+        elif command in "QT":
+            if command == "Q":
+                x1, y1, ex, ey = ox + args[0], oy + args[1], ox + args[2], oy + args[3]
+            else:
+                reflect = control is not None and previous in "QT"
+                x1, y1 = (2 * x - control[0], 2 * y - control[1]) if reflect else (x, y)
+                ex, ey = ox + args[0], oy + args[1]
+            for i in range(1, n + 1):
+                t = i / n
+                a, b, c = (1 - t) ** 2, 2 * (1 - t) * t, t ** 2
+                points.append((a * x + b * x1 + c * ex, a * y + b * y1 + c * ey))
+            control = (x1, y1)
+            x, y = ex, ey
+        elif command == "A":
+            ex, ey = ox + args[5], oy + args[6]
+            points += arc_points(x, y, *args[:5], ex, ey)
+            x, y = ex, ey
+        elif command == "Z":
+            if len(points) > 1:
+                subpaths.append(points)
+            x, y = start_x, start_y
+            points = [(x, y)]
+        if command not in "CSQT":
+            control = None
+        previous = command
+    if len(points) > 1:
+        subpaths.append(points)
+    return subpaths
+
+
+def rasterize_polygons(polygons, size, nonzero=True, mask=None):
+    """Scanline fills the closed polygons into a bytearray coverage mask of size x size.
+
+    Filling into the mask of a previous call unites both shapes, so each
+    svg element can be drawn with its own fill rule.
+    """
+    rows = [[] for _ in range(size)]  # Edges starting at each row
+    for polygon in polygons:
+        for (x0, y0), (x1, y1) in zip(polygon, polygon[1:] + polygon[:1]):
+            if y0 == y1:
+                continue
+            direction = 1 if y1 > y0 else -1
+            if y0 > y1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            # Rows whose pixel centers lie in [y0, y1)
+            first, last = max(0, math.ceil(y0 - 0.5)), min(size, math.ceil(y1 - 0.5))
+            if first >= last:
+                continue
+            slope = (x1 - x0) / (y1 - y0)
+            x = x0 + (first + 0.5 - y0) * slope
+            rows[first].append([x, slope, last, direction])
+
+    if mask is None:
+        mask = bytearray(size * size)
+    full = b"\xff" * size
+    active = []
+    for row in range(size):
+        active = [edge for edge in active if edge[2] > row] + rows[row]
+        if not active:
+            continue
+        crossings = sorted((edge[0], edge[3]) for edge in active)
+        offset = row * size
+        winding = 0
+        for (x, direction), (next_x, _) in zip(crossings, crossings[1:] + crossings[:1]):
+            winding += direction if nonzero else 1
+            inside = winding != 0 if nonzero else winding % 2 == 1
+            if inside:
+                start = min(size, max(0, math.ceil(x - 0.5)))
+                end = min(size, max(0, math.ceil(next_x - 0.5)))
+                if end > start:
+                    mask[offset + start:offset + end] = full[: end - start]
+        for edge in active:
+            edge[0] += edge[1]
+    return mask
+
+
+def get_fill_rule(element, root):
+    "Returns the fill-rule of a path, set by its style or attribute or inherited from <svg>"
+    for node in (element, root):
+        style = node.attrib.get("style", "").replace(" ", "")
+        match = re.search(r"(?:^|;)fill-rule:(\w+)", style)
+        if match:
+            return match.group(1)
+        if "fill-rule" in node.attrib:
+            return node.attrib["fill-rule"].strip()
+    return "nonzero"
+
+
+def builtin_rasterize_svg(color, src_path, size=ICON_SIZE):
+    "Renders the svg at src_path padded by FRAC into a size x size RGBA PIL image"
+    root = ET.parse(src_path).getroot()
+    _, _, width, height = map(float, filter(bool, re.split(r"[ ,]", root.attrib["viewBox"])))
+    width_gap, height_gap = (1 - FRAC) * width / 2, (1 - FRAC) * height / 2
+    supersize = size * BUILTIN_SUPERSAMPLING
+    scale_x, scale_y = supersize / width, supersize / height
+
+    mask = bytearray(supersize * supersize)
+    for element in root.iter():
+        tag = element.tag.rpartition("}")[2]
+        if tag in ("svg", "defs", "metadata", "title", "desc"):
+            continue
+        if tag != "path" or "transform" in element.attrib:
+            raise ValueError(f"Unsupported svg element <{tag}> in {src_path}")
+        polygons = [
+            [
+                ((FRAC * x + width_gap) * scale_x, (FRAC * y + height_gap) * scale_y)
+                for x, y in subpath
+            ]
+            for subpath in flatten_path(element.attrib.get("d", ""))
+        ]
+        rasterize_polygons(polygons, supersize, get_fill_rule(element, root) == "nonzero", mask)
+
+    alpha = Image.frombytes("L", (supersize, supersize), bytes(mask))
+    alpha = alpha.resize((size, size), Image.BOX)  # Average subpixels
+    image = Image.new("RGBA", (size, size), color)
+    image.putalpha(alpha)
+    return image
+
+
+def builtin_convert_svg2png(color, src_path, dst_path, whisper=False):
+    "Renders one icon in process with PIL, returns 0 on success like a command"
+    try:
+        builtin_rasterize_svg(color, src_path).save(dst_path)
+    except (ValueError, KeyError, OSError, ET.ParseError) as err:
+        if not whisper:
+            error(f"Could not render {src_path} ({err})", should_exit=False)
+        return 1
+    return 0
+
+
+def builtin_batch_convert_svg2png(color, jobs, whisper=False):
+    "Renders every (src_path, dst_path) in jobs, returns the list of jobs that failed"
+    return [
+        (src_path, dst_path)
+        for src_path, dst_path in jobs
+        if builtin_convert_svg2png(color, src_path, dst_path, whisper=whisper) != 0
+    ]
+
+
 # For demostration purposes
 if __name__ == "__main__":
     svg2png = inkscape_convert_svg2png
     # svg2png = magick_convert_svg2png
+    # svg2png = builtin_convert_svg2png
     for file in os.listdir("./icons"):
         basename, ext = os.path.splitext(file)
         if ext == ".svg":
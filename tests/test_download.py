@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Checks download() against a local HTTP server: conditional requests, resumes
+and interrupted transfers.
+
+Run with `python3 -m unittest discover tests` from the repository root.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download
+from download import FetchError
+
+BODY = bytes(range(256)) * 1024  # 256KiB, several CHUNK_SIZE chunks
+ETAG = '"matter-test-1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    "Serves BODY with an ETag and byte ranges, see the server attributes that tweak it"
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, like a CDN
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        ranges = self.headers.get("Range")
+        if ranges and self.headers.get("If-Range") == ETAG:
+            start = int(ranges[len("bytes="):].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(BODY) - 1}/{len(BODY)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(BODY) - start))
+        self.end_headers()
+
+        body = BODY[start:]
+        if server.truncations > 0:  # Drop the connection halfway through
+            server.truncations -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="matter-test-")
+        self.dst_path = os.path.join(self.temp_dir, "image.jpg")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        self.server.truncations = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/image.jpg"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def download(self, validators=None, retries=2):
+        return download.download(
+            self.url, self.dst_path, validators=validators, retries=retries, backoff=0
+        )
+
+    def read_dst(self):
+        with open(self.dst_path, "rb") as f:
+            return f.read()
+
+    def test_not_modified_keeps_file(self):
+        modified, validators = self.download()
+        self.assertTrue(modified)
+        self.assertEqual(validators["etag"], ETAG)
+        mtime = os.stat(self.dst_path).st_mtime_ns
+
+        modified, again = self.download(validators)
+        self.assertFalse(modified)
+        self.assertEqual(again, validators)
+        self.assertEqual(self.server.requests[-1].get("If-None-Match"), ETAG)
+        self.assertEqual(self.read_dst(), BODY)
+        self.assertEqual(os.stat(self.dst_path).st_mtime_ns, mtime)
+
+    def test_resume_appends_rest(self):
+        self.server.truncations = 1
+        modified, _ = self.download(retries=1)
+        self.assertTrue(modified)
+        self.assertEqual(self.read_dst(), BODY)
+        resumed = self.server.requests[-1]
+        self.assertEqual(resumed.get("Range"), f"bytes={len(BODY) // 2}-")
+        self.assertEqual(resumed.get("If-Range"), ETAG)
+        self.assertFalse(os.path.exists(f"{self.dst_path}.part"))
+
+    def test_interrupted_leaves_no_corrupt_file(self):
+        with open(self.dst_path, "wb") as f:
+            f.write(b"previous download")
+        self.server.truncations = 2
+        with self.assertRaises(FetchError):
+            self.download(retries=0)
+        self.assertEqual(self.read_dst(), b"previous download")
+        self.assertTrue(os.path.exists(f"{self.dst_path}.part"))  # Kept to resume
+
+        # The next call resumes from the .part, after another interruption
+        self.server.truncations = 1
+        with self.assertRaises(FetchError):
+            self.download(retries=0)
+        self.assertEqual(self.read_dst(), b"previous download")
+        modified, _ = self.download(retries=0)
+        self.assertTrue(modified)
+        self.assertEqual(self.read_dst(), BODY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Checks the grub.cfg lexer, parser and patching.
+
+Run with `python3 -m unittest discover tests` from the repository root.
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grubcfg
+import matter
+
+GRUB_CFG = b"""#
+# DO NOT EDIT THIS FILE { not a brace
+#
+function load_video {
+  if [ x$feature_all_video_module = xy ]; then
+    insmod all_video
+  fi
+}
+menuentry 'Ubuntu' --class ubuntu --class gnu-linux --class os $menuentry_id_option 'gnulinux-simple' {
+	echo	'Loading Linux { ...'
+	linux	/vmlinuz root=UUID=0f2c3a58 ro quiet splash
+}
+submenu 'Advanced options for Ubuntu' $menuentry_id_option 'gnulinux-advanced' {
+	menuentry "Say \\"hi\\" to \\$HOME" --class ubuntu {
+		linux	/vmlinuz-6.8.0 root=UUID=0f2c3a58 ro
+	}
+	submenu 'It'\\''s a {snapshot}' --id snapshots
+	{
+		menuentry Snapshot\\ 1 --class=ignored {
+			linux	/vmlinuz-6.8.0 ro
+		}
+	}
+}
+menuentry 'UEFI Firmware Settings' $menuentry_id_option 'uefi-firmware' {
+	fwsetup
+}
+"""
+
+
+def parse(data=GRUB_CFG):
+    return grubcfg.GrubCfg("<test>", data)
+
+
+def write_patched(grub_cfg, insertions):
+    output = io.BytesIO()
+    grub_cfg.write_patched(insertions, output)
+    return output.getvalue()
+
+
+class ParseTest(unittest.TestCase):
+    def test_entries(self):
+        entries = parse().entries
+        self.assertEqual(
+            [(entry.kind, entry.name, entry.depth) for entry in entries],
+            [
+                ("menuentry", "Ubuntu", 0),
+                ("submenu", "Advanced options for Ubuntu", 0),
+                ("menuentry", 'Say "hi" to $HOME', 1),
+                ("submenu", "It's a {snapshot}", 1),
+                ("menuentry", "Snapshot 1", 2),
+                ("menuentry", "UEFI Firmware Settings", 0),
+            ],
+        )
+
+    def test_classes_and_ids(self):
+        entries = parse().entries
+        self.assertEqual(entries[0].classes, ["ubuntu", "gnu-linux", "os"])
+        self.assertEqual(entries[0].id, "gnulinux-simple")
+        self.assertEqual(entries[2].classes, ["ubuntu"])
+        self.assertEqual(entries[3].id, "snapshots")
+        self.assertEqual(entries[4].classes, [])  # --class=... is not a class
+        self.assertEqual(entries[5].classes, [])
+
+    def test_title_offsets(self):
+        for entry in parse().entries:
+            raw = GRUB_CFG[entry.name_start:entry.name_end]
+            self.assertEqual(grubcfg.unquote(raw).decode(), entry.name)
+
+    def test_errors(self):
+        for data in (b"menuentry 'Ubuntu {\n}\n", b"}\n", b"menuentry 'Ubuntu'\n", b"menuentry {\n}\n"):
+            with self.subTest(data=data):
+                with self.assertRaises(grubcfg.GrubCfgError):
+                    parse(data)
+
+
+class PatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="matter-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_no_insertions_is_identical(self):
+        self.assertEqual(write_patched(parse(), []), GRUB_CFG)
+
+    def test_existing_icons_are_not_inserted_again(self):
+        grub_cfg = parse()
+        icons = ["ubuntu", "folder", "ubuntu", "_", "_", "_"]
+        insertions = matter.get_icon_insertions(grub_cfg.entries, icons)
+        self.assertEqual([offset for offset, _ in insertions], [grub_cfg.entries[1].name_end])
+        patched = write_patched(grub_cfg, insertions)
+        self.assertIn(b"submenu 'Advanced options for Ubuntu' --class folder $menu", patched)
+
+        # Patching the patched file with the same icons changes nothing
+        grub_cfg = parse(patched)
+        self.assertEqual(matter.get_icon_insertions(grub_cfg.entries, icons), [])
+        self.assertEqual(write_patched(grub_cfg, []), patched)
+
+    def test_insertions_across_chunks(self):
+        data = GRUB_CFG * 3
+        grub_cfg = parse(data)
+        insertions = [(entry.name_end, b" --class cog") for entry in grub_cfg.entries]
+        chunk_size = grubcfg.CHUNK_SIZE
+        grubcfg.CHUNK_SIZE = 7  # Many small copies between insertions
+        try:
+            patched = write_patched(grub_cfg, insertions)
+        finally:
+            grubcfg.CHUNK_SIZE = chunk_size
+        self.assertEqual(patched.replace(b" --class cog", b""), data)
+        self.assertEqual(patched.count(b" --class cog"), len(grub_cfg.entries))
+
+    def test_patch_file_round_trip(self):
+        path = os.path.join(self.temp_dir, "grub.cfg")
+        with open(path, "wb") as f:
+            f.write(GRUB_CFG)
+        grubcfg.load(path).patch([])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), GRUB_CFG)
+
+        grub_cfg = grubcfg.load(path)
+        self.assertIs(grubcfg.load(path), grub_cfg)  # Cached while unchanged
+        grub_cfg.patch([(grub_cfg.entries[-1].name_end, b" --class cog")])
+        patched = grubcfg.load(path)
+        self.assertIsNot(patched, grub_cfg)
+        self.assertEqual(patched.entries[-1].classes, ["cog"])
+        self.assertEqual([e.name for e in patched.entries], [e.name for e in grub_cfg.entries])
+
+
+if __name__ == "__main__":
+    unittest.main()
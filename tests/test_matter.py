@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Checks matter.py functions that run on every grub update.
+
+Run with `python3 -m unittest discover tests` from the repository root.
+"""
+
+import io
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matter
+
+GRUB_CFG = b"""set timeout=5
+menuentry 'Ubuntu' --class ubuntu $menuentry_id_option 'gnulinux-simple' {
+	linux	/vmlinuz root=UUID=0f2c3a58 ro quiet splash
+}
+submenu 'Advanced options for Ubuntu' $menuentry_id_option 'gnulinux-advanced' {
+	menuentry 'Ubuntu, with Linux 6.8.0' --class ubuntu {
+		linux	/vmlinuz-6.8.0 root=UUID=0f2c3a58 ro
+	}
+}
+menuentry 'UEFI Firmware Settings' $menuentry_id_option 'uefi-firmware' {
+	fwsetup
+}
+"""
+
+
+class FilterIconsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="matter-test-")
+        self.config_path = matter.CONFIG_FILE_PATH
+        matter.CONFIG_FILE_PATH = os.path.join(self.temp_dir, "config.json")
+
+    def tearDown(self):
+        matter.CONFIG_FILE_PATH = self.config_path
+        shutil.rmtree(self.temp_dir)
+
+    def filter_icons(self, config):
+        "Returns the output of do_filter_icons() for GRUB_CFG with config.json holding config"
+        with open(matter.CONFIG_FILE_PATH, "w") as f:
+            f.write(config)
+        stdin, stdout = sys.stdin, sys.stdout
+        output = io.BytesIO()
+        wrapper = io.TextIOWrapper(output)  # Referenced so it doesn't close output
+        sys.stdin = io.TextIOWrapper(io.BytesIO(GRUB_CFG))
+        sys.stdout = wrapper
+        try:
+            with redirect_stderr(io.StringIO()):
+                matter.do_filter_icons()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+        return output.getvalue()
+
+    def test_sets_icons(self):
+        config = '{"icons": {"Ubuntu": "linux", "UEFI Firmware Settings": "cog"}}'
+        output = self.filter_icons(config)
+        self.assertIn(b"menuentry 'Ubuntu' --class linux --class ubuntu $menu", output)
+        self.assertIn(b"menuentry 'UEFI Firmware Settings' --class cog $menu", output)
+
+    def test_broken_config_passes_input_through(self):
+        for config in ("[]", "{", '{"icons": 3}', '{"icons": {}, "rules": [["re:(", "x"]]}', ""):
+            with self.subTest(config=config):
+                self.assertEqual(self.filter_icons(config), GRUB_CFG)
+
+
+class IconRulesTest(unittest.TestCase):
+    def test_first_matching_rule_wins(self):
+        get_icon = matter.compile_icon_rules(
+            [
+                ["Ubuntu*", "ubuntu"],
+                ["re:.*(?:[Ss]napshot|btrfs).*", "camera"],
+                ["*Linux*", "linux"],
+                ["re:Ubuntu, with Linux .*", "never"],  # Ubuntu* matches first
+                ["*", "folder"],
+            ]
+        )
+        self.assertEqual(get_icon("Ubuntu, with Linux 6.8.0"), "ubuntu")
+        self.assertEqual(get_icon("Ubuntu snapshot 3"), "ubuntu")
+        self.assertEqual(get_icon("Arch Linux snapshot 3"), "camera")
+        self.assertEqual(get_icon("Arch Linux"), "linux")
+        self.assertEqual(get_icon("UEFI Firmware Settings"), "folder")
+        self.assertEqual(get_icon(""), "folder")
+
+    def test_whole_name_is_matched(self):
+        get_icon = matter.compile_icon_rules(
+            [["Windows", "microsoft-windows"], ["re:Arch|Debian", "linux"], ["re:a.c", "abc"]]
+        )
+        self.assertEqual(get_icon("Windows"), "microsoft-windows")
+        self.assertIsNone(get_icon("Windows Boot Manager"))
+        self.assertIsNone(get_icon("Old Windows"))
+        self.assertEqual(get_icon("Debian"), "linux")
+        self.assertIsNone(get_icon("Arch Linux"))  # The alternation is anchored as a whole
+        self.assertIsNone(get_icon("Debian GNU/Linux"))
+        self.assertIsNone(get_icon("abc\n"))  # \Z, not $
+
+    def test_globs_are_literal_but_for_wildcards(self):
+        get_icon = matter.compile_icon_rules([["Memtest86+ (*)", "memory"], ["[Ww]in*", "windows"]])
+        self.assertEqual(get_icon("Memtest86+ (serial console)"), "memory")
+        self.assertIsNone(get_icon("Memtest866 (serial console)"))
+        self.assertEqual(get_icon("win10"), "windows")
+        self.assertEqual(get_icon("Win11"), "windows")
+
+    def test_rules_with_group_references_are_refused(self):
+        for pattern in ["re:(a)\\1", "re:(a)(?(1)b|c)", "re:(?P<name>a)", "re:(?i)ubuntu"]:
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(re.error):
+                    matter.compile_icon_rules([[pattern, "x"]])
+        with redirect_stdout(io.StringIO()), self.assertRaises(SystemExit):
+            matter.parse_icon_rules(["re:(a)\\1=x"])
+
+    def test_groups_of_joined_rules_dont_interfere(self):
+        get_icon = matter.compile_icon_rules(
+            [["re:(\\d+) kernel", "chip"], ["re:(a|b)+", "letters"], ["re:\\\\1", "backslash"]]
+        )
+        self.assertEqual(get_icon("12 kernel"), "chip")
+        self.assertEqual(get_icon("abba"), "letters")
+        self.assertEqual(get_icon("\\1"), "backslash")
+
+
+if __name__ == "__main__":
+    unittest.main()
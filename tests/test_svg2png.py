@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Checks the builtin rasterizer against inkscape, the reference converter.
+
+The svgs in data/ are MDI icons plus a small one mixing fill rules. Run with
+`python3 -m unittest discover tests` from the repository root. Comparisons
+against inkscape are skipped when it is not installed.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import svg2png
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+MDI_ICONS = ["home", "plus", "circle-outline"]
+COLOR = "#ffffff"
+MAX_MEAN_ALPHA_DIFF = 6  # Out of 255, antialiasing of edges differs a bit
+MAX_COVERAGE_DIFF = 0.03  # Relative difference of the total painted alpha
+
+
+def get_alpha(path):
+    with Image.open(path) as im:
+        return list(im.convert("RGBA").getchannel("A").getdata())
+
+
+@unittest.skipIf(Image is None, "PIL is needed by the builtin rasterizer")
+class BuiltinRasterizerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="matter-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def render_builtin(self, name):
+        path = os.path.join(self.temp_dir, f"{name}.builtin.png")
+        src_path = os.path.join(DATA_DIR, f"{name}.svg")
+        self.assertEqual(svg2png.builtin_convert_svg2png(COLOR, src_path, path), 0)
+        return path
+
+    @unittest.skipIf(shutil.which("inkscape") is None, "inkscape is not installed")
+    def test_matches_inkscape(self):
+        for name in MDI_ICONS + ["mixed-fill-rule"]:
+            with self.subTest(icon=name):
+                reference_path = os.path.join(self.temp_dir, f"{name}.inkscape.png")
+                src_path = os.path.join(DATA_DIR, f"{name}.svg")
+                exit_code = svg2png.inkscape_convert_svg2png(
+                    COLOR, src_path, reference_path, whisper=True
+                )
+                self.assertEqual(exit_code, 0)
+                expected = get_alpha(reference_path)
+                actual = get_alpha(self.render_builtin(name))
+                self.assertEqual(len(actual), len(expected))
+                mean_diff = sum(abs(a - b) for a, b in zip(actual, expected)) / len(actual)
+                self.assertLessEqual(mean_diff, MAX_MEAN_ALPHA_DIFF)
+                coverage_diff = abs(sum(actual) - sum(expected)) / max(1, sum(expected))
+                self.assertLessEqual(coverage_diff, MAX_COVERAGE_DIFF)
+
+    def test_fill_rule_per_element(self):
+        # Both squares have a same direction inner square, only the evenodd one is a hole
+        with Image.open(self.render_builtin("mixed-fill-rule")) as im:
+            alpha = im.getchannel("A")
+            self.assertEqual(alpha.getpixel((23, 23)), 0)  # evenodd center
+            self.assertEqual(alpha.getpixel((16, 23)), 255)  # evenodd border
+            self.assertEqual(alpha.getpixel((48, 23)), 255)  # nonzero center
+
+
+if __name__ == "__main__":
+    unittest.main()
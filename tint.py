@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Recoloring of single color images through their alpha masks.
+
+Icons are rasterized once, in MASK_COLOR, and only their alpha (coverage) is
+kept as a grayscale mask, so any color is a cheap tint of the mask instead of
+another svg conversion. The same goes for the bundled pixmaps, which are
+single color too. Masks of the same size are tinted at once as a single
+NumPy array when NumPy is installed, one by one with PIL otherwise.
+"""
+
+from PIL import Image, ImageColor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MASK_COLOR = "#ffffff"  # Rasterizing in white keeps the whole coverage in alpha
+
+
+def get_mask(im):
+    "Returns the alpha channel of im as an L mode mask, im itself if already a mask"
+    if im.mode == "L":
+        return im
+    return im.convert("RGBA").getchannel("A")
+
+
+def load_mask(path):
+    with Image.open(path) as im:
+        im.load()
+        return get_mask(im)
+
+
+def save_mask(path):
+    "Replaces the png at path with its mask"
+    mask = load_mask(path)
+    mask.save(path, "PNG")
+
+
+def tint(masks, color):
+    "Returns an RGBA image of color (e.g. #ff0000) per mask, with the mask as alpha"
+    rgb = ImageColor.getrgb(color)[:3]
+    if numpy is None:
+        tinted = []
+        for mask in masks:
+            im = Image.new("RGBA", mask.size, rgb + (0,))
+            im.putalpha(mask)
+            tinted.append(im)
+        return tinted
+
+    by_size = {}  # Tint masks of the same size as a single array
+    for i, mask in enumerate(masks):
+        by_size.setdefault(mask.size, []).append(i)
+    tinted = [None] * len(masks)
+    for indexes in by_size.values():
+        alphas = numpy.stack([numpy.asarray(masks[i], dtype=numpy.uint8) for i in indexes])
+        pixels = numpy.empty(alphas.shape + (4,), dtype=numpy.uint8)
+        pixels[..., :3] = rgb
+        pixels[..., 3] = alphas
+        for i, image_pixels in zip(indexes, pixels):
+            tinted[i] = Image.fromarray(image_pixels)
+    return tinted
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
+import os
+import re
+import hashlib
+import tempfile
+from contextlib import contextmanager
 from subprocess import run, PIPE
-from shutil import which
+from shutil import which, copymode
 
 # Logging utils
 
@@ -59,3 +64,81 @@ def shout(command, silence=False):
 
 def has_command(command):
     return which(command) is not None
+
+
+# File utils
+
+
+def fingerprint(content):
+    "Returns a digest of str or bytes content to compare files cheaply"
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).digest()
+
+
+def file_fingerprint(path):
+    "Returns the fingerprint of the file at path or None if it does not exist"
+    try:
+        with open(path, "rb") as f:
+            return fingerprint(f.read())
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def atomic_open(path, mode="w", buffering=-1):
+    """Opens a temporary file that atomically replaces path once closed.
+
+    The data is fsync-ed before the rename and the directory after it, so a
+    crash leaves either the old or the new file but never a truncated one.
+    The permissions of the replaced file are kept.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".matter-", dir=directory)
+    try:
+        with os.fdopen(fd, mode, buffering=buffering) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            copymode(path, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_if_changed(path, content):
+    "Atomically writes content to path unless it already has it, returns if it wrote"
+    if file_fingerprint(path) == fingerprint(content):
+        return False
+    with atomic_open(path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    return True
+
+
+def remove_marker_block(text, begin, end):
+    "Removes the blocks of text between begin and end lines, markers included"
+
+    def replacement(match):
+        # Keep the line break of the content before the block
+        return "\n" if match.start() > 0 else ""
+
+    pattern = f"\n*^{re.escape(begin)}$.*?^{re.escape(end)}$\n*"
+    return re.sub(pattern, replacement, text, flags=re.DOTALL | re.MULTILINE)
+
+
+def set_marker_block(text, begin, end, block=None):
+    "Returns text with its begin/end marker block replaced by block, or removed if None"
+    text = remove_marker_block(text, begin, end)
+    if block is not None:
+        text = text.rstrip("\n") + f"\n\n{begin}\n{block}\n{end}\n\n"
+    return text